@@ -7,36 +7,104 @@ station, forecast zone, and radar location.
 
 Download the waether location database each run. Use httplib2 for caching.
 
-Script usage: python3 closest_weather_location.py
+Offline-first mode (--offline) answers at once from local snapshots: the
+cached downloads, or else the ones bundled in BUNDLE. httplib2 is only
+imported when a download is actually needed: here, when a snapshot is
+older than --max-age seconds, it is refreshed after the answer.
+
+Long-running callers can watch() for a newly published generation of the
+tables (see nws_database_creator --watch), and swap it in while queries go
+on (see WeatherLocator.swap).
+
+Script usage: python3 closest_weather_location.py [--offline [--max-age S]]
 """
 # Python Standard Library (Debian package libpython3.*-minimal)
 import io
+import os
 
 # Python Standard Library (Debian package libpython3.*-stdlib)
+import argparse
 import csv
+import hashlib
+import json
 import math
+import threading
+import time
 
 # Other Python packages
-import httplib2      # (Debian package python3-httplib2)
+httplib2 = None     # (Debian package python3-httplib2)
+                    # Imported on first download (see _http): it is slow,
+                    # and so is weather_http, which imports it
+
+# Other modules of this project
+import weather_bundle
+import weather_delta
+import weather_metrics
+import weather_polygons
+import weather_raster
+import weather_snapshot
+import weather_sqlite
+from weather_index import SphereIndex, nearby_stations, nearest_many, \
+    nearest_row
 
 
 LATITUDE  = 43.01
 LONGITUDE = -87.99
+CACHE     = '/tmp/weather'
+URL       = 'https://raw.githubusercontent.com/ian-weisser/data/master/'
+PARSED    = os.path.join(CACHE, 'parsed')   # Cache of parsed CSV tables
+PARSE_MAX = 32 * 1024 * 1024                # Bytes. Oldest are evicted
+TABLES    = ['metar', 'radar', 'zone']
+KEYS      = {'metar': 'Name', 'radar': 'Name', 'zone': 'Zone'}
+JOINS     = {'zone': 'zone_join', 'metar': 'metar_join'}
+BUNDLE    = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+MAX_AGE   = 24 * 60 * 60                    # Seconds. Older are refreshed
+GEN_FILE  = 'generation.json'               # Published generation counter
+WATCH     = 60                              # Seconds between its checks
+
+BEST_METRICS = False    # Count the work of every best() in weather_metrics
+                        # (opt-in: it adds about 30% to every lookup)
+
+_decoded  = None    # (sha256, tables) of the last bundle decoded
+
+
+def _http():
+    """
+    The shared weather_http.Session, with the cache. Imports httplib2 (and
+    weather_http) on first use
+    """
+    global httplib2
+    import weather_http
+    httplib2 = weather_http.httplib2
+    return weather_http.session(CACHE)
+
+
+def _errors(*others):
+    """ The exceptions of a failed download (for except clauses) """
+    errors = (OSError, ValueError) + others
+    if httplib2 is not None:
+        errors = errors + (httplib2.HttpLib2Error,)
+    return errors
+
 
 def download(dl_type):
-    """ Download data tables """
-    cache    = '/tmp/weather'
-    url      = 'https://raw.githubusercontent.com/ian-weisser/data/master/'
-    if dl_type   == 'metar':
-        source = url + 'metar.csv'
-    elif dl_type == 'radar':
-        source = url + 'radar.csv'
-    elif dl_type == 'zone':
-        source = url + 'zone.csv'
-    else:
+    """
+    Download data tables
+    The radar, metar, and zone tables come from the compressed bundle if
+    it is published (see download_bundle), otherwise from their CSVs.
+    Each call fetches the bundle again: to get several tables, use
+    load_all(), which fetches it once.
+    """
+    if dl_type not in TABLES and dl_type not in JOINS.values():
         return
+    if dl_type in TABLES:
+        try:
+            return download_bundle()[dl_type]
+        except _errors(KeyError):
+            pass                # No usable bundle: the CSV
+    source = URL + dl_type + '.csv'
 
-    get           = httplib2.Http(cache)
+    get           = _http()
     #resp, content = get.request(source, "GET")
     #status        = resp['status']
     content       = get.request(source, "GET")[1].decode('utf-8')
@@ -46,6 +114,260 @@ def download(dl_type):
     return table
 
 
+def download_bundle():
+    """
+    Download the compressed bundle of all three tables, in one request,
+    and decode it (see weather_bundle).
+    Output is a dict of {table name: weather_bundle.BundleTable}.
+    Raises OSError or ValueError if the bundle is not available.
+    The last bundle decoded is kept, so the three tables of one bundle
+    are decoded only once.
+    """
+    global _decoded
+    source        = URL + 'bundle.bin'
+    resp, content = _http().request(source, "GET")
+    if resp.status != 200:
+        raise OSError("{}: server status {}".format(source, resp.status))
+    digest = hashlib.sha256(content).hexdigest()
+    last   = _decoded
+    if last is not None and last[0] == digest:
+        return last[1]
+    tables   = weather_bundle.decode(content)
+    _decoded = (digest, tables)
+    return tables
+
+
+def download_file(filename):
+    """
+    Download a binary data file, and save it in the cache directory.
+    Output is the local path.
+    Raises OSError if the file is not available.
+    """
+    source = URL + filename
+    path   = os.path.join(CACHE, filename)
+
+    get           = _http()
+    resp, content = get.request(source, "GET")
+    if resp.status != 200:
+        raise OSError("{}: server status {}".format(source, resp.status))
+
+    # Replace the file only if it changed. Write a new file and rename it,
+    # so other processes that still map the old file are not disturbed.
+    try:
+        with open(path, 'rb') as binfile:
+            unchanged = binfile.read() == content
+    except OSError:
+        unchanged = False
+    if unchanged:
+        os.utime(path)          # Checked now: it is fresh (see MAX_AGE)
+    else:
+        os.makedirs(CACHE, exist_ok=True)
+        with open(path + '.tmp', 'wb') as binfile:
+            binfile.write(content)
+        os.replace(path + '.tmp', path)
+
+    return path
+
+
+def download_snapshot(dl_type):
+    """
+    Download the binary snapshot of a data table, save it in the cache
+    directory, and memory-map it.
+    Raises OSError or ValueError if the snapshot is not available.
+    """
+    if dl_type not in TABLES:
+        raise ValueError("Unknown table: {}".format(dl_type))
+    return weather_snapshot.Snapshot(download_file(dl_type + '.bin'))
+
+
+def download_delta(dl_type, old_text):
+    """
+    Update a previously downloaded CSV table by applying only its delta.
+    Input: the table type, and the text of the previous CSV
+    Output is the text of the new CSV.
+    Raises ValueError if the delta does not apply to old_text: the table
+    changed more than once since. Then download the whole CSV again.
+    """
+    if dl_type not in TABLES:
+        raise ValueError("Unknown table: {}".format(dl_type))
+    source = URL + dl_type + '.delta.json'
+
+    get           = _http()
+    resp, content = get.request(source, "GET")
+    if resp.status != 200:
+        raise ValueError("{}: server status {}".format(source, resp.status))
+    delta = json.loads(content.decode('utf-8'))
+    if delta['hash'] == weather_delta.digest(old_text):
+        return old_text         # Already up to date
+    return weather_delta.apply(old_text, delta)
+
+
+def load_raster():
+    """ Download the nearest-station raster. None if it is not available """
+    try:
+        return weather_raster.Raster(download_file('raster.bin'))
+    except _errors():
+        return None
+
+
+def load_join(dl_type):
+    """
+    Download the join table of 'zone' or 'metar': the nearest radar and
+    METAR stations of each (see nws_database_creator.joins).
+    Output is a dict of {zone or station ID: row}, or None if the table is
+    not available.
+    """
+    try:
+        rows = download(JOINS[dl_type])
+        return dict((row[KEYS[dl_type]], row) for row in rows)
+    except _errors(KeyError):
+        return None
+
+
+def load_polygons():
+    """ Download the zone boundary polygons. None if not available """
+    try:
+        return weather_polygons.ZonePolygons(
+            download_file('zone_polygons.bin'))
+    except _errors():
+        return None
+
+
+def load_database():
+    """
+    Download the SQLite database of all three tables (see weather_sqlite).
+    Raises OSError or httplib2.HttpLib2Error if it is not available.
+    """
+    return weather_sqlite.Database(download_file('weather.sqlite'))
+
+
+def download_parsed(dl_type):
+    """
+    Download a CSV data table, and return it parsed, as a Snapshot.
+    The parsed table is cached on disk in the snapshot format, keyed by
+    the ETag (or Last-Modified) of the response. When the server answers
+    304 Not Modified, the cached table is memory-mapped: the CSV is not
+    decoded or parsed again.
+    Raises OSError if the server answers with an error status.
+    """
+    if dl_type not in TABLES:
+        raise ValueError("Unknown table: {}".format(dl_type))
+    source = URL + dl_type + '.csv'
+
+    get           = _http()
+    resp, content = get.request(source, "GET")
+    if resp.status not in (200, 304):
+        # An error page is not a table: do not parse or cache it
+        raise OSError("{}: server status {}".format(source, resp.status))
+    validator     = resp.get('etag') or resp.get('last-modified')
+    if validator is None:
+        # No validator: key the cache with the content itself
+        validator = hashlib.sha256(content).hexdigest()
+
+    key  = hashlib.sha256((source + '\n' + validator).encode('utf-8'))
+    path = os.path.join(PARSED, dl_type + '-' + key.hexdigest()[:32] + '.bin')
+    try:
+        table = weather_snapshot.Snapshot(path)
+        os.utime(path)              # Mark it as recently used
+        return table
+    except (OSError, ValueError):
+        pass
+
+    rows = csv.DictReader(io.StringIO(content.decode('utf-8')))
+    rows = list(rows)
+    fieldnames = list(rows[0].keys()) if rows else ['Latitude', 'Longitude']
+    os.makedirs(PARSED, exist_ok=True)
+    weather_snapshot.write(path, fieldnames, rows)
+    evict_parsed(keep=path)
+    return weather_snapshot.Snapshot(path)
+
+
+def evict_parsed(keep=None, max_bytes=None):
+    """
+    Delete the least recently used parsed tables, until the cache is no
+    larger than max_bytes (default PARSE_MAX). The keep file is never
+    deleted.
+    """
+    if max_bytes is None:
+        max_bytes = PARSE_MAX
+    try:
+        names = os.listdir(PARSED)
+    except OSError:
+        return
+    entries = []
+    for name in names:
+        path = os.path.join(PARSED, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()              # Least recently used first
+
+    total = sum(entry[1] for entry in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)     # Readers that mapped it keep their copy
+        except OSError:
+            continue
+        total = total - size
+
+
+def load(dl_type):
+    """
+    Load a data table: the memory-mapped binary snapshot if possible,
+    otherwise the CSV, parsed (and cached) by download_parsed()
+    """
+    try:
+        return download_snapshot(dl_type)
+    except _errors():
+        return download_parsed(dl_type)
+
+
+def load_all(dl_types=TABLES):
+    """
+    Load several data tables at once: all from one download of the
+    compressed bundle, if it is published (see download_bundle). Tables
+    not in the bundle, or all of them if it is not available, are loaded
+    one by one with load().
+    Output is a dict of {table name: table}.
+    """
+    try:
+        bundle = download_bundle()
+    except _errors():
+        bundle = {}
+    tables = {}
+    for dl_type in dl_types:
+        if dl_type not in TABLES:
+            raise ValueError("Unknown table: {}".format(dl_type))
+        tables[dl_type] = bundle[dl_type] if dl_type in bundle \
+            else load(dl_type)
+    return tables
+
+
+def load_local(dl_type):
+    """
+    Load a table without any network round trip: the snapshot cached by
+    an earlier download, or else the one bundled in BUNDLE.
+    Output is a tuple of (Snapshot, age in seconds).
+    Raises OSError or ValueError if there is no usable local snapshot.
+    """
+    if dl_type not in TABLES:
+        raise ValueError("Unknown table: {}".format(dl_type))
+    for directory in (CACHE, BUNDLE):
+        path = os.path.join(directory, dl_type + '.bin')
+        try:
+            table = weather_snapshot.Snapshot(path)
+        except (OSError, ValueError):
+            continue
+        return (table, time.time() - os.path.getmtime(path))
+    raise OSError("No local snapshot of the {} table".format(dl_type))
+
+
 def precise_distance(a_lat, a_lon, b_lat, b_lon):
     """
     The Haversine formula is a generally accepted way of finding the
@@ -98,49 +420,525 @@ def rough_distance(degree_variance, test_latitude, test_longitude):
         return False
 
 
-def best(many_locations):
-    """
-    Iterate through the dict, looking for best candidates.
+def best(many_locations, latitude=None, longitude=None):
     """
+    Find the closest location in a table.
+    Input: a SphereIndex, or any iterable of rows (like download() returns)
+    Output: a copy of the closest row, or None if the table is empty.
 
-    closest_dist = 100000
-    closest_sta  = {}
-    for loc in many_locations:
-        if loc['Latitude'] == '' or loc['Longitude'] == '':
-            continue
-        lat = float(loc['Latitude'])
-        lon = float(loc['Longitude'])
+    Rows are searched once, with an exact linear scan (see nearest_row).
+    Long-running callers should build a SphereIndex once, and pass it on
+    every later call: each query is then O(log n).
 
-        # Pass all locations within 5 degrees.
-        # It's a rough filter, but uses fewer CPU cycles.
-        if not rough_distance(5, lat, lon):
-            continue
+    If BEST_METRICS is set, the work is counted in weather_metrics.METRICS:
+    each scan as best_scans_total, and each index query as
+    best_queries_total, best_candidates_total (rows searched),
+    best_distance_evaluations_total, best_pruned_subtrees_total, and the
+    best_prune_ratio gauge: the share of candidates whose distance was
+    never computed.
+    """
+    if latitude is None:
+        latitude  = LATITUDE
+    if longitude is None:
+        longitude = LONGITUDE
 
-        # Measure the distances of those closest hits.
-        # This is more precise, but uses more CPU cycles.
-        dist = precise_distance(LATITUDE, LONGITUDE, lat, lon )
-        if  dist < closest_dist:
-            closest_dist = dist
-            closest_sta.update(loc)
+    metrics = weather_metrics.METRICS
+    if not isinstance(many_locations, SphereIndex):
+        closest_sta = nearest_row(many_locations, latitude, longitude)[0]
+        if BEST_METRICS:
+            metrics.count('best_scans_total')
+        return None if closest_sta is None else dict(closest_sta)
 
-    if len(closest_sta) == 0:
+    index = many_locations
+    if not BEST_METRICS:
+        closest_sta = index.nearest(latitude, longitude)[0]
+        return None if closest_sta is None else dict(closest_sta)
+
+    stats       = {}
+    closest_sta = index.nearest(latitude, longitude, stats=stats)[0]
+    metrics.count('best_queries_total')
+    metrics.count('best_candidates_total', len(index))
+    metrics.count('best_distance_evaluations_total', stats['evaluations'])
+    metrics.count('best_pruned_subtrees_total', stats['pruned'])
+    candidates = metrics.value('best_candidates_total')
+    if candidates:
+        metrics.gauge('best_prune_ratio', 1 - metrics.value(
+            'best_distance_evaluations_total') / candidates)
+    if closest_sta is None:
         return None
     else:
-        return closest_sta
+        return dict(closest_sta)
+
+
+def resolve_many(latitudes, longitudes, radars, metars, zones,
+                 chunk_size=None):
+    """
+    Batch version of run(): resolve many locations at once (needs numpy)
+    Input: arrays of query lat/lon, and the SphereIndex of each table
+    Output: a dict of numpy arrays of row positions, one per query point.
+           Use index.rows[position] to get the row of each index passed in
+           (-1 where there is none, see nearest_many).
+    Raises TypeError if a table is not a SphereIndex: positions are only
+    meaningful in an index the caller keeps.
+    """
+    output = {}
+    for key, table in (('Radar', radars), ('Observation', metars),
+                       ('Zone', zones)):
+        if not isinstance(table, SphereIndex):
+            raise TypeError("resolve_many() needs a SphereIndex of each "
+                            "table, not {}".format(type(table).__name__))
+        output[key] = nearest_many(table, latitudes, longitudes,
+                                   chunk_size)[0]
+    return output
+
+
+class LocatorTables(object):
+    """
+    One consistent set of the tables of a WeatherLocator: the indexes,
+    and the optional raster, polygons, and join tables.
+    A query reads the locator's set once, and uses only that set, so a
+    swap (see WeatherLocator.swap) never mixes two sets in one answer.
+    """
+    def __init__(self, indexes, raster=None, polygons=None, joins=None,
+                 generation=None):
+        self.indexes    = indexes   # Table -> SphereIndex
+        self.raster     = raster
+        self.polygons   = polygons
+        self.joins      = joins or {}
+        self.generation = generation
+        self.keys       = {}        # Table -> {station ID: row position}
+
+    def positions(self, dl_type):
+        """ {station ID: row position} of one table, built on first use """
+        positions = self.keys.get(dl_type)
+        if positions is None:
+            key       = KEYS[dl_type]
+            positions = dict((row[key], position) for position, row
+                             in enumerate(self.indexes[dl_type].rows))
+            self.keys[dl_type] = positions
+        return positions
+
+
+class WeatherLocator(object):
+    """
+    Long-lived resolver for services that answer many location queries
+    - Load the radar, metar, and zone tables once
+    - Keep each as a SphereIndex, with parsed float coordinates
+    - Each query is then compute only: no I/O, no string parsing
+    - (optional) Answer from a precomputed weather_raster.Raster first
+    - (optional) Find the zone that contains the point, from its boundary
+      polygons (weather_polygons.ZonePolygons)
+    - (optional) Answer zone -> stations from the precomputed join tables
+    - (optional) Memoize answers for nearby points, in a
+      weather_cache.QueryCache
+    - Double buffered: new tables are loaded to the side, while queries
+      go on, then swapped in at once (see swap, reload_generation)
+    """
+    def __init__(self, radars=None, metars=None, zones=None, raster=None,
+                 polygons=None, joins=None, cache=None, generation=None):
+        """
+        Build the indexes. Tables not passed in are loaded together, with
+        load_all().
+        Each table may be a SphereIndex, a Snapshot, or an iterable of rows.
+        joins is a dict of {'zone' or 'metar': load_join() output}.
+        With a cache, nearest() and nearest_zone() answer for the cache's
+        grid point, not the exact point.
+        generation is the published generation of the tables, if known.
+        """
+        self.cache = cache
+        tables     = {'radar': radars, 'metar': metars, 'zone': zones}
+        missing    = [dl_type for dl_type in TABLES if tables[dl_type] is None]
+        if missing:
+            tables.update(load_all(missing))
+        indexes    = {}
+        for dl_type, table in tables.items():
+            if not isinstance(table, SphereIndex):
+                table = SphereIndex(table)
+            indexes[dl_type] = table
+
+        self.tables = LocatorTables(indexes, raster, polygons, joins,
+                                    generation)
+        if raster is not None or polygons is not None:
+            for dl_type in indexes:
+                self.tables.positions(dl_type)
+
+    @property
+    def indexes(self):
+        """ The current SphereIndex of each table """
+        return self.tables.indexes
+
+    @property
+    def raster(self):
+        """ The current raster, or None """
+        return self.tables.raster
+
+    @property
+    def polygons(self):
+        """ The current zone polygons, or None """
+        return self.tables.polygons
+
+    @property
+    def joins(self):
+        """ The current join tables """
+        return self.tables.joins
+
+    @property
+    def generation(self):
+        """ The published generation of the current tables, or None """
+        return self.tables.generation
+
+    def swap(self, fresh):
+        """
+        Answer from the tables of another locator (built to the side)
+        from now on. Queries already running finish with the old tables.
+        The cache, if any, is cleared.
+        """
+        self.tables = fresh.tables
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _cached(self, kind, latitude, longitude, compute):
+        """
+        compute(tables, latitude, longitude), through the cache if any.
+        The tables are read when the answer is computed: an answer from
+        tables swapped out meanwhile is not cached (see QueryCache.clear)
+        """
+        if self.cache is None:
+            return compute(self.tables, latitude, longitude)
+        answer = self.cache.lookup(kind, latitude, longitude,
+                                   lambda lat, lon: compute(self.tables,
+                                                            lat, lon))
+        return None if answer is None else dict(answer)
+
+    def nearest(self, dl_type, latitude, longitude):
+        """
+        Closest row of one table ('radar', 'metar', or 'zone')
+        The raster answers in O(1) inside its grid, except near a boundary
+        between stations. Everything else is an exact index search.
+        """
+        return self._cached(dl_type, latitude, longitude,
+                            lambda tables, lat, lon:
+                            self._nearest(tables, dl_type, lat, lon))
+
+    def _nearest(self, tables, dl_type, latitude, longitude):
+        """ nearest(), without the cache """
+        if tables.raster is not None:
+            sta_id    = tables.raster.lookup(dl_type, latitude, longitude)
+            positions = tables.positions(dl_type)
+            if sta_id in positions:
+                return dict(tables.indexes[dl_type].rows[positions[sta_id]])
+        return best(tables.indexes[dl_type], latitude, longitude)
+
+    def nearest_radar(self, latitude, longitude):
+        """ Closest radar station, as a dict """
+        return self.nearest('radar', latitude, longitude)
+
+    def nearest_metar(self, latitude, longitude):
+        """ Closest METAR observation station, as a dict """
+        return self.nearest('metar', latitude, longitude)
+
+    def nearest_zone(self, latitude, longitude):
+        """
+        The forecast zone that contains the point, as a dict.
+        Without zone polygons, or outside all of them, it is the zone with
+        the closest centroid.
+        """
+        return self._cached('zone_area', latitude, longitude,
+                            self._nearest_zone)
+
+    def _nearest_zone(self, tables, latitude, longitude):
+        """ nearest_zone(), without the cache """
+        if tables.polygons is not None:
+            sta_id    = tables.polygons.lookup(latitude, longitude)
+            positions = tables.positions('zone')
+            if sta_id in positions:
+                return dict(tables.indexes['zone'].rows[positions[sta_id]])
+        return self._nearest(tables, 'zone', latitude, longitude)
+
+    def stations(self, dl_type, sta_id, count=3):
+        """
+        The nearest radar, and the count nearest METAR stations, of one
+        zone or METAR station (a METAR station is not its own neighbor).
+        Output is a dict like a join table row: Radar, Radar_km, Metar_1,
+        Metar_1_km, ... or None if the ID is unknown.
+        One keyed lookup when the join table is loaded and has enough
+        stations. Otherwise they are searched for.
+        """
+        tables = self.tables
+        join   = tables.joins.get(dl_type)
+        if join is not None and sta_id in join \
+        and 'Metar_{}'.format(count) in join[sta_id]:
+            return dict(join[sta_id])
+
+        if dl_type not in ('zone', 'metar'):
+            raise ValueError("Unknown table: {}".format(dl_type))
+        positions = tables.positions(dl_type)
+        if sta_id not in positions:
+            return None
+        index = tables.indexes[dl_type]
+        lat   = index.latitudes[positions[sta_id]]
+        lon   = index.longitudes[positions[sta_id]]
+
+        exclude = sta_id if dl_type == 'metar' else None
+        output  = {KEYS[dl_type]: sta_id}
+        nearby  = nearby_stations(tables.indexes['radar'],
+                                  tables.indexes['metar'], lat, lon, count,
+                                  exclude)
+        for field, value in nearby.items():
+            output[field] = str(value)
+        return output
+
+    def nearest_k(self, dl_type, latitude, longitude, k):
+        """
+        The k closest rows of one table, nearest first, for fallbacks when
+        the closest station is offline.
+        Yields (row dict, distance in km). Lazy: stop whenever enough.
+        """
+        for row, kilometers in self.tables.indexes[dl_type].nearest_k(
+                latitude, longitude, k):
+            yield (dict(row), kilometers)
+
+    def within_radius(self, dl_type, latitude, longitude, kilometers):
+        """
+        Every row of one table within the radius (km), nearest first.
+        Yields (row dict, distance in km). Lazy, like nearest_k().
+        """
+        for row, distance in self.tables.indexes[dl_type].within_radius(
+                latitude, longitude, kilometers):
+            yield (dict(row), distance)
+
+    def resolve_all(self, latitude, longitude):
+        """ All three answers, in the same dict format run() prints """
+        output = {}
+        output['Radar']       = self.nearest_radar(latitude, longitude)
+        output['Observation'] = self.nearest_metar(latitude, longitude)
+        output['Zone']        = self.nearest_zone(latitude, longitude)
+        return output
+
+    def resolve_many(self, latitudes, longitudes, chunk_size=None):
+        """ Batch version of resolve_all(). See resolve_many() """
+        indexes = self.tables.indexes
+        return resolve_many(latitudes, longitudes, indexes['radar'],
+                            indexes['metar'], indexes['zone'], chunk_size)
+
+
+class DatabaseLocator(object):
+    """
+    Resolver that answers from the SQLite database, for callers that
+    should not load whole tables into memory.
+    Each query reads only the rows inside a bounding box around the
+    point (see weather_sqlite.Database.nearest)
+    """
+    def __init__(self, database=None):
+        """ Open the database. Downloaded with load_database() if None """
+        if database is None:
+            database = load_database()
+        self.database = database
+
+    def nearest(self, dl_type, latitude, longitude):
+        """ Closest row of one table ('radar', 'metar', or 'zone') """
+        return self.database.nearest(dl_type, latitude, longitude)[0]
+
+    def nearest_radar(self, latitude, longitude):
+        """ Closest radar station, as a dict """
+        return self.nearest('radar', latitude, longitude)
+
+    def nearest_metar(self, latitude, longitude):
+        """ Closest METAR observation station, as a dict """
+        return self.nearest('metar', latitude, longitude)
 
+    def nearest_zone(self, latitude, longitude):
+        """ Closest forecast zone (by centroid), as a dict """
+        return self.nearest('zone', latitude, longitude)
 
-def run():
+    def resolve_all(self, latitude, longitude):
+        """ All three answers, in the same dict format run() prints """
+        output = {}
+        output['Radar']       = self.nearest_radar(latitude, longitude)
+        output['Observation'] = self.nearest_metar(latitude, longitude)
+        output['Zone']        = self.nearest_zone(latitude, longitude)
+        return output
+
+
+def _reload(locator, generation):
+    """
+    A new locator, with fresh downloads of every table the locator has:
+    the three snapshots, and the raster, polygons, and join tables, if it
+    has them. They are all from one download, so they agree with each
+    other, and are swapped in together (see WeatherLocator.swap).
+    Raises the errors of a failed download (see _errors), also when the
+    locator has a raster, polygons, or join table that is not available
+    any more: then the locator keeps its tables.
+    """
+    def required(name, table):
+        """ A downloaded table, which must not be missing """
+        if table is None:
+            raise OSError("The {} table is not available".format(name))
+        return table
+
+    raster   = None
+    polygons = None
+    if locator.raster is not None:
+        raster = required('raster', load_raster())
+    if locator.polygons is not None:
+        polygons = required('polygons', load_polygons())
+    return WeatherLocator(
+        radars=download_snapshot('radar'),
+        metars=download_snapshot('metar'),
+        zones=download_snapshot('zone'),
+        raster=raster,
+        polygons=polygons,
+        joins=dict((dl_type, required(JOINS[dl_type], load_join(dl_type)))
+                   for dl_type in locator.joins),
+        generation=generation)
+
+
+def refresh(locator):
+    """
+    Download fresh copies of all of a running locator's tables, and swap
+    them in at once (see _reload). On any download error, the locator
+    keeps its data.
+    Output is True if the locator was refreshed.
+    """
+    try:
+        fresh = _reload(locator, locator.generation)
+    except _errors():
+        return False
+    locator.swap(fresh)
+    return True
+
+
+def load_generation():
+    """
+    The generation number of the published tables (see
+    nws_database_creator.publish_generation), or None if not available
+    """
+    try:
+        resp, content = _http().request(URL + GEN_FILE, "GET")
+        if resp.status != 200:
+            return None
+        return int(json.loads(content.decode('utf-8'))['generation'])
+    except _errors(KeyError, TypeError):
+        return None
+
+
+def reload_generation(locator):
+    """
+    If a newer generation than the locator's is published, load all of
+    its tables to the side, while the locator goes on answering from the
+    current ones, then swap them in (see _reload).
+    Output is True if the locator was swapped.
+    """
+    generation = load_generation()
+    if generation is None or (locator.generation is not None
+                              and generation <= locator.generation):
+        return False
+    try:
+        fresh = _reload(locator, generation)
+    except _errors():
+        return False
+    locator.swap(fresh)
+    weather_metrics.METRICS.gauge('locator_generation', generation)
+    return True
+
+
+def watch(locator, interval=WATCH, stop=None):
+    """
+    Check for a new published generation every interval seconds, and swap
+    it into the locator (see reload_generation), in a daemon thread:
+    locator.watcher. Set the stop threading.Event to end it.
+    """
+    stop = stop or threading.Event()
+
+    def poll():
+        """ Check, then wait, until stopped """
+        while not stop.wait(interval):
+            reload_generation(locator)
+
+    locator.watcher = threading.Thread(target=poll, daemon=True)
+    locator.watcher.start()
+    return locator.watcher
+
+
+def _refresh_local(locator):
+    """
+    Refresh an offline locator (see refresh). If the snapshots are not
+    published, load the tables from the bundle or the CSVs instead (see
+    load_all).
+    Output is True if the locator was refreshed.
+    """
+    if refresh(locator):
+        return True
+    try:
+        tables = load_all()
+    except _errors():
+        return False
+    locator.swap(WeatherLocator(radars=tables['radar'],
+                                metars=tables['metar'],
+                                zones=tables['zone'],
+                                generation=locator.generation))
+    return True
+
+
+def offline_locator(max_age=MAX_AGE, background=True):
+    """
+    Offline-first startup: a WeatherLocator built from local snapshots
+    (see load_local), with no network round trip and no httplib2 import.
+    If a snapshot is older than max_age seconds, all three are refreshed
+    in a background thread (locator.refresher), and swapped in when done
+    (see _refresh_local).
+    Tables with no local snapshot at all are downloaded first, together
+    (see load_all), and count as stale: the refresh saves their snapshots
+    for the next start.
+    """
+    tables  = {}
+    missing = []
+    stale   = False
+    for dl_type in TABLES:
+        try:
+            tables[dl_type], age = load_local(dl_type)
+        except (OSError, ValueError):
+            missing.append(dl_type)
+            continue
+        stale = stale or age > max_age
+    if missing:
+        tables.update(load_all(missing))
+        stale = True
+
+    locator = WeatherLocator(radars=tables['radar'], metars=tables['metar'],
+                             zones=tables['zone'])
+    locator.refresher = None
+    if stale:
+        locator.refresher = threading.Thread(target=_refresh_local,
+                                             args=(locator,), daemon=True)
+        if background:
+            locator.refresher.start()
+        else:
+            locator.refresher.run()
+    return locator
+
+
+def run(argv=None):
     """ Example application """
-    output  = {}
+    parser = argparse.ArgumentParser(description="Nearest weather radar, "
+                                     "observation station, and zone")
+    parser.add_argument('--offline', action='store_true',
+                        help="Answer from local snapshots first")
+    parser.add_argument('--max-age', type=float, default=MAX_AGE,
+                        help="Offline: refresh snapshots older than this "
+                             "(seconds)")
+    args = parser.parse_args(argv)
 
-    radars                = download('radar')
-    metars                = download('metar')
-    zones                 = download('zone')
-    output['Radar']       = best(radars)
-    output['Observation'] = best(metars)
-    output['Zone']        = best(zones)
+    if args.offline:
+        locator = offline_locator(args.max_age)
+    else:
+        locator = WeatherLocator(raster=load_raster(),
+                                 polygons=load_polygons())
+    output  = locator.resolve_all(LATITUDE, LONGITUDE)
 
     print(output)
+    if args.offline and locator.refresher is not None:
+        locator.refresher.join()    # Leave the refreshed cache for next time
 
 if __name__ == "__main__":
     run()
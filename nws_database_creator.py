@@ -42,14 +42,31 @@ This software is freely redistributable under the terms of the GPLv3 license.
 
 # Python Standard Library (Debian package libpython3.*-minimal)
 import os
+import struct
 
 # Python Standard Library (Debian package libpython3.*-stdlib)
+import collections
+import argparse
+import concurrent.futures
 import csv
 import datetime
-#import dbm.gnu
+import functools
+import json
+import math
+import time
+from array import array
 
-# Other Python packages
-import httplib2      # (Debian package python3-httplib2)
+# Other modules of this project
+import weather_bundle
+import weather_delta
+import weather_http
+import weather_index
+import weather_metrics
+import weather_polygons
+import weather_raster
+import weather_snapshot
+import weather_sqlite
+import weather_table
 
 
 
@@ -64,253 +81,192 @@ SOURCE = { 'Radar' : 'http://www.ncdc.noaa.gov/homr/file/nexrad-stations.txt',
            'Zones' : 'http://www.nws.noaa.gov/geodata/catalog/wsom/' +
                      'html/cntyzone.htm'
          }
+# Zone boundaries: a local GeoJSON export of the NWS zone shapefile
+POLYGONS = os.path.expanduser('~') + '/uploads/zone_polygons.geojson'
+JOIN_METARS = 3     # Nearest METAR stations per row of the join tables
+GENERATION  = 'generation.json'     # Generation counter, written last
+SOURCES     = ('radar', 'metar', 'zone')
+# Watch mode: seconds between conditional GETs of each source
+SCHEDULE    = {'radar' : 24 * 60 * 60,
+               'metar' :  6 * 60 * 60,
+               'zone'  : 24 * 60 * 60}
+RETRY       = 5 * 60        # Watch mode: seconds before a failed source
+                            # is polled again (or its schedule, if sooner)
 
 
 
-class Radar(dict):
+class Radar(weather_table.StationTable):
     """
     Download, process, and save radar station data
     - Download the radar station table
-    - Parse the radar station table into a dict
-    - Output the dict into a csv file
-    - (optional) Output the dict into a dbm file
+    - Parse the radar station table into a columnar table
+    - Output the table into a csv file
+    - (optional) Output the table into the SQLite database (see database)
     """
-    def __init__(self):
-        """ Create the dict, download and unzip the data """
-        super(Radar, self).__init__()
+    # Add URL field, if desired
+    # Add Elevation field, if desired
+    FIELDS = ['Name', 'Location',  'Latitude', 'Longitude' ]
+    KEY    = 'Name'
+
+    def __init__(self, download=True):
+        """ Create the table, download and unzip the data """
+        super(Radar, self).__init__(self.KEY, ['Name', 'Location'],
+                                    ['Latitude', 'Longitude'])
         self.content = ""
         self.status  = 0
-        self.download_nws()
+        if download:
+            self.download_nws()
 
     def download_nws(self):
         """ Download from the NWS, and unzip the kml file """
-        get                = httplib2.Http(CACHE)
+        get                = weather_http.session(CACHE)
         resp, content      = get.request(SOURCE['Radar'], "GET")
         self.status        = resp['status']
-        self.content       = content.decode('utf-8')
+        self.content       = content        # Bytes, decoded while parsing
 
     def parse_nws(self):
         """
-        Parse the NWS radar station file
-        First, parse the header to determine field widths and column name
-        Then parse the body into a dict
+        Parse the NWS radar station file into the table (see radar_columns)
+        The typed columns are added as they are, without a dict per station.
         """
-        stations = self.content.split('\r\n')[:-1]
-
-        column_metadata = []
-        line1 = stations[0]                  # COLUMN NAMES
-        line2 = stations[1]                  # ------ -----
-        for col in range(0, len(line1), 1):
-            if col == 0:
-                start = 0
-            elif line2[col] == '-':
-                continue
-            else:  # line2[col] == ' '
-                name = line1[start:col].strip()
-                column_metadata.append((name, start, col)) # Append a tuple
-                start = col                                # Reset start
+        self.extend(radar_columns(self.content))
 
-        for one_radar_line in stations[2:]:   # Lines 0 and 1 are header
-            if one_radar_line == '':          # Blank CR/LF at EOF
-                continue
-            one_radar = {}
-            for field in column_metadata:
-                col_name            = field[0]
-                col_start           = field[1]
-                col_end             = field[2]
-                field_data          = one_radar_line[col_start:col_end].strip()
-                one_radar[col_name] = field_data
-
-            name                    = one_radar['ICAO']
-            self[name]              = {}
-            self[name]['Name']      = name
-            if len(one_radar['ST']) > 0:
-                self[name]['Location'] = (one_radar['NAME'] + ' ' +
-                                         one_radar['ST'])
-            else:
-                self[name]['Location'] = (one_radar['NAME'] + ' ' +
-                                         one_radar['COUNTRY'])
-            self[name]['Latitude']  = one_radar['LAT']
-            self[name]['Longitude'] = one_radar['LON']
-            self[name]['Elevation'] = one_radar['ELEV']
-            self[name]['URL']       = \
-                'http://www.ncdc.noaa.gov/nexradinv/chooseday.jsp?id=' + name
+    def csv(self):
+        """
+        Output the table as a CSV, with its hash and delta (see publish)
+        Output is True if the table changed, and was written.
+        """
+        return publish('radar', self.KEY, self.FIELDS, self)
 
-            # URL can be generated, too. Merely add the name to the id:
-            # http://www.ncdc.noaa.gov/nexradinv/chooseday.jsp?id=PAEC
+    def snapshot(self):
+        """ Output the table as a binary snapshot (see weather_snapshot) """
+        rows = sorted(self.keys())
+        weather_snapshot.write(DIR + '/radar.bin', self.FIELDS,
+                               [self[row] for row in rows])
 
-    def csv(self):
-        """ Output the dict as a CSV """
-        with open(DIR + '/radar.csv', 'w') as csvfile:
-            # Add URL field, if desired
-            # Add Elevation field, if desired
-            fieldnames = ['Name', 'Location',  'Latitude', 'Longitude' ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames,
-                                    extrasaction='ignore')
-            writer.writeheader()
-            rows = list(self.keys())
-            rows.sort()
-            for row in rows:
-                writer.writerow(self[row])
-
-    #def dbm(self):
-    #    """ Output the dict as a DBM lookup table (faster than CSV) """
-    #    dbf  = dbm.gnu.open(DIR + '/dbm/radar.dbm','n')
-    #    rows = list(self.keys())
-    #    rows.sort()
-    #    for row in rows:
-    #        # Add URL field, if desired
-    #        # Add Elevation field, if desired
-    #        dbf[row] = ','.join([str(self[row]['Location']),
-    #                                str(self[row]['Latitude']),
-    #                                str(self[row]['Longitude'])
-    #                                #str(self[row]['Elevation']),
-    #                                #str(self[row]['URL']),
-    #                          ])
-    #    dbf.close()
-
-
-
-
-class Metar(dict):
+
+
+
+class Metar(weather_table.StationTable):
     """
     Download, process, and save METAR observation station data
     - Download the station list
-    - Parse the station list into a dict
-    - Output the dict into a csv file
-    - (optional) Output the dict into a dbm file
-    """
-    def __init__(self):
-        """ Create the dict, download and unzip the data """
-        super(Metar, self).__init__()
-        self.stations  = []         # Simple list of downloadable stations
-        self.list_of_stations()     # Populate the list. Data check
+    - Parse the station list into a columnar table
+    - Output the table into a csv file
+    - (optional) Output the table into the SQLite database (see database)
+    """
+    # Add other fields, if desired
+    FIELDS = ['Name', 'Location',  'Latitude', 'Longitude' ]
+    KEY    = 'Name'
+
+    def __init__(self, download=True):
+        """ Create the table, download and unzip the data """
+        super(Metar, self).__init__(self.KEY, ['Name', 'Location'],
+                                    ['Latitude', 'Longitude'])
+        self.stations  = set()      # Set of downloadable station codes
         self.status    = 0
-        self.locations = ''
-        self.download_nws()
+        self.locations = b''
+        if download:
+            self.list_of_stations() # Populate the list. Data check
+            self.download_nws()
 
     def list_of_stations(self):
         """
         Create a simple list of observation station codes
         not associated with any location. A data check.
         """
-        get     = httplib2.Http(CACHE)
+        get     = weather_http.session(CACHE)
         content = get.request(SOURCE['Metar']['Stations'], "GET")[1]
         html    = content.decode('utf-8').split('\n')
         for line in html:
             if '<img src="/icons/text.gif" alt="[TXT]">' in line:
-                self.stations.append(line.split('"')[5][0:4])
+                self.stations.add(line.split('"')[5][0:4])
 
     def download_nws(self):
         """ Download worldwide METARs from the NWS """
-        get             = httplib2.Http(CACHE)
+        get             = weather_http.session(CACHE)
         resp, content   = get.request(SOURCE['Metar']['Locations'], "GET")
         self.status     = resp['status']
-        self.locations  = content.decode('utf-8')
+        self.locations  = content           # Bytes, decoded while parsing
 
     def parse(self):
         """
-        Parse the NWS METAR file
-        Fields are defined at http://weather.noaa.gov/tg/site.shtml
+        Parse the NWS METAR file into the table (see iter_metar)
+        Only stations in the list of downloadable stations are kept.
+        The stations are collected into columns, then added at once.
         """
-        stations = self.locations.split('\n')[:-1]
-        for station in stations:
-            sta_line = station.split(';')
-            icao = sta_line[0] 
-            if icao.upper() not in self.stations:
-                continue
-
-            self[icao]                 = {}    
-            self[icao]['Name']         = icao
-            del sta_line[0]
-                
-            #self[icao]['Block_Num']    = sta_line[0].strip()
-            del sta_line[0]
-
-            #self[icao]['Station_Num']  = sta_line[0].strip()
-            del sta_line[0]
-
-            self[icao]['Location']     = sta_line[0].strip()
-            del sta_line[0]
-
-            if len(sta_line[0]) in [0, 2, 24]:
-                #self[icao]['State']    = sta_line[0].strip()
-                del sta_line[0]
-
-            #self[icao]['Country']      = sta_line[0].strip()
-            del sta_line[0]
+        columns = {'Name'      : [],
+                   'Location'  : [],
+                   'Latitude'  : [],
+                   'Longitude' : []}
+        for station in iter_metar(self.locations, self.stations):
+            columns['Name'].append(station.name)
+            columns['Location'].append(station.location)
+            columns['Latitude'].append(station.latitude)
+            columns['Longitude'].append(station.longitude)
+        self.extend(columns)
 
-            #self[icao]['WMO_Region']   = sta_line[0].strip()
-            del sta_line[0]
 
-            self[icao]['Latitude']     = dms_to_dec(sta_line[0].strip())
-            del sta_line[0]
+    def csv(self):
+        """
+        Output the table as a CSV, with its hash and delta (see publish)
+        Output is True if the table changed, and was written.
+        """
+        return publish('metar', self.KEY, self.FIELDS, self)
 
-            self[icao]['Longitude']    = dms_to_dec(sta_line[0].strip())
-            del sta_line[0]
+    def snapshot(self):
+        """ Output the table as a binary snapshot (see weather_snapshot) """
+        rows = sorted(self.keys())
+        weather_snapshot.write(DIR + '/metar.bin', self.FIELDS,
+                               [self[row] for row in rows])
 
-            #self[icao]['Upper_Lat']     = station.split(';')[9].strip()
-            #self[icao]['Upper_Lon']     = station.split(';')[10].strip()
-            #self[icao]['Elevation']     = station.split(';')[11].strip()
-            #self[icao]['Upper_Elev']    = station.split(';')[12].strip()
-            #self[icao]['RSBN']          = station.split(';')[13].strip()
 
 
-    def csv(self):
-        """ Output the dict as a CSV """
-        with open(DIR + '/metar.csv', 'w') as csvfile:
-            # Add other fields, if desired
-            fieldnames = ['Name', 'Location',  'Latitude', 'Longitude' ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames,
-                                    extrasaction='ignore')
-            writer.writeheader()
-            rows = list(self.keys())
-            rows.sort()
-            for row in rows:
-                writer.writerow(self[row])
-
-    #def dbm(self):
-    #    """ Output the dict as a DBM lookup table (faster than CSV) """
-    #    dbf = dbm.gnu.open(DIR + '/dbm/metar.dbm','n')
-    #    rows = list(self.keys())
-    #    rows.sort()
-    #    for row in rows:
-    #        # Add other fields, if desired
-    #        dbf[row] = ','.join([str(self[row]['Location']),
-    #                                str(self[row]['Latitude']),
-    #                                str(self[row]['Longitude'])
-    #                          ])
-    #    dbf.close()
-
-
-
-class Zones(dict):
+class Zones(weather_table.StationTable):
     """
     Download, process, and save forecast zones
     - Download the zone list
-    - Parse the zone list into a dict
-    - Output the dict into a csv file
-    - (optional) Output the dict into a dbm file
+    - Parse the zone list into a columnar table
+    - Output the table into a csv file
+    - (optional) Output the table into the SQLite database (see database)
     """
-    def __init__(self):
-        """ Create the dict, download and unzip the data """
-        super(Zones, self).__init__()
+    # Add other fields, if desired
+    FIELDS = ['Zone', 'Zone_Name', 'County', 'Latitude', 'Longitude' ]
+    KEY    = 'Zone'
+
+    def __init__(self, download=True):
+        """ Create the table, download and unzip the data """
+        super(Zones, self).__init__(self.KEY, ['Zone', 'Zone_Name', 'County'],
+                                    ['Latitude', 'Longitude'])
         self.status  = 0
+        self.index_status  = 0
         self.data_status   = 0
         self.data_url      = ''
-        self.content       = ''
+        self.content       = b''
+        if download:
+            self.download_index()
+
+    def download_index(self):
+        """ Download the index web page that lists the zone files """
         self.download(SOURCE['Zones'])
         self.index_status = self.status
         self.status = 0
 
+    def download_data(self):
+        """ Pick the current zone file from the index, and download it """
+        self.parse_nws_index()
+        self.download(self.data_url)
+        self.data_status = self.status
+        self.status = 0
+
     def download(self, url):
         """
         Download the index web page to determine the zone file URL
         """
-        get               = httplib2.Http(CACHE)
+        get               = weather_http.session(CACHE)
         resp, content     = get.request(url, "GET")
         self.status       = resp['status']
-        self.content      = content.decode('utf-8')
+        self.content      = content         # Bytes, decoded while parsing
 
 
     def parse_nws_index(self):
@@ -321,7 +277,7 @@ class Zones(dict):
         Figure out which file is the most recent (but not future)
         """
         possible_files = []
-        lines = self.content.lower().split('tr>')
+        lines = self.content.decode('utf-8').lower().split('tr>')
         for line in lines:
             if "download text file bp" in line:
                 date_str = line.split('</td>')[0].split('<td>')[1].strip()
@@ -349,142 +305,920 @@ class Zones(dict):
 
 
     def parse_nws_zones(self):
-        """ Parse the zones fileinto a dict """
-        lines = self.content.split('\r\n')[0:-1]
-        for line in lines:
-            zone          = line.split('|')[4]
-            if len(zone) < 5:
-                continue
-            self[zone]    = {}
-            #self[zone]['State_Code']    = line.split('|')[0]
-            #self[zone]['Forecast_Zone'] = line.split('|')[1]
-            #self[zone]['Warning_Area']  = line.split('|')[2]
-            self[zone]['Zone_Name']     = line.split('|')[3]
-            self[zone]['Zone']          = line.split('|')[4]
-            self[zone]['County']        = line.split('|')[5]
-            #self[zone]['Fips_Code']     = line.split('|')[6]
-            #self[zone]['Time_Zone']     = line.split('|')[7]
-            #self[zone]['Within_Cnty']   = line.split('|')[8]
-            self[zone]['Latitude']      = line.split('|')[9]
-            self[zone]['Longitude']     = line.split('|')[10]
+        """
+        Parse the zones file into the table (see iter_zones)
+        The zones are collected into columns, then added at once.
+        """
+        columns = {'Zone'      : [],
+                   'Zone_Name' : [],
+                   'County'    : [],
+                   'Latitude'  : [],
+                   'Longitude' : []}
+        for zone in iter_zones(self.content):
+            columns['Zone'].append(zone.zone)
+            columns['Zone_Name'].append(zone.zone_name)
+            columns['County'].append(zone.county)
+            columns['Latitude'].append(zone.latitude)
+            columns['Longitude'].append(zone.longitude)
+        self.extend(columns)
 
     def csv(self):
-        """ Output the dict as a CSV """
-        with open(DIR + '/zone.csv', 'w') as csvfile:
-            # Add other fields, if desired
-            fieldnames = ['Zone', 'Zone_Name', 'County',
-                          'Latitude', 'Longitude' ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames,
-                                    extrasaction='ignore')
-            writer.writeheader()
-            rows = list(self.keys())
-            rows.sort()
-            for row in rows:
-                writer.writerow(self[row])
-
-    #def dbm(self):
-    #    """ Output the dict as a DBM lookup table (faster than CSV) """
-    #    dbf = dbm.gnu.open(DIR + '/dbm/zone.dbm','n')
-    #    rows = list(self.keys())
-    #    rows.sort()
-    #    for row in rows:
-    #        # Add other fields, if desired
-    #        dbf[row] = ','.join([str(self[row]['Zone']),
-    #                                str(self[row]['Zone_Name']),
-    #                                str(self[row]['County']),
-    #                                str(self[row]['Latitude']),
-    #                                str(self[row]['Longitude'])
-    #                          ])
-    #    dbf.close()
+        """
+        Output the table as a CSV, with its hash and delta (see publish)
+        Output is True if the table changed, and was written.
+        """
+        return publish('zone', self.KEY, self.FIELDS, self)
+
+    def snapshot(self):
+        """ Output the table as a binary snapshot (see weather_snapshot) """
+        rows = sorted(self.keys())
+        weather_snapshot.write(DIR + '/zone.bin', self.FIELDS,
+                               [self[row] for row in rows])
+
+
+# Streaming parsers
+# Each takes the raw bytes of a source, a binary file, or any iterable of
+# byte chunks, and reads it one chunk at a time, so memory use stays flat
+# as the sources grow. The METAR and zone parsers decode one line at a
+# time. The radar station file is fixed-width, so each chunk of whole
+# lines is unpacked into typed columns at once (see iter_radar_blocks).
+
+RadarRecord = collections.namedtuple('RadarRecord',
+                                     'name location latitude longitude')
+MetarRecord = collections.namedtuple('MetarRecord',
+                                     'name location latitude longitude')
+ZoneRecord  = collections.namedtuple('ZoneRecord',
+                                     'zone zone_name county latitude '
+                                     'longitude')
+
+CHUNK      = 65536   # Bytes per read from a binary file
+BATCH      = 4096    # METAR lines per coordinate conversion
+NUMPY_ROWS = 64      # dms_column uses numpy (if installed) from this many
+
+# The only columns of the radar station file that are used
+RADAR_COLUMNS = ('ICAO', 'NAME', 'COUNTRY', 'ST', 'LAT', 'LON')
+
+
+def iter_byte_blocks(stream):
+    """
+    Yield a byte stream as blocks of whole lines (bytes). Every block ends
+    with b'\\n', except the last one if the stream does not.
+    Input: bytes, a binary file, or an iterable of byte chunks
+    (bytes, bytearray, or memoryview)
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        # In CHUNK pieces too: small blocks stay in the CPU cache
+        whole  = memoryview(stream)
+        stream = (whole[start:start + CHUNK]
+                  for start in range(0, len(whole), CHUNK))
+    elif hasattr(stream, 'read'):
+        stream = iter(functools.partial(stream.read, CHUNK), b'')
+
+    pending = b''
+    for chunk in stream:
+        data = pending + bytes(chunk) if pending else bytes(chunk)
+        end  = data.rfind(b'\n') + 1
+        if end == len(data):
+            yield data
+        elif end:
+            yield data[:end]
+        pending = data[end:]
+    if pending:
+        yield pending
+
+
+def iter_byte_lines(stream):
+    """
+    Yield the lines of a byte stream as bytes, without CR/LF.
+    Input: bytes, a binary file, or an iterable of byte chunks
+    (bytes, bytearray, or memoryview)
+    """
+    for block in iter_byte_blocks(stream):
+        lines = block.split(b'\n')
+        last  = lines.pop().rstrip(b'\r')     # Only the final block has one
+        for line in lines:
+            yield line.rstrip(b'\r')
+        if last:
+            yield last
+
+
+def iter_lines(stream, encoding='utf-8'):
+    """
+    Yield the lines of a byte stream as strings, without CR/LF.
+    Input: bytes, a binary file, or an iterable of byte chunks
+    """
+    for line in iter_byte_lines(stream):
+        yield line.decode(encoding)
+
+
+def radar_layout(line1, line2):
+    """
+    Compile the header of the NWS radar station file into a struct.Struct
+    Input: the column names line, and the ------ ----- line (as bytes)
+    Output: a tuple of (struct, columns). The struct unpacks just the
+            RADAR_COLUMNS of one line, as bytes, in file order. Columns
+            lists those, in the same order, as (name, start, end) tuples.
+    Column widths are found from the dashes: each column starts at the
+    space before its dashes.
+    """
+    columns = []
+    for col in range(0, min(len(line1), len(line2)), 1):
+        if col == 0:
+            start = 0
+        elif line2[col:col + 1] == b'-':
+            continue
+        else:  # line2[col] == ' '
+            name = line1[start:col].strip().decode('utf-8')
+            columns.append((name, start, col))
+            start = col
+
+    wanted  = [column for column in columns if column[0] in RADAR_COLUMNS]
+    missing = set(RADAR_COLUMNS) - set(column[0] for column in wanted)
+    if missing:
+        raise ValueError("Radar station file lacks columns: {}"
+                         .format(', '.join(sorted(missing))))
+
+    fmt      = ''
+    position = 0
+    for name, start, end in wanted:
+        if start > position:
+            fmt = fmt + '{}x'.format(start - position)
+        fmt      = fmt + '{}s'.format(end - start)
+        position = end
+    return (struct.Struct(fmt), wanted)
+
+
+def iter_radar_blocks(stream):
+    """
+    Parse the NWS radar station file, one block of stations at a time
+    The header is compiled once by radar_layout(). Then each block of
+    whole lines (see iter_byte_blocks) is unpacked, and only the needed
+    fields are decoded.
+    Yields dicts of columns: Name and Location (lists of str), Latitude
+    and Longitude (array('d'), NaN when blank)
+    """
+    blocks = iter_byte_blocks(stream)
+    header = b''
+    for block in blocks:
+        header = header + block
+        first  = header.find(b'\n')
+        if first >= 0 and header.find(b'\n', first + 1) >= 0:
+            break
+    first  = header.find(b'\n')
+    second = header.find(b'\n', first + 1)
+    if first < 0 or second < 0:
+        return
+    layout, columns = radar_layout(header[:first].rstrip(b'\r'),
+                                   header[first + 1:second].rstrip(b'\r'))
+
+    body = header[second + 1:]
+    if body.strip():
+        yield _radar_block(body, layout, columns)
+    for block in blocks:
+        if block.strip():
+            yield _radar_block(block, layout, columns)
+
+
+def _radar_block(body, layout, columns):
+    """
+    Unpack one block of whole lines of the radar station file into typed
+    columns (see iter_radar_blocks)
+
+    If the lines are all one width, each needed field is cut from the
+    whole block at once (see _fixed_field), and split and converted in
+    bulk, without a Python loop per line. Blocks with ragged lines are
+    unpacked one line at a time.
+    """
+    spans  = dict((name, (start, end)) for name, start, end in columns)
+    width  = body.find(b'\n') + 1
+    ending = b'\r\n' if body[width - 2:width] == b'\r\n' else b'\n'
+    body   = body.rstrip(b'\r\n') + ending     # No blank lines at EOF
+    count  = len(body) // max(width, 1)
+    if width >= layout.size + len(ending) and len(body) % width == 0 \
+    and all(body[width - len(ending) + offset::width] ==
+            ending[offset:offset + 1] * count
+            for offset in range(len(ending))):
+        return _fixed_columns(body, width, count, spans)
+
+    # Ragged lines
+    order  = [[column[0] for column in columns].index(name)
+              for name in RADAR_COLUMNS]
+    fields = [[] for name in RADAR_COLUMNS]
+    for one_radar_line in body.split(b'\n'):
+        one_radar_line = one_radar_line.rstrip(b'\r')
+        if one_radar_line == b'':
+            continue
+        one_radar = layout.unpack_from(one_radar_line.ljust(layout.size))
+        for column, values in zip(order, fields):
+            values.append(one_radar[column])
+    return _radar_columns(fields)
+
+
+def _fixed_field(body, width, count, start, end):
+    """
+    One field (bytes[start:end]) of every line of a fixed-width body, as
+    one bytes: each line's field, then b'\n'. Each byte offset of the
+    field is copied for every line at once, by a slice with a step.
+    """
+    size   = end - start
+    column = bytearray(b'\n') * ((size + 1) * count)
+    for offset in range(size):
+        column[offset::size + 1] = body[start + offset::width]
+    return bytes(column)
+
+
+def _fixed_columns(body, width, count, spans):
+    """
+    Typed columns of a fixed-width block (see _radar_block)
+    float() skips the padding of the number fields by itself. The IDs are
+    split on whitespace in one call, when that leaves one per line.
+    """
+    def field(name):
+        """ The field of every line, as one bytes (see _fixed_field) """
+        return _fixed_field(body, width, count, *spans[name])
+
+    def lines(name):
+        """ The field of every line, stripped """
+        return list(map(bytes.strip, field(name).split(b'\n')[:count]))
+
+    ids   = field('ICAO')
+    names = ids.split()
+    if len(names) != count or \
+    ids.replace(b' ', b'') != b'\n'.join(names) + b'\n':
+        names = lines('ICAO')           # Blank IDs, or IDs with spaces
+
+    # The state, or the country where there is none
+    places = lines('ST')
+    start, end = spans['COUNTRY']
+    for position, place in enumerate(places):
+        if not place:
+            places[position] = body[position * width + start:
+                                    position * width + end].strip()
+    location = list(map(b' '.join, zip(lines('NAME'), places)))
+    return {'Name'      : _decode(names),
+            'Location'  : _decode(location),
+            'Latitude'  : _float_column(field('LAT').split(b'\n')[:count]),
+            'Longitude' : _float_column(field('LON').split(b'\n')[:count])}
+
+
+def _decode(fields):
+    """ utf-8 fields (bytes, without b'\n') to a list of str, at once """
+    text = b'\n'.join(fields)
+    return text.decode('utf-8').split('\n') if fields else []
+
+
+def _radar_columns(fields):
+    """ Decode the raw RADAR_COLUMNS fields (bytes) into typed columns """
+    icao, name, country, state, lat, lon = fields
+    names    = [field.strip().decode('utf-8') for field in icao]
+    location = [(one_name.strip() + b' ' + (st.strip() or ctry.strip()))
+                .decode('utf-8')
+                for one_name, st, ctry in zip(name, state, country)]
+    return {'Name'      : names,
+            'Location'  : location,
+            'Latitude'  : _float_column(lat),
+            'Longitude' : _float_column(lon)}
+
+
+def _float_column(fields):
+    """ Fixed-width bytes fields to array('d'). Blank or bad become NaN """
+    try:
+        return array('d', map(float, fields))
+    except ValueError:
+        return array('d', [weather_index.coordinate(field, math.nan)
+                           for field in fields])
+
+
+def radar_columns(stream):
+    """
+    Parse the whole NWS radar station file into typed columns: the blocks
+    of iter_radar_blocks(), end to end
+    Input: bytes, a binary file, or an iterable of byte chunks
+    Output is a dict of columns: Name and Location (lists of str),
+    Latitude and Longitude (array('d'), NaN when blank)
+    """
+    columns = {'Name'      : [],
+               'Location'  : [],
+               'Latitude'  : array('d'),
+               'Longitude' : array('d')}
+    for block in iter_radar_blocks(stream):
+        for field, values in block.items():
+            columns[field].extend(values)
+    return columns
+
+
+def iter_radar(stream):
+    """
+    Parse the NWS radar station file, one RadarRecord per station
+    (see iter_radar_blocks). Blank numbers are None.
+    """
+    for block in iter_radar_blocks(stream):
+        for name, location, lat, lon in zip(block['Name'], block['Location'],
+                                            block['Latitude'],
+                                            block['Longitude']):
+            yield RadarRecord(name, location,
+                              None if math.isnan(lat) else lat,
+                              None if math.isnan(lon) else lon)
 
 
+def iter_metar(stream, stations=None):
+    """
+    Parse the NWS METAR file, one MetarRecord per station
+    Fields are defined at http://weather.noaa.gov/tg/site.shtml
+    Input: the stream, and (optional) a set of downloadable station codes.
+           Stations not in the set are skipped.
+    Lines are read in batches of BATCH, so the coordinates of each batch
+    are converted together by dms_column().
+    """
+    batch = []
+    for station in iter_lines(stream):
+        sta_line = station.split(';')
+        if len(sta_line) < 8:
+            continue
+        icao = sta_line[0]
+        if stations is not None and icao.upper() not in stations:
+            continue
+
+        # Fields: ICAO, Block_Num, Station_Num, Location, (optional) State,
+        # Country, WMO_Region, Latitude, Longitude, Upper_Lat, Upper_Lon,
+        # Elevation, Upper_Elev, RSBN
+        lat_field = 6
+        if len(sta_line[4]) in [0, 2, 24]:      # State
+            lat_field = 7
+        if len(sta_line) < lat_field + 2:
+            continue
+        batch.append((icao, sta_line[3].strip(), sta_line[lat_field],
+                      sta_line[lat_field + 1]))
+        if len(batch) >= BATCH:
+            for record in _metar_batch(batch):
+                yield record
+            batch = []
+
+    for record in _metar_batch(batch):
+        yield record
+
+
+def _metar_batch(batch):
+    """ Convert the coordinate columns of a batch, and yield MetarRecords """
+    latitudes  = dms_column([station[2] for station in batch])
+    longitudes = dms_column([station[3] for station in batch])
+    for station, lat, lon in zip(batch, latitudes, longitudes):
+        yield MetarRecord(station[0], station[1],
+                          None if math.isnan(lat) else lat,
+                          None if math.isnan(lon) else lon)
+
+
+def iter_zones(stream):
+    """
+    Parse the NWS zones file, one ZoneRecord per zone
+    Fields: State_Code, Forecast_Zone, Warning_Area, Zone_Name, Zone,
+    County, Fips_Code, Time_Zone, Within_Cnty, Latitude, Longitude
+    """
+    for line in iter_lines(stream):
+        fields = line.split('|')
+        if len(fields) < 11 or len(fields[4]) < 5:
+            continue
+        yield ZoneRecord(fields[4], fields[3], fields[5],
+                         weather_index.coordinate(fields[9]),
+                         weather_index.coordinate(fields[10]))
+
+
+
+def dms_column(dms_strings, spacer='-'):
+    """
+    Convert a whole column of dd-mm-ssH text into decimal degrees
+    Input: an iterable of strings like '43-01-30N', '087-59W', or '12S'
+    Output: an array('d') of full-precision values. S and W are negative.
+            Values that cannot be parsed are NaN.
+    The text is split into degree, minute, second, and sign columns first,
+    then the columns are combined: with numpy array arithmetic, if it is
+    installed and there are at least NUMPY_ROWS values, else in one
+    Python pass. Both give the same values.
+    """
+    degrees = array('d')
+    minutes = array('d')
+    seconds = array('d')
+    signs   = array('d')
+    for dms_string in dms_strings:
+        dms_string = dms_string.strip()
+        hemisphere = dms_string[-1:].upper()
+        if hemisphere.isalpha():
+            dms_string = dms_string[:-1]
+        fields = dms_string.split(spacer)
+        try:
+            values = [float(field) for field in fields]
+        except ValueError:
+            values = []
+        if not 1 <= len(values) <= 3 or hemisphere not in 'NSEW0123456789.' \
+        or any(value < 0 for value in values):
+            values = [math.nan]
+        values = values + [0.0] * (3 - len(values))
+        degrees.append(values[0])
+        minutes.append(values[1])
+        seconds.append(values[2])
+        signs.append(-1.0 if hemisphere in ('S', 'W') else 1.0)
+
+    # Sum whole seconds first: one rounding step, instead of three
+    if len(signs) >= NUMPY_ROWS:
+        try:
+            numpy = weather_index.require_numpy()
+        except RuntimeError:
+            pass                # Not installed: combine in Python
+        else:
+            sign, deg, mins, secs = [numpy.frombuffer(column, numpy.float64)
+                                     for column in (signs, degrees, minutes,
+                                                    seconds)]
+            return array('d', (sign * (deg * 3600 + mins * 60 + secs)
+                               / 3600).tobytes())
+    return array('d', map(lambda sign, deg, mins, secs:
+                          sign * (deg * 3600 + mins * 60 + secs) / 3600,
+                          signs, degrees, minutes, seconds))
+
 
 def dms_to_dec(dms_string, spacer='-'):
-    """Simple conversion from dd-mm-ssW to -dd.xxx"""
-    dms = dms_string[:-1].split(spacer)
+    """
+    Simple conversion from dd-mm-ssW to -dd.xxx (see dms_column)
+    Output is the decimal degrees as a string, or '' if unparseable.
+
+    >>> [dms_to_dec(dms) for dms in ['43N', '43-30N', '43-30-36N']]
+    ['43.0', '43.5', '43.51']
+    >>> [dms_to_dec(dms) for dms in ['43S', '43-30S', '43-30-36S']]
+    ['-43.0', '-43.5', '-43.51']
+    >>> [dms_to_dec(dms) for dms in ['087E', '087-06E', '087-06-18E']]
+    ['87.0', '87.1', '87.105']
+    >>> [dms_to_dec(dms) for dms in ['087W', '087-06W', '087-06-18W']]
+    ['-87.0', '-87.1', '-87.105']
+    >>> [dms_to_dec(dms) for dms in ['00-00-36N', '00-03S', '000-00-01W']]
+    ['0.01', '-0.05', '-0.0002777777777777778']
+    >>> [dms_to_dec(dms) for dms in ['43-75N', ' 43-01N ', '43/01N']]
+    ['44.25', '43.016666666666666', '']
+    >>> dms_to_dec('43/01/30N', spacer='/')
+    '43.025'
+    >>> [dms_to_dec(dms) for dms in ['', 'N', '43-xx-00N', '1-2-3-4N']]
+    ['', '', '', '']
+    """
+    value = dms_column([dms_string], spacer)[0]
+    if math.isnan(value):
+        return ''
+    return repr(value)
 
-    # Degrees
-    degrees = int(dms[0])
 
-    # Minutes and Seconds
-    if len(dms) > 1:
-        minutes = float(dms[1])
-        minsec = minutes / 60
 
-    if len(dms) > 2:
-        seconds = float(dms[2])
-        minsec = minsec + (seconds / 3600)
+def write_text(path, text):
+    """
+    Write a text file. Any existing file is replaced at once, when the new
+    one is complete, so a reader never sees it half written.
+    """
+    with open(path + '.tmp', 'w', newline='') as textfile:
+        textfile.write(text)
+    os.replace(path + '.tmp', path)
 
-    # Truncating
-    minsec = str(minsec)[2:5]
 
-    # Change S and W to negative
-    if dms_string[-1:] in ['S', 'W']:
-        sign = '-'
-    else:
-        sign = ''
 
-    result = "{}{}.{}".format(sign, degrees, minsec)
-    return result
+def publish(name, key, fieldnames, table):
+    """
+    Write one table as DIR/<name>.csv, unless its content hash is unchanged.
+    Also write DIR/<name>.csv.sha256, and DIR/<name>.delta.json: the
+    record-level changes from the previous CSV (see weather_delta).
+    Output is True if the table changed.
+    """
+    rows     = [table[row] for row in sorted(table.keys())]
+    new_text = weather_delta.render(fieldnames, rows)
+    path     = DIR + '/' + name + '.csv'
+    old_text = None
+    if os.path.exists(path):
+        with open(path, 'r', newline='') as csvfile:
+            old_text = csvfile.read()
+        if weather_delta.digest(old_text) == weather_delta.digest(new_text):
+            return False
+
+    delta = weather_delta.diff(name, key, fieldnames, old_text, new_text)
+    write_text(DIR + '/' + name + '.delta.json',
+               json.dumps(delta, indent=1, sort_keys=True))
+    write_text(path, new_text)
+    write_text(path + '.sha256',
+               '{}  {}\n'.format(delta['hash'], name + '.csv'))
+    return True
+
+
+
+def publish_generation(outputs):
+    """
+    Count one more generation of the published files, in DIR/GENERATION:
+    {"generation": number, "time": unix time, "outputs": [changed files]}
+    It is written last, when every file of the generation is in place, so
+    a client that sees a new number can load them all.
+    Output is the new generation number.
+    """
+    path = DIR + '/' + GENERATION
+    try:
+        with open(path, 'r') as genfile:
+            generation = int(json.load(genfile)['generation'])
+    except (OSError, ValueError, KeyError, TypeError):
+        generation = 0
+    record = {'generation' : generation + 1,
+              'time'       : int(time.time()),
+              'outputs'    : sorted(outputs)}
+    write_text(path, json.dumps(record, sort_keys=True) + '\n')
+    return generation + 1
+
 
 
+def raster():
+    """
+    Precompute the nearest radar, METAR, and zone for every cell of the
+    weather_raster.BOUNDS grid, from the current CSV tables
+    """
+    tables = []
+    for name, key in (('radar', 'Name'), ('metar', 'Name'), ('zone', 'Zone')):
+        with open(DIR + '/' + name + '.csv', 'r') as csvfile:
+            index = weather_index.SphereIndex(csv.DictReader(csvfile))
+        tables.append((name, index, key))
+    weather_raster.build(DIR + '/raster.bin', tables)
+
 
-def run():
+
+def joins():
     """
-    Build the complete database. Overwrite any older database without checking
+    Precompute the most common follow-up query: for every zone, and every
+    METAR station, the nearest radar and the JOIN_METARS nearest (other)
+    METAR stations, with their distances in km.
+    Written as DIR/zone_join.csv and DIR/metar_join.csv (see publish), so
+    a client answers with one keyed lookup instead of more searches.
     """
-    print("Starting run...")
+    tables = {}
+    for name in ('radar', 'metar', 'zone'):
+        with open(DIR + '/' + name + '.csv', 'r') as csvfile:
+            tables[name] = list(csv.DictReader(csvfile))
+    radars = weather_index.SphereIndex(tables['radar'])
+    metars = weather_index.SphereIndex(tables['metar'])
+    fields = ['Radar', 'Radar_km']
+    for rank in range(1, JOIN_METARS + 1):
+        fields = fields + ['Metar_{}'.format(rank),
+                           'Metar_{}_km'.format(rank)]
+
+    for name, key in (('zone', 'Zone'), ('metar', 'Name')):
+        join = {}
+        for row in tables[name]:
+            lat = weather_index.coordinate(row['Latitude'])
+            lon = weather_index.coordinate(row['Longitude'])
+            if lat is None or lon is None:
+                continue
+            entry = {key: row[key]}
+            entry.update(weather_index.nearby_stations(
+                radars, metars, lat, lon, JOIN_METARS,
+                exclude=row[key] if name == 'metar' else None))
+            join[row[key]] = entry
+        publish(name + '_join', key, [key] + fields, join)
+
+
+
+def zone_polygons():
+    """
+    Convert the zone boundaries (the POLYGONS GeoJSON file) into
+    DIR/zone_polygons.bin, for point-in-zone lookups (see weather_polygons)
+    """
+    with open(POLYGONS, 'r') as geojson:
+        weather_polygons.write(DIR + '/zone_polygons.bin',
+                               weather_polygons.read_geojson(geojson))
+
+
 
+def bundle():
+    """
+    Pack the current CSV tables into DIR/bundle.bin, one compressed file
+    for clients, and write its manifest as DIR/bundle.json
+    (see weather_bundle)
+    """
+    tables = []
+    for name, key in (('radar', 'Name'), ('metar', 'Name'), ('zone', 'Zone')):
+        with open(DIR + '/' + name + '.csv', 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            rows   = list(reader)
+        tables.append((name, key, reader.fieldnames, rows))
+    manifest = weather_bundle.write(DIR + '/bundle.bin', tables)
+    write_text(DIR + '/bundle.json',
+               json.dumps(manifest, indent=1, sort_keys=True) + '\n')
+
+
+
+def database():
+    """
+    Write DIR/weather.sqlite from the current CSV tables: one table per
+    source, and an R*Tree index of each (see weather_sqlite)
+    """
+    tables = []
+    for name, key in (('radar', 'Name'), ('metar', 'Name'), ('zone', 'Zone')):
+        with open(DIR + '/' + name + '.csv', 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            rows   = list(reader)
+        tables.append((name, key, reader.fieldnames, rows))
+    weather_sqlite.write(DIR + '/weather.sqlite', tables)
+
+
+
+def fetch_all(names=SOURCES):
+    """
+    Download the NWS sources ('radar', 'metar', 'zone': default all)
+    concurrently. Tables of sources not named are returned empty.
+    The zone data download depends on the zone index, so it starts as soon
+    as the index is parsed. It is skipped if the index has not changed.
+    Each source fails alone: its error is reported, and counted in
+    weather_metrics.METRICS as fetch_errors_total, and in the HTTP session
+    (see weather_http.Session.failed), and the other sources go on.
+    Output is a tuple of (radar, metar, zone, timings, failed). Timings is
+    a dict of the seconds each download took. Failed is a dict of
+    {source: exception} of the sources that could not be downloaded.
+    """
+    radar   = Radar(download=False)
+    metar   = Metar(download=False)
+    zone    = Zones(download=False)
+    timings = {}
+    failed  = {}
+
+    def timed(name, function):
+        """ Run one download, and record how long it took """
+        start = time.monotonic()
+        try:
+            function()
+        finally:
+            timings[name] = time.monotonic() - start
+            weather_metrics.METRICS.add_time('fetch_seconds', timings[name],
+                                             source=name)
+
+    def zone_chain():
+        """ Zone index, then (if needed) the zone data file """
+        timed('Zone index', zone.download_index)
+        if zone.index_status == '304' \
+        and os.path.exists(DIR + '/zone.csv') \
+        and os.path.exists(DIR + '/zone.bin'):
+            return
+        if zone.index_status in ['200', '304']:
+            timed('Zone data', zone.download_data)
+
+    def isolated(source, function, *args):
+        """ Run one download of a source. An error fails only the source """
+        try:
+            function(*args)
+        except Exception as error:
+            failed.setdefault(source, error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        futures = []
+        if 'radar' in names:
+            futures.append(pool.submit(isolated, 'radar', timed, 'Radar',
+                                       radar.download_nws))
+        if 'metar' in names:
+            futures.append(pool.submit(isolated, 'metar', timed,
+                                       'METAR list', metar.list_of_stations))
+            futures.append(pool.submit(isolated, 'metar', timed,
+                                       'METAR locations', metar.download_nws))
+        if 'zone' in names:
+            futures.append(pool.submit(isolated, 'zone', zone_chain))
+        concurrent.futures.wait(futures)
+
+    for source in sorted(failed):
+        print("WARNING: {} download failed: {!r}".format(source,
+                                                         failed[source]))
+        weather_metrics.METRICS.count('fetch_errors_total', source=source)
+        weather_http.session(CACHE).failed(source)
+    return (radar, metar, zone, timings, failed)
+
+
+
+def update(name, table, parse):
+    """
+    Parse one downloaded table, and write its CSV (see publish). If the
+    table changed, or its snapshot is missing, write the snapshot, too.
+    Each stage is timed in weather_metrics.METRICS.
+    Output is True if the table changed.
+    """
+    metrics = weather_metrics.METRICS
+    with metrics.timer('parse_seconds', table=name):
+        parse()
+    metrics.gauge('table_rows', len(table), table=name)
+    with metrics.timer('write_seconds', table=name, output='csv'):
+        changed = table.csv()
+    if changed or not os.path.exists(DIR + '/' + name + '.bin'):
+        with metrics.timer('write_seconds', table=name, output='snapshot'):
+            table.snapshot()
+    if changed:
+        metrics.count('tables_updated_total', table=name)
+    else:
+        metrics.count('tables_unchanged_total', table=name)
+    return changed
+
+
+
+def check_radar(radar):
+    """ Update the radar table from its download. True if it changed """
     print("Checking US radar stations...")
-    radar = Radar()
     if radar.status == '304' \
-    and os.path.exists(DIR + '/radar.csv'):
+    and os.path.exists(DIR + '/radar.csv') \
+    and os.path.exists(DIR + '/radar.bin'):
         print("US radar information has not changed")
     elif radar.status in ['200', '304']:
         print("Updating US radar lookup table")
-        radar.parse_nws()
-        radar.csv()
+        if update('radar', radar, radar.parse_nws):
+            return True
+        print("US radar table is unchanged")
     else:
         print("WARNING: Server status: {}".format(radar.status))
+    return False
 
 
+def check_metar(metar):
+    """ Update the METAR table from its download. True if it changed """
     print("Checking METAR observation stations...")
-    metar = Metar()
     if  metar.status == '304' \
-    and os.path.exists(DIR + '/metar.csv'):
+    and os.path.exists(DIR + '/metar.csv') \
+    and os.path.exists(DIR + '/metar.bin'):
         print("METAR information has not changed")
     elif metar.status in ['200', '304']:
         print("Updating METAR lookup table")
-        metar.parse()
-        metar.csv()
+        if update('metar', metar, metar.parse):
+            return True
+        print("METAR table is unchanged")
     else:
         print("WARNING: Server status: {}".format(metar.status))
+    return False
 
 
+def check_zone(zone):
+    """ Update the zone table from its download. True if it changed """
     print("Checking Forcast/Alert Zone data...")
-    zone = Zones()
     if zone.index_status == '304' \
-    and os.path.exists(DIR + '/zone.csv'):
+    and os.path.exists(DIR + '/zone.csv') \
+    and os.path.exists(DIR + '/zone.bin'):
         print("Zone information has not changed")
     elif zone.index_status in ['200', '304']:
-        zone.parse_nws_index()
-        zone.download(zone.data_url)
-        zone.data_status = zone.status
-        zone.status = 0
         if zone.data_status == '304' \
-        and os.path.exists(DIR + '/csv/zone.csv'):
+        and os.path.exists(DIR + '/zone.csv') \
+        and os.path.exists(DIR + '/zone.bin'):
             print("Zone information has not changed")
         elif zone.data_status in ['200', '304']:
             print("Updating Forecast/Alert Zone lookup table")
-            zone.parse_nws_zones()
-            zone.csv()
+            if update('zone', zone, zone.parse_nws_zones):
+                return True
+            print("Forecast/Alert Zone table is unchanged")
         else:
             print("WARNING: Server status: {}".format(zone.data_status))
     else:
         print("WARNING: Server status: {}".format(zone.index_status))
+    return False
+
 
+def derive(updated):
+    """
+    Rebuild the outputs computed from the CSV tables (raster, SQLite
+    database, join tables, client bundle) if a table was updated, or they
+    are missing.
+    Rebuild the zone polygons if their GeoJSON source is newer.
+    Output is the list of outputs rebuilt.
+    """
+    outputs = []
+    tables  = [DIR + '/' + name + '.csv' for name in SOURCES]
+    if all(os.path.exists(table) for table in tables) \
+    and (updated or not os.path.exists(DIR + '/raster.bin')):
+        print("Updating nearest-station raster")
+        with weather_metrics.METRICS.timer('write_seconds', output='raster'):
+            raster()
+        outputs.append('raster')
+    if all(os.path.exists(table) for table in tables) \
+    and (updated or not os.path.exists(DIR + '/weather.sqlite')):
+        print("Updating SQLite database")
+        with weather_metrics.METRICS.timer('write_seconds', output='sqlite'):
+            database()
+        outputs.append('sqlite')
+    if all(os.path.exists(table) for table in tables) \
+    and (updated or not os.path.exists(DIR + '/zone_join.csv')):
+        print("Updating zone and METAR join tables")
+        with weather_metrics.METRICS.timer('write_seconds', output='joins'):
+            joins()
+        outputs.append('joins')
+    if all(os.path.exists(table) for table in tables) \
+    and (updated or not os.path.exists(DIR + '/bundle.bin')):
+        print("Updating compressed client bundle")
+        with weather_metrics.METRICS.timer('write_seconds', output='bundle'):
+            bundle()
+        outputs.append('bundle')
+
+    polygons = DIR + '/zone_polygons.bin'
+    if os.path.exists(POLYGONS) and (not os.path.exists(polygons)
+                                     or os.path.getmtime(POLYGONS)
+                                     > os.path.getmtime(polygons)):
+        print("Updating zone boundary polygons")
+        with weather_metrics.METRICS.timer('write_seconds',
+                                           output='polygons'):
+            zone_polygons()
+        outputs.append('polygons')
+    return outputs
+
+
+def build(names=SOURCES):
+    """
+    Build the database from the named sources (default all). Every file
+    is replaced at once, when complete. If anything changed, a new
+    generation is published last (see publish_generation).
+    A source that fails to download is skipped, and the others are still
+    updated (see fetch_all).
+    Output is a tuple of (changed, failed): the lists of tables and
+    outputs that changed, and of sources that failed to download.
+    """
+    print("Starting run...")
+
+    print("Downloading NWS sources...")
+    start = time.monotonic()
+    radar, metar, zone, timings, failed = fetch_all(names)
+    for name in sorted(timings):
+        print("  {:<16} {:6.2f} s".format(name, timings[name]))
+    print("  {:<16} {:6.2f} s".format('Total', time.monotonic() - start))
+
+    changed = []
+    for name, table, check in (('radar', radar, check_radar),
+                               ('metar', metar, check_metar),
+                               ('zone', zone, check_zone)):
+        if name in names and name not in failed and check(table):
+            changed.append(name)
+    changed = changed + derive(bool(changed))
+
+    if changed or not os.path.exists(DIR + '/' + GENERATION):
+        generation = publish_generation(changed)
+        weather_metrics.METRICS.gauge('generation', generation)
+        print("Published generation {}".format(generation))
     print("End of run")
+    return (changed, sorted(failed))
+
+
+def watch(schedule=None, passes=None, sleep=time.sleep, clock=time.monotonic):
+    """
+    Watch mode: keep polling each source on its own schedule, and rebuild
+    only what changed (see build).
+    schedule: {source: seconds between polls}, merged into SCHEDULE
+    passes:   stop after this many polls (default: never stop)
+    httplib2's cache makes each poll a conditional GET: a source that has
+    not changed answers 304 Not Modified, and is not parsed again.
+    A source that fails to download stays due: it alone is polled again
+    after RETRY seconds. A failed build is reported, and retried on the
+    next schedule.
+    """
+    schedule = dict(SCHEDULE, **(schedule or {}))
+    due      = dict((name, 0.0) for name in SOURCES)
+    count    = 0
+    while passes is None or count < passes:
+        now   = clock()
+        names = [name for name in SOURCES if due[name] <= now]
+        if names:
+            for name in names:
+                due[name] = now + schedule[name]
+            try:
+                failed = build(names)[1]
+            except (OSError, ValueError,
+                    weather_http.httplib2.HttpLib2Error) as error:
+                weather_metrics.METRICS.count('watch_errors_total')
+                print("WARNING: {}: {}".format(', '.join(names), error))
+            else:
+                for name in failed:
+                    due[name] = now + min(schedule[name], RETRY)
+            count = count + 1
+        if passes is None or count < passes:
+            sleep(max(0.0, min(due.values()) - clock()))
+
+
+def run(metrics=None, profile=None, watching=False):
+    """
+    Build the database (see build), or keep it up to date (see watch)
+    metrics: (optional) path to write the stage timings and counters to,
+             as Prometheus text (*.prom) or JSON (see weather_metrics).
+             In watch mode, it is written after every poll.
+    profile: (optional) path to save cProfile stats to (one-shot builds)
+    """
+    if watching:
+        def pause(seconds):
+            """ Write the metrics of the last poll, then wait """
+            if metrics:
+                weather_metrics.METRICS.write(metrics)
+            time.sleep(seconds)
+        watch(sleep=pause)
+        return
+    try:
+        with weather_metrics.profiled(profile):
+            build()
+    finally:
+        if metrics:
+            weather_metrics.METRICS.write(metrics)
 
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Build the weather "
+                                     "location database from NWS sources")
+    parser.add_argument('--metrics', default=None,
+                        help="Write metrics here (.prom: Prometheus text, "
+                             "otherwise JSON)")
+    parser.add_argument('--profile', default=None,
+                        help="Save cProfile stats here (see pstats)")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running, and poll each source on its "
+                             "schedule (see SCHEDULE)")
+    args = parser.parse_args()
+    run(args.metrics, args.profile, args.watch)
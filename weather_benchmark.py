@@ -0,0 +1,540 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for the lookup and parse hot paths
+
+Synthetic NWS-format inputs are generated for each table size: the
+fixed-width radar station file, the semicolon-delimited nsd_cccc.txt
+METAR file, and the pipe-delimited zone file. Each case is timed (best of
+--repeat runs), then run once more under tracemalloc for peak memory.
+
+--memory reports the memory each parsed table keeps, as the columnar
+StationTable and as the older dict of dicts. Each is built from the raw
+input in its own interpreter, and measured with tracemalloc.
+
+--only decode compares a client's download of a table: the CSV, and the
+compressed bundle (see weather_bundle).
+
+--startup times a cold start of the offline-first client in a fresh
+interpreter: the import, and then the first answer, from local snapshots.
+
+Results can be saved as a baseline, and later runs compared against it.
+A case that is slower than the baseline by more than --tolerance is
+reported as a regression, and the exit status is 1.
+
+Script usage:
+    python3 weather_benchmark.py [--sizes 1000,100000] [--save]
+    python3 weather_benchmark.py --sizes 1000,10000000 --only parse
+    python3 weather_benchmark.py --memory
+    python3 weather_benchmark.py --startup
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+import sys
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import argparse
+import csv
+import io
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+# Other modules of this project
+import closest_weather_location
+import nws_database_creator
+import weather_bundle
+import weather_index
+import weather_snapshot
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'benchmark_baseline.json')
+SIZES    = [1000, 10000, 100000]
+FIELDS   = ['Name', 'Location', 'Latitude', 'Longitude']
+
+
+
+# Synthetic inputs
+
+def _dms(value, positive, negative, width):
+    """ Decimal degrees to NWS dd-mm-ssH text """
+    hemisphere = positive if value >= 0 else negative
+    value   = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = min(int(round(((value - degrees) * 60 - minutes) * 60)), 59)
+    return '{:0{}d}-{:02d}-{:02d}{}'.format(degrees, width, minutes,
+                                            seconds, hemisphere)
+
+
+def radar_text(rows, seed=1):
+    """ A fixed-width NEXRAD station file (CR/LF lines), as bytes """
+    rand  = random.Random(seed)
+    lines = ['NCDCID   ICAO     WBAN  NAME                           '
+             'COUNTRY              ST COUNTY                         '
+             'LAT       LON         ELEV   UTC   STNTYPE   ',
+             '-------- -------- ----- ------------------------------ '
+             '-------------------- -- ------------------------------ '
+             '--------- ----------- ------ ----- ----------']
+    for row in range(rows):
+        lines.append('{:<8d} {:<8s} {:<5d} {:<30s} {:<20s} {:<2s} {:<30s} '
+                     '{:<9.5f} {:<11.5f} {:<6d} {:<5d} {:<10s}'.format(
+                         30000000 + row, _station_id(row), row % 100000,
+                         'TOWN {}'.format(row), 'UNITED STATES',
+                         'WI' if row % 5 else '', 'COUNTY',
+                         rand.uniform(-89, 89), rand.uniform(-179, 179),
+                         rand.randint(0, 3000), -6, 'NEXRAD'))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def metar_text(rows, seed=2):
+    """
+    A semicolon-delimited nsd_cccc.txt METAR file, as bytes.
+    Output is a tuple of (file, set of downloadable station codes)
+    """
+    rand     = random.Random(seed)
+    lines    = []
+    stations = set()
+    for row in range(rows):
+        icao = _station_id(row)
+        lat  = _dms(rand.uniform(-89, 89), 'N', 'S', 2)
+        lon  = _dms(rand.uniform(-179, 179), 'E', 'W', 3)
+        lines.append(';'.join([icao, '72', '{:03d}'.format(row % 1000),
+                               'Place {}'.format(row),
+                               'WI' if row % 3 == 0 else '',
+                               'United States', '4', lat, lon, lat, lon,
+                               '211', '221', 'P']))
+        if row % 4:
+            stations.add(icao)
+    return (('\n'.join(lines) + '\n').encode('utf-8'), stations)
+
+
+def zone_text(rows, seed=3):
+    """ A pipe-delimited NWS zone file (CR/LF lines), as bytes """
+    rand  = random.Random(seed)
+    lines = []
+    for row in range(rows):
+        lines.append('WI|{0:03d}|MKX|Zone {0}|{1}|County {0}|55079|C|se|'
+                     '{2:.4f}|{3:.4f}'.format(row, 'Z' + _station_id(row),
+                                              rand.uniform(-89, 89),
+                                              rand.uniform(-179, 179)))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def table_rows(rows, seed=4):
+    """ Rows of a downloaded table (like csv.DictReader yields) """
+    rand = random.Random(seed)
+    return [{'Name'     : _station_id(row),
+             'Location' : 'Place {}'.format(row),
+             'Latitude' : '{:.4f}'.format(rand.uniform(-89, 89)),
+             'Longitude': '{:.4f}'.format(rand.uniform(-179, 179))}
+            for row in range(rows)]
+
+
+def table_csv(rows, seed=4):
+    """ The CSV text of a downloaded table (see table_rows) """
+    text   = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(table_rows(rows, seed))
+    return text.getvalue()
+
+
+def _station_id(row):
+    """ A unique 4-letter station code (base 26) for every row """
+    letters = []
+    for _ in range(4):
+        row, letter = divmod(row, 26)
+        letters.append(chr(ord('A') + letter))
+    return ''.join(reversed(letters)) + ('' if row == 0 else str(row))
+
+
+
+# Benchmark cases
+# Each case function takes the table size, and returns a callable to time
+# (setup, like generating input, is not timed).
+
+def case_best(rows):
+    """ best() on an unindexed table: one linear scan """
+    table = table_rows(rows)
+    return lambda: closest_weather_location.best(table)
+
+
+def case_best_indexed(rows):
+    """ best() against a prebuilt SphereIndex, one query per row """
+    index  = weather_index.SphereIndex(table_rows(rows))
+    points = [(float(row['Latitude']), float(row['Longitude']))
+              for row in table_rows(rows, seed=5)]
+    best   = closest_weather_location.best
+    return lambda: [best(index, lat, lon) for lat, lon in points]
+
+
+def case_rough_distance(rows):
+    """ rough_distance(), once per row """
+    points = [(float(row['Latitude']), float(row['Longitude']))
+              for row in table_rows(rows)]
+    rough  = closest_weather_location.rough_distance
+    return lambda: [rough(5, lat, lon) for lat, lon in points]
+
+
+def case_precise_distance(rows):
+    """ precise_distance(), once per row """
+    points = [(float(row['Latitude']), float(row['Longitude']))
+              for row in table_rows(rows)]
+    precise = closest_weather_location.precise_distance
+    return lambda: [precise(43.01, -87.99, lat, lon) for lat, lon in points]
+
+
+def case_dms_to_dec(rows):
+    """ dms_to_dec(), once per row """
+    rand   = random.Random(6)
+    values = [_dms(rand.uniform(-179, 179), 'E', 'W', 3) for _ in range(rows)]
+    convert = nws_database_creator.dms_to_dec
+    return lambda: [convert(value) for value in values]
+
+
+def case_parse_radar(rows):
+    """ Radar.parse_nws() """
+    content = radar_text(rows)
+    def parse():
+        radar = nws_database_creator.Radar(download=False)
+        radar.content = content
+        radar.parse_nws()
+        return radar
+    return parse
+
+
+def case_parse_metar(rows):
+    """ Metar.parse() """
+    content, stations = metar_text(rows)
+    def parse():
+        metar = nws_database_creator.Metar(download=False)
+        metar.locations = content
+        metar.stations  = stations
+        metar.parse()
+        return metar
+    return parse
+
+
+def case_parse_zones(rows):
+    """ Zones.parse_nws_zones() """
+    content = zone_text(rows)
+    def parse():
+        zone = nws_database_creator.Zones(download=False)
+        zone.content = content
+        zone.parse_nws_zones()
+        return zone
+    return parse
+
+
+def case_csv(rows):
+    """ The three csv() writers, on parsed tables """
+    radar = case_parse_radar(rows)()
+    metar = case_parse_metar(rows)()
+    zone  = case_parse_zones(rows)()
+    def write():
+        # Remove the previous output, so unchanged tables are not skipped
+        for name in os.listdir(nws_database_creator.DIR):
+            os.remove(os.path.join(nws_database_creator.DIR, name))
+        radar.csv()
+        metar.csv()
+        zone.csv()
+    return write
+
+
+def case_decode_csv(rows):
+    """ Read a downloaded CSV table, and parse its coordinates """
+    text       = table_csv(rows)
+    coordinate = weather_index.coordinate
+    def decode():
+        return [(coordinate(row['Latitude']), coordinate(row['Longitude']))
+                for row in csv.DictReader(io.StringIO(text))]
+    return decode
+
+
+def case_decode_bundle(rows):
+    """ weather_bundle.decode() of the same table, as a bundle """
+    data = weather_bundle.encode([('metar', 'Name', FIELDS,
+                                   table_rows(rows))])[0]
+    return lambda: weather_bundle.decode(data)
+
+
+CASES = [('best',             case_best,             'lookup'),
+         ('best_indexed',     case_best_indexed,     'lookup'),
+         ('rough_distance',   case_rough_distance,   'lookup'),
+         ('precise_distance', case_precise_distance, 'lookup'),
+         ('dms_to_dec',       case_dms_to_dec,       'parse'),
+         ('parse_radar',      case_parse_radar,      'parse'),
+         ('parse_metar',      case_parse_metar,      'parse'),
+         ('parse_zones',      case_parse_zones,      'parse'),
+         ('csv',              case_csv,              'write'),
+         ('decode_csv',       case_decode_csv,       'decode'),
+         ('decode_bundle',    case_decode_bundle,    'decode')]
+
+
+
+def measure(function, repeat):
+    """
+    Time a callable (best of repeat runs), then run it once more under
+    tracemalloc. Output is a tuple of (seconds, peak bytes)
+    """
+    seconds = None
+    for _ in range(repeat):
+        start   = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (seconds, peak)
+
+
+def run_cases(sizes, repeat=3, only=None):
+    """
+    Run every case (or only those in one group) for every size.
+    Output is a dict: {'<case>/<size>': {seconds, rows_per_second,
+                                         peak_bytes}}
+    """
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='weather-benchmark-')
+    old_dir = nws_database_creator.DIR
+    nws_database_creator.DIR = workdir
+    try:
+        for name, case, group in CASES:
+            if only and only not in (name, group):
+                continue
+            for rows in sizes:
+                seconds, peak = measure(case(rows), repeat)
+                key = '{}/{}'.format(name, rows)
+                results[key] = {'seconds'        : seconds,
+                                'rows_per_second': rows / seconds,
+                                'peak_bytes'     : peak}
+                print("{:<24} {:>10.4f} s {:>14,.0f} rows/s {:>12,} B peak"
+                      .format(key, seconds, rows / seconds, peak))
+    finally:
+        nws_database_creator.DIR = old_dir
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline. Output is a list of regression
+    messages (empty if none)
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        before = baseline[key]['seconds']
+        after  = results[key]['seconds']
+        if after > before * (1 + tolerance):
+            regressions.append("{}: {:.4f} s, baseline {:.4f} s ({:+.0%})"
+                               .format(key, after, before,
+                                       after / before - 1))
+    return regressions
+
+
+def _parsed(parse):
+    """ parse(), then drop the raw input it kept: only the table is left """
+    table = parse()
+    for name in ('content', 'locations', 'stations'):
+        if hasattr(table, name):
+            setattr(table, name, None)
+    return table
+
+
+def representation(name, rows, kind):
+    """
+    A function that parses one table's raw input (made here, once) into
+    one representation, and returns it: the StationTable ('table'), or a
+    dict of {station ID: dict of fields} ('dicts', the representation it
+    replaced). Both hold the same parsed values, and not the raw input.
+    """
+    creator = nws_database_creator
+    if kind == 'table':
+        parse = {'radar': case_parse_radar, 'metar': case_parse_metar,
+                 'zones': case_parse_zones}[name](rows)
+        return lambda: _parsed(parse)
+
+    if name == 'radar':
+        content = radar_text(rows)
+        def dicts():
+            columns = creator.radar_columns(content)
+            return dict((sta_id, dict((field, columns[field][position])
+                                      for field in creator.Radar.FIELDS))
+                        for position, sta_id in enumerate(columns['Name']))
+        return dicts
+    if name == 'metar':
+        content, stations = metar_text(rows)
+        return lambda: dict((record.name,
+                             dict(zip(creator.Metar.FIELDS, record)))
+                            for record in creator.iter_metar(content,
+                                                             stations))
+    content = zone_text(rows)
+    return lambda: dict((record.zone, dict(zip(creator.Zones.FIELDS, record)))
+                        for record in creator.iter_zones(content))
+
+
+# Run in a fresh interpreter, so that neither representation shares
+# strings with the other. The first build loads any lazy
+# imports, and is not counted.
+MEMORY = '''
+import gc, sys, tracemalloc
+import weather_benchmark
+build = weather_benchmark.representation(sys.argv[1], int(sys.argv[2]),
+                                         sys.argv[3])
+build()
+gc.collect()
+tracemalloc.start()
+kept = build()
+gc.collect()
+print(tracemalloc.get_traced_memory()[0])
+'''
+
+
+def memory_report(sizes):
+    """
+    Compare the memory kept by each parsed table: the StationTable, and
+    the same values as a dict of dicts (the representation it replaced).
+    Each is built from the raw input in its own fresh interpreter, and
+    measured with tracemalloc: the bytes still allocated once it is built.
+    Output is a dict: {'<table>/<size>': {table_bytes, dict_bytes}}
+    """
+    results = {}
+    here    = os.path.dirname(os.path.abspath(__file__))
+    for name in ('radar', 'metar', 'zones'):
+        for rows in sizes:
+            kept = {}
+            for kind in ('table', 'dicts'):
+                output = subprocess.run([sys.executable, '-c', MEMORY,
+                                         name, str(rows), kind],
+                                        cwd=here, check=True,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True).stdout
+                kept[kind] = int(output.split()[-1])
+            key = '{}/{}'.format(name, rows)
+            results[key] = {'table_bytes': kept['table'],
+                            'dict_bytes': kept['dicts']}
+            print("{:<24} {:>14,} B table {:>14,} B dicts ({:.0%})"
+                  .format(key, kept['table'], kept['dicts'],
+                          kept['table'] / max(kept['dicts'], 1)))
+    return results
+
+
+# Run in a fresh interpreter: the import is part of what is timed
+STARTUP = '''
+import sys, time
+start = time.perf_counter()
+import closest_weather_location
+imported = time.perf_counter()
+closest_weather_location.CACHE = sys.argv[1]
+locator = closest_weather_location.offline_locator(max_age=float('inf'))
+locator.resolve_all(closest_weather_location.LATITUDE,
+                    closest_weather_location.LONGITUDE)
+print(imported - start, time.perf_counter() - start,
+      'httplib2' in sys.modules, 'numpy' in sys.modules)
+'''
+
+
+def startup_report(sizes, repeat=3):
+    """
+    Time import-to-first-answer of closest_weather_location.offline_locator
+    with local snapshots of each table size (best of repeat cold starts).
+    Output is a dict: {'startup/<size>': {import_seconds, seconds}}
+    """
+    results = {}
+    here    = os.path.dirname(os.path.abspath(__file__))
+    for rows in sizes:
+        cache = tempfile.mkdtemp(prefix='weather-startup-')
+        try:
+            for dl_type in closest_weather_location.TABLES:
+                fields = ['Zone' if dl_type == 'zone' else 'Name',
+                          'Location', 'Latitude', 'Longitude']
+                table  = table_rows(rows)
+                if dl_type == 'zone':
+                    for row in table:
+                        row['Zone'] = row['Name']
+                weather_snapshot.write(os.path.join(cache, dl_type + '.bin'),
+                                       fields, table)
+            best = None
+            for _ in range(repeat):
+                output = subprocess.run([sys.executable, '-c', STARTUP, cache],
+                                        cwd=here, check=True,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True).stdout
+                imported, answered, http, numpy = output.split()
+                if best is None or float(answered) < best[1]:
+                    best = (float(imported), float(answered), http, numpy)
+        finally:
+            shutil.rmtree(cache, ignore_errors=True)
+        key = 'startup/{}'.format(rows)
+        results[key] = {'import_seconds': best[0], 'seconds': best[1]}
+        print("{:<24} {:>8.3f} s import {:>8.3f} s first answer "
+              "(httplib2 loaded: {}, numpy loaded: {})"
+              .format(key, best[0], best[1], best[2], best[3]))
+    return results
+
+
+def run(argv=None):
+    """ Command line """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help="Comma-separated table sizes (rows)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Timed runs per case. The best is kept")
+    parser.add_argument('--only', default=None,
+                        help="One case, or group: lookup, parse, write, "
+                             "decode")
+    parser.add_argument('--baseline', default=BASELINE,
+                        help="Baseline JSON file")
+    parser.add_argument('--save', action='store_true',
+                        help="Save the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed slowdown before a regression")
+    parser.add_argument('--memory', action='store_true',
+                        help="Report the memory kept by each parsed table")
+    parser.add_argument('--startup', action='store_true',
+                        help="Time import-to-first-answer, offline-first")
+    args = parser.parse_args(argv)
+
+    sizes   = [int(size) for size in args.sizes.split(',')]
+    if args.memory:
+        memory_report(sizes)
+        return 0
+    if args.startup:
+        startup_report(sizes, args.repeat)
+        return 0
+    results = run_cases(sizes, args.repeat, args.only)
+
+    if args.save:
+        with open(args.baseline, 'w') as jsonfile:
+            json.dump(results, jsonfile, indent=1, sort_keys=True)
+        print("Saved baseline: {}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with. Save one with --save")
+        return 0
+    with open(args.baseline) as jsonfile:
+        baseline = json.load(jsonfile)
+    regressions = compare(results, baseline, args.tolerance)
+    for message in regressions:
+        print("REGRESSION " + message)
+    if not regressions:
+        print("No regressions against {}".format(args.baseline))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+"""
+Compressed bundle of the weather location tables, for client downloads
+
+nws_database_creator packs the radar, metar, and zone tables into one
+file, bundle.bin, so a client gets all three in one small request instead
+of three CSVs. The tables are stored column by column, which compresses
+far better than rows of text:
+- Rows are sorted by station ID. Each ID is front coded: the length of
+  the prefix it shares with the previous ID, then the rest of it
+- Coordinates are integers of 1/SCALE degree (SCALE 1e6: about 0.1 m),
+  each stored as the difference from the previous row's
+- Every other field is one '\\n'-joined text column
+The whole payload is then compressed with COMPRESSION: zlib decodes
+fastest, lzma is smaller.
+
+A JSON manifest, ahead of the payload, has the format version, the size
+and SHA-256 of the payload, and each table's name, fields, row count, and
+the SHA-256 of its section. decode() checks them all. The manifest is
+also written alone, as bundle.json, for mirrors.
+
+decode() returns BundleTable objects, with float coordinate columns like
+weather_snapshot.Snapshot, so a SphereIndex uses them without parsing.
+
+Layout (little-endian):
+    Header       magic b'NWSB', version (u16), compression (u16),
+                 manifest length (u32)
+    Manifest     utf-8 JSON
+    Payload      compressed: the table sections, one after another
+Table section:
+    Missing      count (u32), then row positions (u32) without coordinates
+    Latitude     i32 x rows: differences of 1/SCALE degree
+    Longitude    i32 x rows: differences of 1/SCALE degree
+    IDs          u8 x rows: shared prefix lengths, then a text column
+    Per field    text column: length (u32), then utf-8 values joined by '\\n'
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+import struct
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import hashlib
+import itertools
+import json
+import lzma
+import math
+import time
+import zlib
+from array import array
+
+# Other modules of this project
+from weather_index import coordinate
+from weather_snapshot import little_endian, from_little_endian
+
+
+MAGIC       = b'NWSB'
+VERSION     = 1
+HEADER      = struct.Struct('<4sHHI')
+LENGTH      = struct.Struct('<I')
+SCALE       = 1000000           # Coordinate units per degree
+COMPRESSION = 'zlib'            # Default: 'zlib', 'lzma', or 'none'
+COORDS      = ('Latitude', 'Longitude')
+COMPRESSORS = {'none' : (0, bytes, bytes),
+               'zlib' : (1, lambda data: zlib.compress(data, 9),
+                         zlib.decompress),
+               'lzma' : (2, lambda data: lzma.compress(data, preset=9),
+                         lzma.decompress)}
+
+
+def _quantize(value):
+    """ Table text (or float) to integer 1/SCALE degrees. None if unusable """
+    value = coordinate(value)
+    if value is None:
+        return None
+    return int(round(value * SCALE))
+
+
+def _text(values):
+    """ A text column: length, then the values joined by '\\n' """
+    for value in values:
+        if '\n' in value:
+            raise ValueError("Bundle text cannot hold a newline: {!r}"
+                             .format(value))
+    text = '\n'.join(values).encode('utf-8')
+    return LENGTH.pack(len(text)) + text
+
+
+def _section(key, fieldnames, rows):
+    """ The raw bytes of one table section (see the layout above) """
+    rows    = sorted(rows, key=lambda row: row[key])
+    missing = array('I')
+    columns = (array('i'), array('i'))
+    last    = [0, 0]
+    for position, row in enumerate(rows):
+        values = [_quantize(row.get(coord)) for coord in COORDS]
+        if None in values:
+            missing.append(position)
+            values = last           # A difference of 0
+        for axis, value in enumerate(values):
+            columns[axis].append(value - last[axis])
+        last = values
+
+    prefixes = array('B')
+    suffixes = []
+    previous = ''
+    for row in rows:
+        sta_id = row[key]
+        shared = 0
+        limit  = min(len(sta_id), len(previous), 255)
+        while shared < limit and sta_id[shared] == previous[shared]:
+            shared = shared + 1
+        prefixes.append(shared)
+        suffixes.append(sta_id[shared:])
+        previous = sta_id
+
+    chunks = [LENGTH.pack(len(missing)), little_endian(missing),
+              little_endian(columns[0]), little_endian(columns[1]),
+              little_endian(prefixes), _text(suffixes)]
+    for field in fieldnames:
+        if field != key and field not in COORDS:
+            chunks.append(_text([row.get(field) or '' for row in rows]))
+    return b''.join(chunks)
+
+
+def encode(tables, compression=COMPRESSION):
+    """
+    Pack tables into a bundle.
+    Input: a list of (table name, ID field name, field names, rows) tuples,
+           rows being dicts keyed by field name, and the compression
+           ('zlib', 'lzma', or 'none')
+    Output is a tuple of (bundle bytes, manifest dict).
+    """
+    if compression not in COMPRESSORS:
+        raise ValueError("Unknown compression: {}".format(compression))
+    number, compress, _ = COMPRESSORS[compression]
+    sections = []
+    entries  = []
+    for name, key, fieldnames, rows in tables:
+        rows    = list(rows)
+        section = _section(key, fieldnames, rows)
+        sections.append(section)
+        entries.append({'name'   : name,
+                        'key'    : key,
+                        'fields' : list(fieldnames),
+                        'rows'   : len(rows),
+                        'size'   : len(section),
+                        'sha256' : hashlib.sha256(section).hexdigest()})
+
+    payload  = compress(b''.join(sections))
+    manifest = {'version'     : VERSION,
+                'created'     : int(time.time()),
+                'compression' : compression,
+                'scale'       : SCALE,
+                'size'        : len(payload),
+                'sha256'      : hashlib.sha256(payload).hexdigest(),
+                'tables'      : entries}
+    text = json.dumps(manifest, sort_keys=True).encode('utf-8')
+    return (HEADER.pack(MAGIC, VERSION, number, len(text)) + text + payload,
+            manifest)
+
+
+def write(path, tables, compression=COMPRESSION):
+    """
+    Write a bundle file (see encode). Any existing file is replaced at
+    once, when the new one is complete.
+    Output is the manifest dict.
+    """
+    data, manifest = encode(tables, compression)
+    with open(path + '.tmp', 'wb') as bundlefile:
+        bundlefile.write(data)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+
+def _check_manifest(manifest):
+    """ Raise ValueError unless the manifest has every entry decode() uses """
+    def has(entries, name, kinds):
+        """ The entry of that name, which must be of one of those types """
+        value = entries.get(name)
+        if not isinstance(value, kinds) or isinstance(value, bool):
+            raise ValueError("Corrupt bundle manifest")
+        return value
+
+    if not isinstance(manifest, dict):
+        raise ValueError("Corrupt bundle manifest")
+    has(manifest, 'size', int)
+    has(manifest, 'sha256', str)
+    if has(manifest, 'scale', (int, float)) <= 0:
+        raise ValueError("Corrupt bundle manifest")
+    for entry in has(manifest, 'tables', list):
+        if not isinstance(entry, dict):
+            raise ValueError("Corrupt bundle manifest")
+        has(entry, 'name', str)
+        has(entry, 'key', str)
+        has(entry, 'sha256', str)
+        if has(entry, 'rows', int) < 0 or has(entry, 'size', int) < 0 \
+        or not all(isinstance(field, str)
+                   for field in has(entry, 'fields', list)):
+            raise ValueError("Corrupt bundle manifest")
+
+
+def decode(data):
+    """
+    Unpack a bundle, and check it against its manifest.
+    Output is a dict of {table name: BundleTable}.
+    Raises ValueError if the data is not a bundle, or is corrupt.
+    """
+    data = memoryview(data)
+    if len(data) < HEADER.size:
+        raise ValueError("Not a weather bundle")
+    magic, version, number, length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a weather bundle")
+    if version != VERSION:
+        raise ValueError("Unsupported bundle version {}".format(version))
+    try:
+        manifest = json.loads(bytes(data[HEADER.size:HEADER.size + length])
+                              .decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError("Corrupt bundle manifest")
+    _check_manifest(manifest)
+    payload = data[HEADER.size + length:]
+    if len(payload) != manifest['size'] \
+    or hashlib.sha256(payload).hexdigest() != manifest['sha256']:
+        raise ValueError("Bundle payload does not match its checksum")
+    for compression, (code, _, decompress) in COMPRESSORS.items():
+        if code == number:
+            break
+    else:
+        raise ValueError("Unknown bundle compression {}".format(number))
+    try:
+        raw = memoryview(decompress(payload))
+    except (lzma.LZMAError, zlib.error):
+        raise ValueError("Corrupt bundle payload")
+
+    tables = {}
+    offset = 0
+    for entry in manifest['tables']:
+        section = raw[offset:offset + entry['size']]
+        offset  = offset + entry['size']
+        if hashlib.sha256(section).hexdigest() != entry['sha256']:
+            raise ValueError("Bundle table {} does not match its checksum"
+                             .format(entry['name']))
+        tables[entry['name']] = BundleTable(entry['key'], entry['fields'],
+                                            entry['rows'], section,
+                                            manifest['scale'])
+    return tables
+
+
+
+class BundleTable(object):
+    """
+    One decoded table of a bundle
+    - latitudes and longitudes are float64 arrays (NaN if missing)
+    - Text columns are lists of strings. Rows are built (as dicts of
+      strings, like csv.DictReader) on access
+    """
+    def __init__(self, key, fieldnames, n_rows, section, scale=SCALE):
+        """ Decode one table section """
+        self.fieldnames = list(fieldnames)
+        self.key        = key
+        self._rows      = n_rows
+
+        offset  = 0
+        count   = LENGTH.unpack_from(section, offset)[0]
+        offset  = offset + LENGTH.size
+        missing = from_little_endian('I', section[offset:offset + 4 * count])
+        offset  = offset + 4 * count
+        columns = []
+        for coord in COORDS:
+            deltas = from_little_endian('i', section[offset:
+                                                      offset + 4 * n_rows])
+            offset = offset + 4 * n_rows
+            columns.append(array('d', map(float(scale).__rtruediv__,
+                                          itertools.accumulate(deltas))))
+        for position in missing:
+            columns[0][position] = math.nan
+            columns[1][position] = math.nan
+        self.latitudes, self.longitudes = columns
+
+        prefixes = section[offset:offset + n_rows]
+        offset   = offset + n_rows
+        suffixes, offset = self._text(section, offset)
+        ids      = []
+        previous = ''
+        for shared, suffix in zip(prefixes, suffixes):
+            previous = previous[:shared] + suffix if shared else suffix
+            ids.append(previous)
+
+        self._strings = {key: ids}
+        for field in self.fieldnames:
+            if field != key and field not in COORDS:
+                self._strings[field], offset = self._text(section, offset)
+        if offset != len(section):
+            raise ValueError("Corrupt bundle table")
+
+    def _text(self, section, offset):
+        """ Decode a text column. Output is (list of values, next offset) """
+        length = LENGTH.unpack_from(section, offset)[0]
+        offset = offset + LENGTH.size
+        text   = bytes(section[offset:offset + length]).decode('utf-8')
+        values = text.split('\n') if self._rows else []
+        if len(values) != self._rows:
+            raise ValueError("Corrupt bundle table")
+        return (values, offset + length)
+
+    def __len__(self):
+        return self._rows
+
+    def __getitem__(self, position):
+        """ One row as a dict of strings """
+        if position < 0:
+            position = position + self._rows
+        if not 0 <= position < self._rows:
+            raise IndexError("bundle row out of range")
+        row = {}
+        for name in self.fieldnames:
+            if name == 'Latitude':
+                value = self.latitudes[position]
+            elif name == 'Longitude':
+                value = self.longitudes[position]
+            else:
+                row[name] = self._strings[name][position]
+                continue
+            row[name] = '' if math.isnan(value) else repr(value)
+        return row
+
+    def __iter__(self):
+        for position in range(self._rows):
+            yield self[position]
+
+    def field(self, name, position):
+        """ One string field of one row """
+        return self._strings[name][position]
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+"""
+Memo cache of nearest-location answers, for clients that ask about the
+same place again and again
+
+Mobile clients send slightly different coordinates for the same place, so
+a plain memo would never hit. QueryCache rounds each point to a grid of
+PRECISION degrees (0.01 degree is about 1 km), and the answer for a grid
+point is computed once, for the grid point itself: every query that rounds
+to it gets the same answer.
+
+The cache is a bounded LRU: when full, the least recently used answer is
+evicted. Answers also expire TTL seconds after they were computed. clear()
+drops everything, and must be called when the tables are reloaded. An
+answer computed from the old tables, that is stored after clear(), is
+dropped too.
+
+Hits, misses, evictions (LRU) and expirations (TTL) are counted, for
+tuning the size against memory: see stats(). They are also counted in
+weather_metrics.METRICS, as locator_cache_*_total.
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import threading
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import collections
+import time
+
+# Other modules of this project
+import weather_metrics
+
+
+PRECISION   = 0.01          # Degrees. Points are rounded to this grid
+MAX_ENTRIES = 10000         # Cached answers. Least recently used go first
+TTL         = 60 * 60       # Seconds an answer is kept
+
+
+
+class QueryCache(object):
+    """
+    Thread-safe LRU cache of answers, keyed by (kind, rounded lat/lon)
+    """
+    def __init__(self, precision=PRECISION, max_entries=MAX_ENTRIES,
+                 ttl=TTL, clock=time.monotonic):
+        """ clock returns seconds, replaceable for tests """
+        if precision <= 0 or max_entries < 1:
+            raise ValueError("precision and max_entries must be positive")
+        self.precision   = precision
+        self.max_entries = max_entries
+        self.ttl         = ttl
+        self.clock       = clock
+        self.entries     = collections.OrderedDict()  # key -> (time, answer)
+        self.generation  = 0        # Incremented by clear()
+        self.counts      = collections.Counter()
+        self._lock       = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _count(self, name):
+        """ Count in this cache, and in weather_metrics.METRICS """
+        self.counts[name] += 1
+        weather_metrics.METRICS.count('locator_cache_' + name + '_total')
+
+    def quantize(self, latitude, longitude):
+        """ The grid cell of a point: a tuple of two integers """
+        longitude = (longitude + 180) % 360 - 180
+        return (int(round(latitude / self.precision)),
+                int(round(longitude / self.precision)))
+
+    def lookup(self, kind, latitude, longitude, compute):
+        """
+        The answer of one kind of query at a point.
+        On a miss, it is compute(grid latitude, grid longitude), and kept.
+        Answers are shared: callers must copy them before any change.
+        """
+        row, col = self.quantize(latitude, longitude)
+        key      = (kind, row, col)
+        now      = self.clock()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self.entries[key]
+                self._count('expirations')
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self._count('hits')
+                return entry[1]
+            self._count('misses')
+            generation = self.generation
+
+        # Computed outside the lock: other queries need not wait
+        answer = compute(row * self.precision, col * self.precision)
+        with self._lock:
+            if generation != self.generation:
+                return answer           # The tables changed meanwhile
+            self.entries[key] = (now, answer)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self._count('evictions')
+        return answer
+
+    def clear(self):
+        """ Forget every answer: call when the tables are reloaded """
+        with self._lock:
+            self.entries.clear()
+            self.generation = self.generation + 1
+
+    def stats(self):
+        """
+        A dict of entries (now cached), max_entries, hits, misses,
+        evictions, expirations, and hit_ratio
+        """
+        with self._lock:
+            output = {'entries': len(self.entries),
+                      'max_entries': self.max_entries}
+            for name in ('hits', 'misses', 'evictions', 'expirations'):
+                output[name] = self.counts[name]
+        lookups = output['hits'] + output['misses']
+        output['hit_ratio'] = output['hits'] / lookups if lookups else 0.0
+        return output
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+"""
+Record-level deltas between two versions of a weather location table
+
+nws_database_creator writes a content hash and a delta next to each CSV.
+A mirror or client that already has the previous CSV can download the
+small delta, and apply it instead of downloading the whole table again.
+
+A delta is a JSON object:
+    table      'radar', 'metar', or 'zone'
+    key        the ID field: 'Name' (radar, metar) or 'Zone'
+    fields     the CSV field names, in order
+    base       SHA-256 of the previous CSV (null if there was none)
+    hash       SHA-256 of the new CSV
+    added      new rows (dicts)
+    removed    IDs of the deleted rows
+    modified   changed rows (dicts, complete)
+
+The CSV is sorted by ID, so applying a delta to the base CSV reproduces
+the new CSV byte for byte. apply() checks both hashes.
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import io
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import csv
+import hashlib
+
+
+VERSION = 1
+
+
+def render(fieldnames, rows):
+    """ The CSV text of a table. Rows must already be sorted by ID """
+    csvfile = io.StringIO()
+    writer  = csv.DictWriter(csvfile, fieldnames=fieldnames,
+                             extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+    return csvfile.getvalue()
+
+
+def digest(text):
+    """ SHA-256 (hex) of a CSV text """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _keyed(text, key):
+    """ Parse a CSV text into {ID: row} """
+    if not text:
+        return {}
+    return dict((row[key], row) for row in csv.DictReader(io.StringIO(text)))
+
+
+def diff(table, key, fieldnames, old_text, new_text):
+    """
+    Compute the delta from old_text (None if there was no table) to
+    new_text. Output is the delta dict.
+    """
+    old_rows = _keyed(old_text, key)
+    new_rows = _keyed(new_text, key)
+    delta = {'version'  : VERSION,
+             'table'    : table,
+             'key'      : key,
+             'fields'   : list(fieldnames),
+             'base'     : digest(old_text) if old_text is not None else None,
+             'hash'     : digest(new_text),
+             'added'    : [],
+             'removed'  : [],
+             'modified' : []}
+    for sta_id in sorted(new_rows):
+        if sta_id not in old_rows:
+            delta['added'].append(new_rows[sta_id])
+        elif new_rows[sta_id] != old_rows[sta_id]:
+            delta['modified'].append(new_rows[sta_id])
+    delta['removed'] = sorted(set(old_rows) - set(new_rows))
+    return delta
+
+
+def apply(old_text, delta):
+    """
+    Apply a delta to the previous CSV text.
+    Output is the new CSV text.
+    Raises ValueError if old_text is not the delta's base, or if the
+    result does not match the delta's hash.
+    """
+    if delta.get('version') != VERSION:
+        raise ValueError("Unsupported delta version")
+    base = digest(old_text) if old_text is not None else None
+    if base != delta['base']:
+        raise ValueError("Delta does not apply to this version of the table")
+
+    key  = delta['key']
+    rows = _keyed(old_text, key)
+    for sta_id in delta['removed']:
+        rows.pop(sta_id, None)
+    for row in delta['added'] + delta['modified']:
+        rows[row[key]] = row
+
+    new_text = render(delta['fields'],
+                      [rows[sta_id] for sta_id in sorted(rows)])
+    if digest(new_text) != delta['hash']:
+        raise ValueError("Delta result does not match the expected hash")
+    return new_text
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+
+"""
+Bulk geocoding: assign the nearest radar, METAR station, and zone to
+every row of a CSV file
+
+The tables are loaded once, in the main process. Their coordinates are
+copied into multiprocessing.shared_memory blocks, and each worker process
+attaches to those blocks and builds its own SphereIndex from them, once,
+in its initializer. Tables are never pickled: only the coordinates of
+each chunk of input go to a worker, and only row positions come back.
+
+The input is streamed, CHUNK rows at a time. A few chunks per worker are
+in flight at once, and the output is written in input order, so memory
+use stays flat whatever the size of the input.
+
+Output is the input CSV, with three columns added: Radar, Observation,
+and Zone (station IDs, blank when the row has no usable lat/lon).
+
+Script usage:
+    python3 weather_geocode.py devices.csv geocoded.csv
+    python3 weather_geocode.py --lat latitude --lon longitude \\
+        --processes 8 --tables ~/uploads/data devices.csv -
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+import sys
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import argparse
+import collections
+import csv
+import multiprocessing
+import multiprocessing.shared_memory
+from array import array
+
+# Other modules of this project
+import closest_weather_location
+from weather_index import SphereIndex, coordinate
+
+
+CHUNK   = 10000     # Input rows per task
+AHEAD   = 2         # Tasks in flight per worker process
+COLUMNS = (('Radar', 'radar'), ('Observation', 'metar'), ('Zone', 'zone'))
+
+_INDEXES = {}       # Worker process: table name -> SphereIndex
+
+
+
+class _Columns(object):
+    """
+    The shared coordinate columns of one table, in a worker process.
+    SphereIndex.load_columns() reads them in place. Its rows are the row
+    positions in the main process's table.
+    """
+    def __init__(self, latitudes, longitudes):
+        self.latitudes  = latitudes
+        self.longitudes = longitudes
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self.latitudes):
+            raise IndexError("table row out of range")
+        return position
+
+
+
+def _coordinates(table):
+    """ The lat and lon columns of a table, as array('d'), NaN if missing """
+    if hasattr(table, 'latitudes'):
+        return (array('d', table.latitudes), array('d', table.longitudes))
+    latitudes  = array('d')
+    longitudes = array('d')
+    for row in table:
+        for column, field in ((latitudes, 'Latitude'),
+                              (longitudes, 'Longitude')):
+            value = coordinate(row[field])
+            column.append(float('nan') if value is None else value)
+    return (latitudes, longitudes)
+
+
+def _share(values):
+    """ Copy an array into a new shared memory block """
+    block = multiprocessing.shared_memory.SharedMemory(
+        create=True, size=max(len(values) * values.itemsize, 1))
+    block.buf[:len(values) * values.itemsize] = values.tobytes()
+    return block
+
+
+def _attach(name, length):
+    """ A worker's float64 view of a shared memory block """
+    # Pool workers share the main process's resource tracker, so the
+    # block is still unlinked only once, by the main process
+    block = multiprocessing.shared_memory.SharedMemory(name=name)
+    return block, block.buf[:8 * length].cast('d')
+
+
+def _initialize(shared):
+    """
+    Worker initializer: attach to the shared coordinate blocks, and build
+    one SphereIndex per table.
+    Input: {table name: (lat block name, lon block name, rows)}
+    """
+    for name, (lat_name, lon_name, length) in shared.items():
+        lat_block, latitudes  = _attach(lat_name, length)
+        lon_block, longitudes = _attach(lon_name, length)
+        index = SphereIndex(_Columns(latitudes, longitudes))
+        # Keep the blocks open as long as the index uses their memory
+        index.blocks = (lat_block, lon_block)
+        _INDEXES[name] = index
+
+
+def _resolve(points):
+    """
+    Worker task: the nearest row of each table, for a chunk of points.
+    Input: an array('d') of lat, lon pairs (NaN for unusable rows)
+    Output: {table name: array('l') of row positions, -1 for none}
+    """
+    output = {}
+    for name, index in _INDEXES.items():
+        positions = array('l')
+        for offset in range(0, len(points), 2):
+            lat, lon = points[offset], points[offset + 1]
+            if lat != lat or lon != lon:        # NaN
+                positions.append(-1)
+                continue
+            position = index.query(lat, lon)[0]
+            positions.append(index.rows[position] if position >= 0 else -1)
+        output[name] = positions
+    return output
+
+
+
+def _chunks(reader, lat_field, lon_field, size):
+    """ Yield (rows, array('d') of lat, lon pairs) for each chunk of input """
+    rows   = []
+    points = array('d')
+    for row in reader:
+        lat = coordinate(row.get(lat_field))
+        lon = coordinate(row.get(lon_field))
+        if lat is None or lon is None \
+        or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            lat = lon = float('nan')
+        rows.append(row)
+        points.append(lat)
+        points.append(lon)
+        if len(rows) >= size:
+            yield (rows, points)
+            rows   = []
+            points = array('d')
+    if rows:
+        yield (rows, points)
+
+
+def geocode(infile, outfile, tables, lat_field='lat', lon_field='lon',
+            processes=None, chunk=CHUNK):
+    """
+    Geocode a CSV stream into another.
+    Input: open text files, and {table name: table} for 'radar', 'metar',
+           and 'zone'. Each table is a Snapshot, or a list of rows.
+    Output is the number of rows written.
+    """
+    processes = processes or os.cpu_count() or 1
+    reader    = csv.DictReader(infile)
+    if reader.fieldnames is None:
+        return 0
+    if lat_field not in reader.fieldnames \
+    or lon_field not in reader.fieldnames:
+        raise ValueError("The input has no {} and {} columns"
+                         .format(lat_field, lon_field))
+    writer = csv.DictWriter(outfile, fieldnames=list(reader.fieldnames)
+                            + [column for column, name in COLUMNS])
+    writer.writeheader()
+
+    ids    = {}
+    blocks = []
+    shared = {}
+    try:
+        for column, name in COLUMNS:
+            table = tables[name]
+            key   = closest_weather_location.KEYS[name]
+            if hasattr(table, 'field'):
+                ids[name] = [table.field(key, position)
+                             for position in range(len(table))]
+            else:
+                ids[name] = [row[key] for row in table]
+            latitudes, longitudes = _coordinates(table)
+            blocks.append(_share(latitudes))
+            blocks.append(_share(longitudes))
+            shared[name] = (blocks[-2].name, blocks[-1].name, len(latitudes))
+
+        written = 0
+        with multiprocessing.Pool(processes, _initialize, (shared,)) as pool:
+            pending = collections.deque()
+            chunks  = _chunks(reader, lat_field, lon_field, chunk)
+            while True:
+                while len(pending) < processes * AHEAD:
+                    rows_points = next(chunks, None)
+                    if rows_points is None:
+                        break
+                    pending.append((rows_points[0], pool.apply_async(
+                        _resolve, (rows_points[1],))))
+                if not pending:
+                    break
+                rows, result = pending.popleft()
+                answers = result.get()
+                for offset, row in enumerate(rows):
+                    for column, name in COLUMNS:
+                        position = answers[name][offset]
+                        row[column] = ids[name][position] \
+                            if position >= 0 else ''
+                writer.writerows(rows)
+                written = written + len(rows)
+        return written
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def load_tables(directory=None):
+    """
+    The radar, metar, and zone tables: the CSVs in a local directory (like
+    nws_database_creator writes), or else downloaded together (see
+    load_all)
+    """
+    if directory is None:
+        return closest_weather_location.load_all([name for column, name
+                                                  in COLUMNS])
+    tables = {}
+    for column, name in COLUMNS:
+        with open(os.path.join(directory, name + '.csv'), 'r') as csvfile:
+            tables[name] = list(csv.DictReader(csvfile))
+    return tables
+
+
+def run(argv=None):
+    """ Command line """
+    parser = argparse.ArgumentParser(description="Assign the nearest radar, "
+                                     "METAR station, and zone to each row "
+                                     "of a CSV file")
+    parser.add_argument('input', help="Input CSV file ('-' for stdin)")
+    parser.add_argument('output', help="Output CSV file ('-' for stdout)")
+    parser.add_argument('--lat', default='lat', help="Latitude column")
+    parser.add_argument('--lon', default='lon', help="Longitude column")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Worker processes (default: one per core)")
+    parser.add_argument('--chunk', type=int, default=CHUNK,
+                        help="Rows per task")
+    parser.add_argument('--tables', default=None,
+                        help="Directory of radar.csv, metar.csv, zone.csv "
+                             "(default: download them)")
+    args = parser.parse_args(argv)
+
+    tables  = load_tables(args.tables)
+    infile  = sys.stdin if args.input == '-' \
+        else open(args.input, 'r', newline='')
+    outfile = sys.stdout if args.output == '-' \
+        else open(args.output, 'w', newline='')
+    try:
+        geocode(infile, outfile, tables, args.lat, args.lon,
+                args.processes, args.chunk)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+"""
+Shared HTTP session for every download of the weather tools
+
+An httplib2.Http keeps its connections open (keep-alive), but it is not
+thread-safe, and every fetch used to create its own, so no connection was
+ever reused. A Session keeps a pool of idle httplib2.Http objects per
+host instead: a request checks one out, and returns it when done, so the
+next request to that host reuses its open connection.
+
+Every request:
+- asks for a gzip-compressed response (httplib2 decompresses it)
+- has a timeout (TIMEOUT seconds, per socket operation)
+- is retried up to RETRIES times on a network or timeout error, or on
+  a status in RETRY_STATUS, after a random (jittered) exponential
+  backoff. Other httplib2 errors are raised at once.
+
+Requests, retries, bytes, compressed and cached responses, and opened and
+reused connections are counted per host, in Session.counts and in
+weather_metrics.METRICS (as http_*_total). Bytes are those received over
+the network, before decompression: responses from the cache add none.
+A source whose download failed is counted per source, by failed().
+
+Use session(cache) to share one Session per cache directory.
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import threading
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import collections
+import random
+import socket
+import time
+
+# Other Python packages
+import httplib2      # (Debian package python3-httplib2)
+
+# Other modules of this project
+import weather_metrics
+
+
+TIMEOUT      = 30           # Seconds, per socket operation
+RETRIES      = 3            # Retries after the first attempt
+BACKOFF      = 0.5          # Seconds. Doubled for each retry, then jittered
+BACKOFF_MAX  = 30           # Seconds
+RETRY_STATUS = (429, 500, 502, 503, 504)
+IDLE_MAX     = 4            # Idle httplib2.Http kept per host
+
+_SESSIONS = {}              # Cache directory -> Session
+_LOCK     = threading.Lock()
+
+
+
+class _Counting(object):
+    """
+    Connection mixin: received counts the response body bytes read from
+    the network, before httplib2 decompresses them
+    """
+    received = 0
+
+    def getresponse(self):
+        response = super(_Counting, self).getresponse()
+        read     = response.read
+
+        def counted(*args):
+            """ HTTPResponse.read(), counted """
+            data = read(*args)
+            self.received = self.received + len(data)
+            return data
+
+        response.read = counted
+        return response
+
+
+class _CountingHTTP(_Counting, httplib2.HTTPConnectionWithTimeout):
+    pass
+
+
+class _CountingHTTPS(_Counting, httplib2.HTTPSConnectionWithTimeout):
+    pass
+
+
+CONNECTIONS = {'http': _CountingHTTP, 'https': _CountingHTTPS}
+
+
+
+class Session(object):
+    """
+    Thread-safe, pooled, retrying HTTP client
+    - request() has the signature and output of httplib2.Http.request()
+    - Idle httplib2.Http objects are pooled per scheme and host, with
+      their keep-alive connections
+    """
+    def __init__(self, cache=None, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, sleep=time.sleep):
+        """ sleep is the backoff wait, replaceable for tests """
+        self.cache   = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep   = sleep
+        self.counts  = collections.Counter()   # (name, host) -> count
+        self._idle   = {}                      # 'scheme:host' -> [Http]
+        self._lock   = threading.Lock()
+
+    def _count(self, name, host, amount=1):
+        """ Count in this session, and in weather_metrics.METRICS """
+        with self._lock:
+            self.counts[(name, host)] += amount
+        weather_metrics.METRICS.count('http_' + name + '_total', amount,
+                                      host=host)
+
+    def failed(self, source):
+        """
+        Count a source (a table, not a host) that could not be downloaded,
+        once its requests have run out of retries: in this session as
+        ('source_failures', source), and in weather_metrics.METRICS as
+        http_source_failures_total
+        """
+        with self._lock:
+            self.counts[('source_failures', source)] += 1
+        weather_metrics.METRICS.count('http_source_failures_total',
+                                      source=source)
+
+    def _checkout(self, conn_key):
+        """ An idle Http for one host, or a new one """
+        with self._lock:
+            idle = self._idle.get(conn_key)
+            if idle:
+                return idle.pop()
+        return httplib2.Http(self.cache, timeout=self.timeout)
+
+    def _checkin(self, conn_key, http):
+        """ Return an Http to the pool, with its open connection """
+        with self._lock:
+            idle = self._idle.setdefault(conn_key, [])
+            if len(idle) < IDLE_MAX:
+                idle.append(http)
+                return
+        http.close()
+
+    def close(self):
+        """ Close every pooled connection """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for pool in idle.values():
+            for http in pool:
+                http.close()
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        """
+        Send a request. Output is a tuple of (response, content), like
+        httplib2.Http.request().
+        After the last retry, a network error is raised, and a retryable
+        status is returned. Any other httplib2.HttpLib2Error is raised
+        without a retry.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('accept-encoding', 'gzip')
+        scheme, host = httplib2.urlnorm(uri)[:2]
+        conn_key = scheme + ':' + host
+
+        attempt = 0
+        while True:
+            http     = self._checkout(conn_key)
+            before   = http.connections.get(conn_key)
+            received = getattr(before, 'received', 0)
+            try:
+                resp, content = http.request(
+                    uri, method, body=body, headers=headers,
+                    connection_type=CONNECTIONS.get(scheme))
+            except (OSError, socket.timeout, httplib2.ServerNotFoundError):
+                http.close()
+                if attempt >= self.retries:
+                    self._count('errors', host)
+                    raise
+            except httplib2.HttpLib2Error:
+                # Not transient (a bad URI, a redirect without a location):
+                # a retry would fail the same way
+                http.close()
+                self._count('errors', host)
+                raise
+            else:
+                self._count('requests', host)
+                conn = http.connections.get(conn_key)
+                if conn is not before:
+                    received = 0                # A new connection
+                if resp.fromcache:
+                    self._count('cached', host)
+                elif before is not None and conn is before:
+                    self._count('connections_reused', host)
+                else:
+                    self._count('connections_opened', host)
+                if resp.get('-content-encoding') == 'gzip':
+                    self._count('compressed', host)
+                if not resp.fromcache:
+                    self._count('bytes', host,
+                                getattr(conn, 'received', 0) - received)
+                self._checkin(conn_key, http)
+                if resp.status not in RETRY_STATUS \
+                or attempt >= self.retries:
+                    return (resp, content)
+
+            # Full jitter: a random wait, up to the exponential backoff
+            attempt = attempt + 1
+            self._count('retries', host)
+            self.sleep(random.uniform(0, min(BACKOFF_MAX,
+                                             self.backoff * 2 ** attempt)))
+
+
+
+def session(cache=None):
+    """ The shared Session for one httplib2 cache directory """
+    with _LOCK:
+        if cache not in _SESSIONS:
+            _SESSIONS[cache] = Session(cache)
+        return _SESSIONS[cache]
@@ -0,0 +1,492 @@
+#!/usr/bin/python3
+
+"""
+Spatial index for the weather location tables
+
+Every radar, METAR station, and forecast zone is placed on the unit sphere
+as a 3D vector. Those vectors are stored in a k-d tree, so the nearest
+location to any point on Earth is found in O(log n) without scanning the
+whole table.
+
+Straight-line (chord) distance between unit vectors increases with the
+great-circle distance, so the nearest vector is also the nearest station.
+There are no special cases at the poles or across the antimeridian.
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import math
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import heapq
+import itertools
+from array import array
+
+# Other Python packages
+numpy = None        # (Debian package python3-numpy) Only for batch lookups.
+                    # Imported on first use (see require_numpy): it is slow
+                    # to load
+
+
+RADIUS         = 6371       # km
+CHUNK_CELLS    = 4000000    # Batch lookups: query points x stations per chunk
+PRUNE_STATIONS = 1000       # Batch lookups: tables this large are matched
+PRUNE_DEGREES  = 4.0        # per grid cell of query points, this size
+
+
+def require_numpy():
+    """
+    Import numpy, once, for the modules of this project that use it.
+    Raises RuntimeError if it is not installed.
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            raise RuntimeError("Batch lookups require numpy")
+        numpy = module
+    return numpy
+
+
+def unit_vector(latitude, longitude):
+    """ Convert a lat/lon (degrees) into an (x, y, z) unit sphere point """
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord_squared):
+    """ Convert a squared chord length on the unit sphere into kilometers """
+    half_chord = min(math.sqrt(chord_squared) / 2, 1.0)
+    return 2 * RADIUS * math.asin(half_chord)
+
+
+def km_to_chord(kilometers):
+    """ Convert kilometers into a squared chord length on the unit sphere """
+    if kilometers >= math.pi * RADIUS:
+        return 4.0
+    return (2 * math.sin(max(kilometers, 0) / (2 * RADIUS))) ** 2
+
+
+def coordinate(value, missing=None):
+    """
+    Convert a table Latitude or Longitude (text, bytes, or number) into a
+    float. Blank, unparseable, and non-finite values return missing.
+    """
+    if isinstance(value, float):
+        return value if math.isfinite(value) else missing
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return missing
+    return value if math.isfinite(value) else missing
+
+
+
+class SphereIndex(object):
+    """
+    Nearest-location index over one weather table (radar, metar, or zone)
+    - Keep the usable rows, and their coordinates as float arrays
+    - Build a k-d tree over the unit vectors of those coordinates
+    - Answer exact nearest-neighbor queries anywhere on the globe
+    """
+    def __init__(self, many_locations):
+        """ Parse the table once, and build the tree """
+        self.rows       = []
+        self.latitudes  = array('d')
+        self.longitudes = array('d')
+        if hasattr(many_locations, 'latitudes'):
+            self.load_columns(many_locations)
+        else:
+            self.load_rows(many_locations)
+
+        self._order = array('l')   # Tree slot -> row position
+        self._axis  = array('b')   # Tree slot -> split axis
+        self._x     = array('d')   # Tree slot -> unit vector
+        self._y     = array('d')
+        self._z     = array('d')
+        self.build()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def load_rows(self, many_locations):
+        """ Keep the rows with usable coordinates, parsing the text """
+        for loc in many_locations:
+            lat = coordinate(loc['Latitude'])
+            lon = coordinate(loc['Longitude'])
+            if lat is None or lon is None:
+                continue
+            self.rows.append(loc)
+            self.latitudes.append(lat)
+            self.longitudes.append(lon)
+
+    def load_columns(self, table):
+        """
+        Use a table that already has float coordinate columns, such as a
+        weather_snapshot.Snapshot. If every coordinate is usable, the
+        columns and the table itself are used in place, without copying.
+        """
+        usable = [position for position, (lat, lon)
+                  in enumerate(zip(table.latitudes, table.longitudes))
+                  if math.isfinite(lat) and math.isfinite(lon)]
+        if len(usable) == len(table):
+            self.rows       = table
+            self.latitudes  = table.latitudes
+            self.longitudes = table.longitudes
+            return
+        for position in usable:
+            self.rows.append(table[position])
+            self.latitudes.append(table.latitudes[position])
+            self.longitudes.append(table.longitudes[position])
+
+    def build(self):
+        """
+        Lay the tree out implicitly: the range [lo, hi) is rooted at its
+        middle slot, with the left subtree below it and the right above.
+        Each node splits on the axis where its points are most spread out.
+        """
+        points = [unit_vector(lat, lon)
+                  for lat, lon in zip(self.latitudes, self.longitudes)]
+        order  = list(range(len(points)))
+        axes   = [0] * len(points)
+
+        stack  = [(0, len(order))]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo < 1:
+                continue
+            spread = []
+            for axis in range(3):
+                values = [points[i][axis] for i in order[lo:hi]]
+                spread.append(max(values) - min(values))
+            axis = spread.index(max(spread))
+            order[lo:hi] = sorted(order[lo:hi], key=lambda i: points[i][axis])
+            mid = (lo + hi) // 2
+            axes[mid] = axis
+            stack.append((lo, mid))
+            stack.append((mid + 1, hi))
+
+        self._order = array('l', order)
+        self._axis  = array('b', axes)
+        self._x     = array('d', [points[i][0] for i in order])
+        self._y     = array('d', [points[i][1] for i in order])
+        self._z     = array('d', [points[i][2] for i in order])
+
+    def query(self, latitude, longitude, exclude=-1, stats=None):
+        """
+        Find the nearest row to the lat/lon.
+        Output is a tuple of (row position, distance in km).
+        The position is -1 if the table is empty.
+        The row at position exclude (if any) is skipped: query once, then
+        exclude the answer to find the runner-up.
+        If stats is a dict, the work done is added to it: 'evaluations'
+        (distances computed) and 'pruned' (subtrees skipped).
+        """
+        qxyz    = unit_vector(latitude, longitude)
+        xyz     = (self._x, self._y, self._z)
+        best    = -1
+        best_d2 = 5.0   # Larger than any squared chord (max 4.0)
+        visited = 0
+        pruned  = 0
+
+        stack   = [(0, len(self._order), 0.0)]
+        while stack:
+            lo, hi, bound = stack.pop()
+            if hi <= lo:
+                continue
+            if bound >= best_d2:
+                pruned = pruned + 1
+                continue
+            visited = visited + 1
+            mid = (lo + hi) // 2
+            dx = self._x[mid] - qxyz[0]
+            dy = self._y[mid] - qxyz[1]
+            dz = self._z[mid] - qxyz[2]
+            d2 = dx * dx + dy * dy + dz * dz
+            if d2 < best_d2 and self._order[mid] != exclude:
+                best_d2 = d2
+                best    = mid
+
+            axis = self._axis[mid]
+            diff = qxyz[axis] - xyz[axis][mid]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            # Push the far side first, so the near side is searched first
+            stack.append((far[0], far[1], diff * diff))
+            stack.append((near[0], near[1], 0.0))
+
+        if stats is not None:
+            stats['evaluations'] = stats.get('evaluations', 0) + visited
+            stats['pruned']      = stats.get('pruned', 0) + pruned
+        if best < 0:
+            return (-1, None)
+        return (self._order[best], chord_to_km(best_d2))
+
+    def nearest(self, latitude, longitude, stats=None):
+        """
+        Find the nearest row to the lat/lon.
+        Output is a tuple of (row, distance in km), or (None, None)
+        stats: see query()
+        """
+        position, kilometers = self.query(latitude, longitude, stats=stats)
+        if position < 0:
+            return (None, None)
+        return (self.rows[position], kilometers)
+
+    def iter_query(self, latitude, longitude, max_km=None):
+        """
+        Yield (row position, distance in km) for every row, nearest first,
+        out to max_km (if given).
+        The tree is searched best-first: a heap holds the subtrees and rows
+        not yet visited, ordered by their least possible distance. A row
+        is yielded only once nothing left in the heap can be closer, so the
+        order is exact without sorting the table. Work stops as soon as the
+        caller stops iterating.
+        """
+        qxyz    = unit_vector(latitude, longitude)
+        xyz     = (self._x, self._y, self._z)
+        limit   = 4.0 if max_km is None else km_to_chord(max_km)
+        counter = itertools.count()     # Tie-breaker, for stable ordering
+
+        # Heap entries: (squared chord bound, tie-breaker, lo, hi)
+        # A row is pushed as (exact squared chord, tie-breaker, slot, -1)
+        heap = [(0.0, next(counter), 0, len(self._order))]
+        while heap:
+            d2, _, lo, hi = heapq.heappop(heap)
+            if hi < 0:
+                yield (self._order[lo], chord_to_km(d2))
+                continue
+            if hi <= lo:
+                continue
+            mid = (lo + hi) // 2
+            dx = self._x[mid] - qxyz[0]
+            dy = self._y[mid] - qxyz[1]
+            dz = self._z[mid] - qxyz[2]
+            point_d2 = dx * dx + dy * dy + dz * dz
+            if point_d2 <= limit:
+                heapq.heappush(heap, (point_d2, next(counter), mid, -1))
+
+            axis = self._axis[mid]
+            diff = qxyz[axis] - xyz[axis][mid]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            far_d2 = max(d2, diff * diff)
+            if near[0] < near[1]:
+                heapq.heappush(heap, (d2, next(counter), near[0], near[1]))
+            if far[0] < far[1] and far_d2 <= limit:
+                heapq.heappush(heap, (far_d2, next(counter), far[0], far[1]))
+
+    def nearest_k(self, latitude, longitude, k):
+        """
+        Yield the k nearest rows, nearest first, as (row, distance in km)
+        Lazy: stop iterating early, and the rest is never computed.
+        """
+        for position, kilometers in itertools.islice(
+                self.iter_query(latitude, longitude), k):
+            yield (self.rows[position], kilometers)
+
+    def within_radius(self, latitude, longitude, kilometers):
+        """
+        Yield every row within the radius, nearest first,
+        as (row, distance in km). Lazy, like nearest_k().
+        """
+        for position, distance in self.iter_query(latitude, longitude,
+                                                  kilometers):
+            if distance > kilometers:    # Rounding at the edge
+                break
+            yield (self.rows[position], distance)
+
+
+
+def nearest_row(many_locations, latitude, longitude):
+    """
+    Find the nearest row of a table that is searched only once, by an
+    exact linear scan: building a SphereIndex costs far more than one scan.
+    Input: any iterable of rows, or a table with float coordinate columns
+           (like a weather_snapshot.Snapshot)
+    Output is a tuple of (row, distance in km), or (None, None)
+    """
+    p_x, p_y, p_z = unit_vector(latitude, longitude)
+    closest = None
+    nearest = None
+    if hasattr(many_locations, 'latitudes'):
+        points = enumerate(zip(many_locations.latitudes,
+                               many_locations.longitudes))
+    else:
+        points = ((loc, (coordinate(loc['Latitude']),
+                         coordinate(loc['Longitude'])))
+                  for loc in many_locations)
+    for loc, (lat, lon) in points:
+        if lat is None or lon is None \
+        or not (math.isfinite(lat) and math.isfinite(lon)):
+            continue
+        x, y, z = unit_vector(lat, lon)
+        chord   = (x - p_x) ** 2 + (y - p_y) ** 2 + (z - p_z) ** 2
+        if nearest is None or chord < nearest:
+            closest = loc
+            nearest = chord
+    if closest is None:
+        return (None, None)
+    if hasattr(many_locations, 'latitudes'):
+        closest = many_locations[closest]
+    return (closest, chord_to_km(nearest))
+
+
+
+def nearby_stations(radars, metars, latitude, longitude, count,
+                    exclude=None):
+    """
+    The nearest radar, and the count nearest METAR stations, of a point.
+    Input: the radar and METAR SphereIndex, the lat/lon, and (optional)
+           the METAR station ID to leave out (a station's own)
+    Output is a dict like a row of the join tables: Radar, Radar_km,
+    Metar_1, Metar_1_km, ... Distances are km, rounded to 0.1.
+    """
+    output = {}
+    radar, kilometers = radars.nearest(latitude, longitude)
+    if radar is not None:
+        output['Radar']    = radar['Name']
+        output['Radar_km'] = round(kilometers, 1)
+    rank = 0
+    for metar, kilometers in metars.nearest_k(latitude, longitude,
+                                              count + 1):
+        if metar['Name'] == exclude:
+            continue
+        rank = rank + 1
+        if rank > count:
+            break
+        output['Metar_{}'.format(rank)]    = metar['Name']
+        output['Metar_{}_km'.format(rank)] = round(kilometers, 1)
+    return output
+
+
+
+def nearest_many(index, latitudes, longitudes, chunk_size=None):
+    """
+    Batch lookup: find the nearest row of one SphereIndex for many points.
+    Input: a SphereIndex, and equal-length arrays of query lat/lon (degrees)
+    Output is a tuple of numpy arrays: (row positions, distances in km).
+    Positions are -1 (and distances NaN) if the table is empty, and for
+    query points that are not finite (NaN, inf).
+
+    The closest station has the largest dot product with the query unit
+    vector, so a group of points is matched by a single matrix multiply.
+    With PRUNE_STATIONS stations or more, the points are first grouped by
+    a PRUNE_DEGREES lat/lon grid cell, and each group is matched only
+    against its candidates (see _candidates), not the whole table.
+    Each multiply is done in chunks, so that the (points x stations) work
+    matrix never holds more than about CHUNK_CELLS values. The haversine
+    distance is then computed only for the winners.
+    """
+    numpy = require_numpy()
+    q_lat = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    q_lon = numpy.radians(numpy.asarray(longitudes, dtype=numpy.float64))
+    if q_lat.shape != q_lon.shape or q_lat.ndim != 1:
+        raise ValueError("latitudes and longitudes must be 1-D, same length")
+
+    positions = numpy.full(q_lat.shape, -1, dtype=numpy.int64)
+    distances = numpy.full(q_lat.shape, numpy.nan)
+    if len(index) == 0 or len(q_lat) == 0:
+        return (positions, distances)
+
+    s_lat = numpy.radians(numpy.frombuffer(index.latitudes, numpy.float64))
+    s_lon = numpy.radians(numpy.frombuffer(index.longitudes, numpy.float64))
+    s_cos = numpy.cos(s_lat)
+    stations = numpy.stack((s_cos * numpy.cos(s_lon),
+                            s_cos * numpy.sin(s_lon),
+                            numpy.sin(s_lat)))          # Shape (3, stations)
+
+    # Unusable query points are searched as (0, 0), then reported as -1
+    usable  = numpy.isfinite(q_lat) & numpy.isfinite(q_lon)
+    q_lat   = numpy.where(usable, q_lat, 0.0)
+    q_lon   = numpy.where(usable, q_lon, 0.0)
+    cos_lat = numpy.cos(q_lat)
+    points  = numpy.stack((cos_lat * numpy.cos(q_lon),
+                           cos_lat * numpy.sin(q_lon),
+                           numpy.sin(q_lat)), axis=1)    # Shape (points, 3)
+
+    winners = numpy.empty(q_lat.shape, dtype=numpy.int64)
+    if len(index) < PRUNE_STATIONS \
+    or len(q_lat) * len(index) <= CHUNK_CELLS:
+        _match(numpy, points, numpy.arange(len(q_lat)), stations, None,
+               winners, chunk_size)
+    else:
+        for group in _grid_groups(numpy, q_lat, q_lon):
+            _match(numpy, points, group, stations,
+                   _candidates(numpy, points[group], stations), winners,
+                   chunk_size)
+
+    positions = numpy.where(usable, winners, -1)
+    distances = numpy.where(
+        usable, haversine_many(q_lat, q_lon, s_lat[winners], s_lon[winners]),
+        numpy.nan)
+    return (positions, distances)
+
+
+def _grid_groups(numpy, q_lat, q_lon):
+    """
+    The query points, grouped by PRUNE_DEGREES lat/lon grid cell
+    Output is a list of arrays of point positions, one per occupied cell
+    """
+    step  = math.radians(PRUNE_DEGREES)
+    cols  = int(math.ceil(2 * math.pi / step)) + 1
+    cells = (numpy.floor((q_lat + math.pi / 2) / step) * cols
+             + numpy.floor((q_lon + math.pi) / step))
+    order = numpy.argsort(cells, kind='stable')
+    edges = numpy.flatnonzero(numpy.diff(cells[order])) + 1
+    return numpy.split(order, edges)
+
+
+def _candidates(numpy, group, stations):
+    """
+    The stations that can be nearest to any point of a group: all those
+    within angle best + 2 * spread of the group's center, where best is
+    the angle from the center to its nearest station, and spread is the
+    largest angle from the center to a point of the group. (Any station
+    farther out is farther from every point than that nearest station.)
+    Input: the group's unit vectors (points, 3), and stations (3, stations)
+    Output is an ascending array of station columns, or None for all
+    """
+    center = group.sum(axis=0)
+    norm   = numpy.linalg.norm(center)
+    center = center / norm if norm > 1e-9 else group[0]
+    spread = numpy.arccos(numpy.clip((group @ center).min(), -1.0, 1.0))
+    dots   = center @ stations
+    best   = numpy.arccos(numpy.clip(dots.max(), -1.0, 1.0))
+    limit  = best + 2 * spread + 1e-6       # Rounding of arccos near 0
+    if limit >= math.pi:
+        return None
+    return numpy.flatnonzero(dots >= math.cos(limit))
+
+
+def _match(numpy, points, group, stations, candidates, winners, chunk_size):
+    """
+    Set winners[group] to the station column with the largest dot product
+    with each point of the group, among the candidates (None for all)
+    """
+    if candidates is not None:
+        stations = stations[:, candidates]
+    size = chunk_size or max(1, CHUNK_CELLS // stations.shape[1])
+    for start in range(0, len(group), size):
+        chunk = group[start:start + size]
+        best  = numpy.argmax(points[chunk] @ stations, axis=1)
+        winners[chunk] = best if candidates is None else candidates[best]
+
+
+def haversine_many(a_lat, a_lon, b_lat, b_lon):
+    """
+    The haversine formula over whole numpy arrays.
+    Input: four arrays of lat/lon, in radians
+    Output is an array of the distances in km.
+    """
+    numpy    = require_numpy()
+    sin_dlat = numpy.sin((b_lat - a_lat) / 2)
+    sin_dlon = numpy.sin((b_lon - a_lon) / 2)
+    aaa = sin_dlat * sin_dlat \
+        + numpy.cos(a_lat) * numpy.cos(b_lat) * sin_dlon * sin_dlon
+    return 2 * RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(aaa, 0.0, 1.0)))
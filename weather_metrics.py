@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+"""
+Timers, counters, and an opt-in profiler for the weather tools
+
+nws_database_creator times every fetch, parse, and write stage, and
+closest_weather_location (if BEST_METRICS is set) counts the work each
+best() lookup does. Both record into METRICS, the shared registry of this
+module.
+
+Metrics have a name, and (optional) labels, like
+    METRICS.count('parsed_rows_total', 120, table='radar')
+    with METRICS.timer('fetch_seconds', source='Radar'):
+        ...
+A timer records how many times it ran, the total, and the longest time.
+
+Output is JSON (to_json), or the Prometheus text format (to_prometheus),
+so a cron job can write the build's metrics where a node exporter's
+textfile collector picks them up.
+
+profiled() runs a block under cProfile, only when given a path (or when
+the WEATHER_PROFILE environment variable names one).
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+import threading
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import contextlib
+import cProfile
+import json
+import time
+
+
+PREFIX = 'weather_'     # Prometheus metric name prefix
+
+
+def _key(name, labels):
+    """ Registry key of one metric: (name, sorted label items) """
+    return (name, tuple(sorted(labels.items())))
+
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters, gauges, and timers
+    """
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self.counters = {}      # (name, labels) -> number
+        self.gauges   = {}      # (name, labels) -> number
+        self.timers   = {}      # (name, labels) -> [count, total s, max s]
+
+    def reset(self):
+        """ Forget every metric """
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+
+    def count(self, name, amount=1, **labels):
+        """ Add amount to a counter """
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def value(self, name, **labels):
+        """ The current value of a counter (0 if never counted) """
+        return self.counters.get(_key(name, labels), 0)
+
+    def gauge(self, name, value, **labels):
+        """ Set a gauge: a value that goes up and down """
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def add_time(self, name, seconds, **labels):
+        """ Record one run of a timed stage """
+        key = _key(name, labels)
+        with self._lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] = timer[0] + 1
+            timer[1] = timer[1] + seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Time a with block. Failed runs are recorded, too """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        All metrics, as a dict ready for json.dumps:
+        {'counters': [...], 'gauges': [...], 'timers': [...]}
+        Each entry has the name, labels, and value (timers: count,
+        sum and max seconds).
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges   = sorted(self.gauges.items())
+            timers   = sorted((key, list(value))
+                              for key, value in self.timers.items())
+        return {'counters': [{'name': name, 'labels': dict(labels),
+                              'value': value}
+                             for (name, labels), value in counters],
+                'gauges'  : [{'name': name, 'labels': dict(labels),
+                              'value': value}
+                             for (name, labels), value in gauges],
+                'timers'  : [{'name': name, 'labels': dict(labels),
+                              'count': count, 'sum': total, 'max': longest}
+                             for (name, labels), (count, total, longest)
+                             in timers]}
+
+    def to_json(self):
+        """ All metrics, as JSON text """
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+    def to_prometheus(self, prefix=PREFIX):
+        """
+        All metrics, in the Prometheus text exposition format.
+        Timers are summaries: <name>_count and <name>_sum, plus a
+        <name>_max gauge.
+        """
+        snapshot = self.snapshot()
+        lines    = []
+        typed    = set()
+
+        def sample(name, kind, labels, value, family=None):
+            """ One line, after the # TYPE line of its metric family """
+            family = family or name
+            if family not in typed:
+                lines.append('# TYPE {} {}'.format(family, kind))
+                typed.add(family)
+            text = ','.join('{}="{}"'.format(label, str(labels[label])
+                                             .replace('\\', '\\\\')
+                                             .replace('"', '\\"'))
+                            for label in sorted(labels))
+            lines.append('{}{} {!r}'.format(name, '{' + text + '}' if text
+                                            else '', float(value)))
+
+        for metric in snapshot['counters']:
+            sample(prefix + metric['name'], 'counter', metric['labels'],
+                   metric['value'])
+        for metric in snapshot['gauges']:
+            sample(prefix + metric['name'], 'gauge', metric['labels'],
+                   metric['value'])
+        for metric in snapshot['timers']:
+            name = prefix + metric['name']
+            sample(name + '_count', 'summary', metric['labels'],
+                   metric['count'], family=name)
+            sample(name + '_sum', 'summary', metric['labels'], metric['sum'],
+                   family=name)
+        for metric in snapshot['timers']:
+            sample(prefix + metric['name'] + '_max', 'gauge',
+                   metric['labels'], metric['max'])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write all metrics to a file: Prometheus text if the path ends in
+        .prom, otherwise JSON. The file is replaced at once, so a
+        collector never reads it half written.
+        """
+        if path.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+        with open(path + '.tmp', 'w') as metricsfile:
+            metricsfile.write(text)
+        os.replace(path + '.tmp', path)
+
+
+METRICS = Metrics()
+
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """
+    Run a with block under cProfile, and save the stats to path, for
+    python3 -m pstats. Without a path, WEATHER_PROFILE is used. If
+    neither is set, the block runs unprofiled, at full speed.
+    """
+    path = path or os.environ.get('WEATHER_PROFILE')
+    if not path:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
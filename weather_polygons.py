@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+"""
+Forecast zone boundary polygons, for exact point-in-zone lookups
+
+The zone table only has one centroid per zone, so the zone with the
+closest centroid is often wrong near a border. nws_database_creator
+converts the zone boundaries (a GeoJSON export of the NWS zone shapefile)
+into one binary file. closest_weather_location loads it, and finds the
+zone that actually contains a point.
+
+Each polygon has a bounding box. On load, the boxes are put into a grid
+of GRID-degree cells, so a lookup tests only the few polygons whose box
+covers the point's cell, then runs an even-odd ray casting test. Holes
+are inner rings, and need no special case.
+
+Layout (little-endian, each section padded to 8 bytes):
+    Header       magic b'NWSP', version (u16), reserved (u16),
+                 polygon, ring, and vertex counts (u32)
+    Zone IDs     length (u32), then utf-8 text: the zone IDs, joined by '\\n'
+    Zones        i32 x polygons: index into the zone IDs
+    Boxes        float64 x 4 x polygons: south, north, west, east
+    Rings        u32 x (polygons + 1): first ring of each polygon
+    Vertices     u32 x (rings + 1): first vertex of each ring
+    Longitude    float64 x vertices
+    Latitude     float64 x vertices
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+import struct
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import json
+import math
+from array import array
+
+# Other modules of this project
+from weather_snapshot import padding, little_endian, from_little_endian
+
+
+MAGIC   = b'NWSP'
+VERSION = 1
+HEADER  = struct.Struct('<4sHHIII')
+LENGTH  = struct.Struct('<I')
+GRID    = 1.0       # Degrees per grid index cell
+
+
+def zone_id(properties):
+    """
+    The zone ID (like the zone table's 'WI066') of a GeoJSON feature.
+    The NWS shapefile has STATE_ZONE ('WI066'), and STATE ('WI') and ZONE
+    ('066'). Output is None if the feature has neither.
+    """
+    state_zone = properties.get('STATE_ZONE')
+    if state_zone:
+        return state_zone
+    state = properties.get('STATE')
+    zone  = properties.get('ZONE')
+    if state and zone:
+        return state + zone
+    return None
+
+
+def read_geojson(stream):
+    """
+    Yield (zone ID, polygon) for every zone polygon of a GeoJSON
+    FeatureCollection. A polygon is a list of rings, and each ring is a
+    list of (lon, lat). A MultiPolygon yields each of its polygons.
+    Features without a zone ID, or without a polygon, are skipped.
+    """
+    collection = json.load(stream)
+    for feature in collection.get('features', []):
+        sta_id   = zone_id(feature.get('properties') or {})
+        geometry = feature.get('geometry') or {}
+        if sta_id is None:
+            continue
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        for polygon in polygons:
+            rings = [[(float(point[0]), float(point[1])) for point in ring]
+                     for ring in polygon if len(ring) >= 3]
+            if rings:
+                yield (sta_id, rings)
+
+
+def write(path, polygons):
+    """
+    Write the polygon file.
+    Input: the path, and an iterable of (zone ID, polygon) tuples, like
+           read_geojson() yields
+    """
+    ids      = []
+    numbers  = {}
+    zones    = array('i')
+    boxes    = array('d')
+    rings    = array('I', [0])
+    vertices = array('I', [0])
+    lons     = array('d')
+    lats     = array('d')
+    for sta_id, polygon in polygons:
+        if sta_id not in numbers:
+            numbers[sta_id] = len(ids)
+            ids.append(sta_id)
+        zones.append(numbers[sta_id])
+        outer = polygon[0]
+        boxes.extend([min(lat for lon, lat in outer),
+                      max(lat for lon, lat in outer),
+                      min(lon for lon, lat in outer),
+                      max(lon for lon, lat in outer)])
+        for ring in polygon:
+            lons.extend(lon for lon, lat in ring)
+            lats.extend(lat for lon, lat in ring)
+            vertices.append(len(lons))
+        rings.append(len(vertices) - 1)
+
+    text   = '\n'.join(ids).encode('utf-8')
+    chunks = [HEADER.pack(MAGIC, VERSION, 0, len(zones), len(vertices) - 1,
+                          len(lons)),
+              LENGTH.pack(len(text)), text,
+              bytes(padding(HEADER.size + LENGTH.size + len(text)))]
+    for values in (zones, boxes, rings, vertices, lons, lats):
+        chunks.append(little_endian(values))
+        chunks.append(bytes(padding(values.itemsize * len(values))))
+    with open(path + '.tmp', 'wb') as polyfile:
+        polyfile.write(b''.join(chunks))
+    os.replace(path + '.tmp', path)
+
+
+def _ascending(starts, total):
+    """ True if a table of first positions runs from 0 up to total """
+    return starts[0] == 0 and starts[-1] == total \
+        and all(a <= b for a, b in zip(starts, starts[1:]))
+
+
+
+class ZonePolygons(object):
+    """
+    Read a zone polygon file, and find the zone that contains a point
+    """
+    def __init__(self, path):
+        """ Read and check the file, then build the grid index """
+        with open(path, 'rb') as polyfile:
+            data = memoryview(polyfile.read())
+        if len(data) < HEADER.size + LENGTH.size:
+            raise ValueError("{}: not a zone polygon file".format(path))
+        magic, version, _, n_polygons, n_rings, n_vertices = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("{}: not a zone polygon file".format(path))
+        if version != VERSION:
+            raise ValueError("{}: unsupported zone polygon version {}"
+                             .format(path, version))
+
+        def check(end):
+            if end > len(data):
+                raise ValueError("{}: truncated zone polygon file"
+                                 .format(path))
+
+        offset = HEADER.size
+        length = LENGTH.unpack_from(data, offset)[0]
+        offset = offset + LENGTH.size
+        check(offset + length)
+        try:
+            text = bytes(data[offset:offset + length]).decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("{}: corrupt zone polygon file".format(path))
+        offset = offset + length
+        offset = offset + padding(offset)
+        self.ids = text.split('\n') if text else []
+
+        sections = []
+        for typecode, count in (('i', n_polygons), ('d', 4 * n_polygons),
+                                ('I', n_polygons + 1), ('I', n_rings + 1),
+                                ('d', n_vertices), ('d', n_vertices)):
+            size = array(typecode).itemsize * count
+            check(offset + size)
+            sections.append(from_little_endian(typecode,
+                                                data[offset:offset + size]))
+            offset = offset + size
+            offset = offset + padding(offset)
+        self.zones, self.boxes, self.rings, self.vertices, self.lons, \
+            self.lats = sections
+        # Every zone must be an index into the zone IDs, the rings and
+        # vertices must run in order to their counts, and the boxes must
+        # be on the globe
+        if (n_polygons and (min(self.zones) < 0
+                            or max(self.zones) >= len(self.ids))) \
+        or not _ascending(self.rings, n_rings) \
+        or not _ascending(self.vertices, n_vertices) \
+        or not all(-90 <= south <= north <= 90 and -540 <= west <= east <= 540
+                   for south, north, west, east
+                   in zip(*[iter(self.boxes)] * 4)):
+            raise ValueError("{}: corrupt zone polygon file".format(path))
+
+        self.grid = {}      # (row, col) grid cell -> list of polygons
+        for polygon in range(n_polygons):
+            south, north, west, east = self.boxes[4 * polygon:
+                                                  4 * polygon + 4]
+            for row in range(int(math.floor(south / GRID)),
+                             int(math.floor(north / GRID)) + 1):
+                for col in range(int(math.floor(west / GRID)),
+                                 int(math.floor(east / GRID)) + 1):
+                    cell = (row, col % int(round(360 / GRID)))
+                    self.grid.setdefault(cell, []).append(polygon)
+
+    def __len__(self):
+        return len(self.zones)
+
+    def contains(self, polygon, latitude, longitude):
+        """ Even-odd ray casting test of one polygon (all of its rings) """
+        inside = False
+        lons   = self.lons
+        lats   = self.lats
+        for ring in range(self.rings[polygon], self.rings[polygon + 1]):
+            first = self.vertices[ring]
+            last  = self.vertices[ring + 1]
+            j     = last - 1
+            for i in range(first, last):
+                if (lats[i] > latitude) != (lats[j] > latitude) \
+                and longitude < (lons[j] - lons[i]) * (latitude - lats[i]) \
+                                / (lats[j] - lats[i]) + lons[i]:
+                    inside = not inside
+                j = i
+        return inside
+
+    def lookup(self, latitude, longitude):
+        """
+        The ID of the zone that contains a point, or None if no zone
+        polygon contains it
+        """
+        cell = (int(math.floor(latitude / GRID)),
+                int(math.floor(longitude / GRID)) % int(round(360 / GRID)))
+        for polygon in self.grid.get(cell, ()):
+            south, north, west, east = self.boxes[4 * polygon:
+                                                  4 * polygon + 4]
+            if not south <= latitude <= north:
+                continue
+            # The polygon may use longitudes past +/-180
+            for lon in (longitude, longitude - 360, longitude + 360):
+                if west <= lon <= east and self.contains(polygon, latitude,
+                                                         lon):
+                    return self.ids[self.zones[polygon]]
+        return None
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+"""
+Precomputed nearest-station raster for the weather location tables
+
+nws_database_creator divides a service area into a lat/lon grid, and
+records the nearest radar, METAR station, and zone for every grid cell:
+a discretized Voronoi map. closest_weather_location answers a query in the
+area with one array lookup.
+
+A cell is flagged ambiguous when a different station might be nearest for
+some point inside it. The client must run an exact search for those cells.
+By the triangle inequality, the station nearest to the cell center is the
+nearest for the whole cell if the runner-up is more than one cell diameter
+further away.
+
+Layout (little-endian, each section padded to 8 bytes):
+    Header       magic b'NWSR', version (u16), table count (u16),
+                 south, west, step (float64), grid rows, grid cols (u32)
+    Per table    length (u32), then utf-8 text: the table name, and its
+                 station IDs, joined by '\\n'. Then the answer for each
+                 cell (i32 index into those IDs, -1 for none)
+    Flags        one byte per cell. Bit n set: table n is ambiguous
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+import struct
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import math
+from array import array
+
+# Other modules of this project
+from weather_index import unit_vector, chord_to_km
+from weather_snapshot import padding, little_endian, from_little_endian
+
+
+MAGIC   = b'NWSR'
+VERSION = 1
+HEADER  = struct.Struct('<4sHHdddII')
+LENGTH  = struct.Struct('<I')
+
+# Service area of the raster. Edit as desired.
+BOUNDS  = {'south': 17.0, 'north': 72.0,     # Degrees latitude
+           'west': -180.0, 'east': -64.0,    # Degrees longitude
+           'step': 0.25}                     # Cell size, degrees
+
+
+def _distance(a_lat, a_lon, b_lat, b_lon):
+    """ Great-circle distance in km """
+    a_xyz = unit_vector(a_lat, a_lon)
+    b_xyz = unit_vector(b_lat, b_lon)
+    return chord_to_km(sum((a - b) ** 2 for a, b in zip(a_xyz, b_xyz)))
+
+
+def build(path, tables, bounds=None):
+    """
+    Compute and write the raster.
+    Input: the path, a list of (table name, SphereIndex, ID field name)
+           tuples, and the grid bounds (default BOUNDS)
+    Any existing file is replaced at once, when the new one is complete.
+    """
+    bounds = bounds or BOUNDS
+    step   = bounds['step']
+    south  = bounds['south']
+    west   = bounds['west']
+    n_rows = int(math.ceil((bounds['north'] - south) / step))
+    n_cols = int(math.ceil((bounds['east'] - west) / step))
+    if len(tables) > 8:
+        raise ValueError("The raster flags hold at most 8 tables")
+
+    chunks = [HEADER.pack(MAGIC, VERSION, len(tables), south, west, step,
+                          n_rows, n_cols)]
+    flags  = array('B', bytes(n_rows * n_cols))
+
+    for bit, (name, index, key) in enumerate(tables):
+        ids     = sorted(set(row[key] for row in index.rows))
+        numbers = dict((sta_id, number) for number, sta_id in enumerate(ids))
+        answers = array('i', [-1]) * (n_rows * n_cols)
+
+        for grid_row in range(n_rows):
+            lat = south + (grid_row + 0.5) * step
+            # Cell diameter: twice the distance from center to a corner
+            diameter = 2 * max(_distance(lat, 0, lat + step / 2, step / 2),
+                               _distance(lat, 0, lat - step / 2, step / 2))
+            for grid_col in range(n_cols):
+                lon  = west + (grid_col + 0.5) * step
+                cell = grid_row * n_cols + grid_col
+                first, first_km = index.query(lat, lon)
+                if first < 0:
+                    continue
+                answers[cell] = numbers[index.rows[first][key]]
+                second_km = index.query(lat, lon, exclude=first)[1]
+                if second_km is not None \
+                and second_km - first_km <= diameter:
+                    flags[cell] |= 1 << bit
+
+        text = '\n'.join([name] + ids).encode('utf-8')
+        chunks.append(LENGTH.pack(len(text)))
+        chunks.append(text)
+        chunks.append(bytes(padding(LENGTH.size + len(text))))
+        chunks.append(little_endian(answers))
+        chunks.append(bytes(padding(answers.itemsize * len(answers))))
+
+    chunks.append(flags.tobytes())
+    with open(path + '.tmp', 'wb') as rasterfile:
+        rasterfile.write(b''.join(chunks))
+    os.replace(path + '.tmp', path)
+
+
+
+class Raster(object):
+    """
+    Read a raster file, and answer nearest-station lookups from it
+    """
+    def __init__(self, path):
+        """
+        Read and check the file. Raises ValueError if it is not a valid
+        raster: every section is checked against the file size before it
+        is read, like weather_snapshot does.
+        """
+        with open(path, 'rb') as rasterfile:
+            data = memoryview(rasterfile.read())
+        if len(data) < HEADER.size:
+            raise ValueError("{}: not a weather raster".format(path))
+        magic, version, n_tables, south, west, step, n_rows, n_cols = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("{}: not a weather raster".format(path))
+        if version != VERSION:
+            raise ValueError("{}: unsupported raster version {}"
+                             .format(path, version))
+        if n_tables > 8 or not (math.isfinite(south) and math.isfinite(west)
+                                and math.isfinite(step) and step > 0):
+            raise ValueError("{}: corrupt weather raster".format(path))
+        self.south  = south
+        self.west   = west
+        self.step   = step
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        cells       = n_rows * n_cols
+
+        def check(end):
+            if end > len(data):
+                raise ValueError("{}: truncated weather raster"
+                                 .format(path))
+
+        self.tables = {}    # Table name -> (bit, IDs, answers)
+        offset = HEADER.size
+        for bit in range(n_tables):
+            check(offset + LENGTH.size)
+            length = LENGTH.unpack_from(data, offset)[0]
+            offset = offset + LENGTH.size
+            check(offset + length)
+            try:
+                text = bytes(data[offset:offset + length]).decode('utf-8')
+            except UnicodeDecodeError:
+                raise ValueError("{}: corrupt weather raster".format(path))
+            offset = offset + length
+            offset = offset + padding(offset)
+            lines  = text.split('\n')
+            check(offset + 4 * cells)
+            answers = from_little_endian('i', data[offset:offset + 4 * cells])
+            offset = offset + 4 * cells
+            offset = offset + padding(offset)
+            # Every answer must be an index into the IDs, or -1
+            if cells and (min(answers) < -1
+                          or max(answers) >= len(lines) - 1):
+                raise ValueError("{}: corrupt weather raster".format(path))
+            self.tables[lines[0]] = (bit, lines[1:], answers)
+        check(offset + cells)
+        self.flags = data[offset:offset + cells]
+
+    def cell(self, latitude, longitude):
+        """ The grid cell number of a lat/lon, or None outside the grid """
+        if not (math.isfinite(latitude) and math.isfinite(longitude)):
+            return None
+        grid_row = int(math.floor((latitude - self.south) / self.step))
+        grid_col = int(math.floor(((longitude - self.west) % 360)
+                                  / self.step))
+        if 0 <= grid_row < self.n_rows and 0 <= grid_col < self.n_cols:
+            return grid_row * self.n_cols + grid_col
+        return None
+
+    def lookup(self, name, latitude, longitude):
+        """
+        The ID of the nearest station of one table.
+        Output is None when the point is outside the grid, or in a cell
+        flagged ambiguous: then an exact search is needed.
+        """
+        if name not in self.tables:
+            return None
+        cell = self.cell(latitude, longitude)
+        if cell is None:
+            return None
+        bit, ids, answers = self.tables[name]
+        if self.flags[cell] & (1 << bit) or answers[cell] < 0:
+            return None
+        return ids[answers[cell]]
@@ -0,0 +1,357 @@
+#!/usr/bin/python3
+
+"""
+HTTP lookup service for closest_weather_location
+
+Load the weather location tables once, then answer lookups over HTTP.
+Only the Python standard library (asyncio) is used.
+
+    GET  /nearest?lat=43.01&lon=-87.99
+         One location. The reply is the dict run() prints, as JSON.
+    POST /nearest
+         Many locations. The body is a JSON list of [lat, lon] pairs.
+         The reply is a JSON list of answers, in the same order.
+
+Concurrent requests for the same coordinates share one lookup.
+
+With --watch, the service checks for a newly published generation of the
+tables every few seconds, and swaps it in without pausing lookups (see
+closest_weather_location.watch).
+
+Script usage:
+    python3 weather_service.py serve [--host HOST] [--port PORT] [--watch S]
+    python3 weather_service.py benchmark [--requests N] [--concurrency N]
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import sys
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import urllib.parse
+
+# Other modules of this project
+import closest_weather_location
+
+
+MAX_BODY   = 1024 * 1024    # Bytes. Larger POST bodies are refused
+MAX_POINTS = 10000          # Locations per POST request
+REASONS    = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+              405: 'Method Not Allowed', 413: 'Payload Too Large',
+              500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """ A request that cannot be answered. Reported with an HTTP status """
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+
+def _point(latitude, longitude):
+    """ Validate one query location. Output is a (lat, lon) tuple """
+    try:
+        latitude  = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        raise RequestError(400, "lat and lon must be numbers")
+    if not (math.isfinite(latitude) and math.isfinite(longitude)) \
+    or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise RequestError(400, "lat/lon out of range")
+    return (latitude, longitude)
+
+
+
+class LookupService(object):
+    """
+    Answer nearest-location requests from one WeatherLocator
+    - Parse just enough HTTP/1.1 (with keep-alive) for the two endpoints
+    - Run each lookup in a worker thread, so slow lookups never block
+      the event loop
+    - Coalesce identical coordinates that are in flight at the same time
+    """
+    def __init__(self, locator):
+        self.locator   = locator
+        self.pending   = {}     # (lat, lon) -> Future of the answer
+        self.lookups   = 0      # Lookups actually run
+        self.coalesced = 0      # Lookups answered by another request's
+
+    async def resolve(self, latitude, longitude):
+        """ The resolve_all() answer for one location """
+        key = (latitude, longitude)
+        if key in self.pending:
+            self.coalesced = self.coalesced + 1
+            return await asyncio.shield(self.pending[key])
+
+        loop   = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, self.locator.resolve_all,
+                                      latitude, longitude)
+        self.pending[key] = future
+        self.lookups = self.lookups + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    async def answer(self, method, target, body):
+        """ Route one request. Output is the reply, ready for json.dumps """
+        url = urllib.parse.urlsplit(target)
+        if url.path != '/nearest':
+            raise RequestError(404, "Unknown path: {}".format(url.path))
+
+        if method == 'GET':
+            query = urllib.parse.parse_qs(url.query)
+            if 'lat' not in query or 'lon' not in query:
+                raise RequestError(400, "lat and lon are required")
+            return await self.resolve(*_point(query['lat'][0],
+                                              query['lon'][0]))
+
+        if method == 'POST':
+            try:
+                points = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise RequestError(400, "The body must be JSON")
+            if not isinstance(points, list) \
+            or not all(isinstance(point, list) and len(point) == 2
+                       for point in points):
+                raise RequestError(400, "The body must be [[lat, lon], ...]")
+            if len(points) > MAX_POINTS:
+                raise RequestError(413, "At most {} locations per request"
+                                   .format(MAX_POINTS))
+            points = [_point(*point) for point in points]
+            return await asyncio.gather(*[self.resolve(*point)
+                                          for point in points])
+
+        raise RequestError(405, "Use GET or POST")
+
+    async def handle(self, reader, writer):
+        """ Serve one client connection, until it closes """
+        try:
+            while True:
+                try:
+                    request = await reader.readline()
+                except ValueError:
+                    # Longer than the stream limit (asyncio LimitOverrunError)
+                    await self.reply(writer, 400,
+                                     {'error': "Request line is too long"},
+                                     False)
+                    break
+                if not request:
+                    break
+                try:
+                    method, target, version = \
+                        request.decode('latin-1').split()
+                except ValueError:
+                    break
+
+                headers = {}
+                try:
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = \
+                            line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                except ValueError:
+                    await self.reply(writer, 400,
+                                     {'error': "Header line is too long"},
+                                     False)
+                    break
+
+                keep_alive = headers.get('connection', '').lower() != 'close' \
+                    and version == 'HTTP/1.1'
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                try:
+                    if length < 0:
+                        keep_alive = False
+                        raise RequestError(400, "Bad Content-Length")
+                    if length > MAX_BODY:
+                        keep_alive = False
+                        raise RequestError(413, "Request body is too large")
+                    body   = await reader.readexactly(length)
+                    status = 200
+                    reply  = await self.answer(method, target, body)
+                except RequestError as error:
+                    status = error.status
+                    reply  = {'error': str(error)}
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as error:
+                    # A failed lookup: reply, and keep serving
+                    print("ERROR: {} {}: {!r}".format(method, target, error),
+                          file=sys.stderr)
+                    status = 500
+                    reply  = {'error': "Internal error"}
+
+                await self.reply(writer, status, reply, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def reply(self, writer, status, reply, keep_alive):
+        """ Send one JSON reply """
+        content = json.dumps(reply).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\n'
+                     'Content-Type: application/json\r\n'
+                     'Content-Length: {}\r\n'
+                     'Connection: {}\r\n\r\n'
+                     .format(status, REASONS[status], len(content),
+                             'keep-alive' if keep_alive else 'close')
+                     .encode('latin-1') + content)
+        await writer.drain()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """ Start listening. Output is the asyncio Server """
+        return await asyncio.start_server(self.handle, host, port)
+
+
+
+async def _client(host, port, paths, latencies, errors):
+    """
+    One benchmark connection: send each GET, keep the connection open.
+    The latency of each 200 reply is added to latencies. The status of
+    any other reply is added to errors.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for path in paths:
+            start = time.perf_counter()
+            writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'
+                         .format(path, host).encode('latin-1'))
+            await writer.drain()
+            status = (await reader.readline()).split()
+            status = int(status[1]) if len(status) > 1 else 0
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def benchmark(host, port, requests=2000, concurrency=50, repeat=0.0):
+    """
+    Load test a running service with GET /nearest requests.
+    repeat is the fraction of requests that reuse an earlier location,
+    which exercises request coalescing.
+    Output is a dict of p50 and p99 latency (ms) and requests per second
+    of the successful (200) requests, and the count of errors: other
+    replies, and connections that failed. The latencies are None if no
+    request succeeded.
+    """
+    if requests < 1 or concurrency < 1:
+        raise ValueError("requests and concurrency must be at least 1")
+    points = []
+    for count in range(requests):
+        if points and random.random() < repeat:
+            points.append(random.choice(points))
+        else:
+            points.append((round(random.uniform(25, 49), 4),
+                           round(random.uniform(-124, -67), 4)))
+    paths = ['/nearest?lat={}&lon={}'.format(lat, lon)
+             for lat, lon in points]
+
+    latencies = []
+    errors    = []
+    start     = time.perf_counter()
+    clients   = await asyncio.gather(*[_client(host, port,
+                                               paths[i::concurrency],
+                                               latencies, errors)
+                                       for i in range(concurrency)],
+                                     return_exceptions=True)
+    elapsed   = time.perf_counter() - start
+
+    latencies.sort()
+    failed = [error for error in clients if isinstance(error, Exception)]
+    output = {'requests'   : len(latencies),
+              'errors'     : len(errors) + len(failed),
+              'p50_ms'     : None,
+              'p99_ms'     : None,
+              'per_second' : len(latencies) / elapsed}
+    if latencies:
+        output['p50_ms'] = 1000 * latencies[len(latencies) // 2]
+        output['p99_ms'] = 1000 * latencies[int(len(latencies) * 0.99)]
+    return output
+
+
+async def _serve(host, port, watch=None):
+    """ Load the tables, and serve forever """
+    service = LookupService(closest_weather_location.WeatherLocator())
+    if watch:
+        closest_weather_location.watch(service.locator, watch)
+    server  = await service.start(host, port)
+    print("Serving on http://{}:{}/nearest".format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+async def _benchmark(requests, concurrency, repeat):
+    """ Start a service on a free port, and load test it """
+    service = LookupService(closest_weather_location.WeatherLocator())
+    server  = await service.start('127.0.0.1', 0)
+    port    = server.sockets[0].getsockname()[1]
+    async with server:
+        result = await benchmark('127.0.0.1', port, requests, concurrency,
+                                 repeat)
+    result['lookups']   = service.lookups
+    result['coalesced'] = service.coalesced
+    return result
+
+
+def _positive(text):
+    """ argparse type: an integer of at least 1 """
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
+
+
+def run(argv=None):
+    """ Command line """
+    parser = argparse.ArgumentParser(description="Weather location service")
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help="Run the HTTP service")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--watch', type=float, default=None,
+                       help="Check for new tables every WATCH seconds")
+    bench = commands.add_parser('benchmark', help="Load test the service")
+    bench.add_argument('--requests', type=_positive, default=2000)
+    bench.add_argument('--concurrency', type=_positive, default=50)
+    bench.add_argument('--repeat', type=float, default=0.5,
+                       help="Fraction of repeated locations (default 0.5)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        asyncio.run(_serve(args.host, args.port, args.watch))
+    elif args.command == 'benchmark':
+        result = asyncio.run(_benchmark(args.requests, args.concurrency,
+                                        args.repeat))
+        print(json.dumps(result, indent=1))
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+if __name__ == "__main__":
+    run()
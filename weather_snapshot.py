@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+"""
+Binary snapshot format for the weather location tables
+
+nws_database_creator writes each table as a .bin snapshot next to the CSV.
+closest_weather_location memory-maps the snapshot, so loading is nearly
+instant: coordinates are read in place, and strings are decoded only for
+rows that are actually used.
+
+Layout (little-endian, each section padded to 8 bytes):
+    Header       magic b'NWSW', version (u16), field count (u16),
+                 row count (u32)
+    Field names  length (u32), then the names as utf-8, joined by '\\n'
+    Latitude     float64 x rows
+    Longitude    float64 x rows
+    Per field    offsets (u32 x rows+1) into a utf-8 blob, then the blob
+
+Latitude and Longitude are the coordinate arrays. Every other field is a
+string column. Missing coordinates are stored as NaN.
+
+padding(), little_endian(), and from_little_endian() are shared with the
+other binary formats (weather_raster, weather_polygons, weather_bundle).
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+import struct
+import sys
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import math
+import mmap
+from array import array
+
+# Other modules of this project
+from weather_index import coordinate
+
+
+MAGIC   = b'NWSW'
+VERSION = 1
+HEADER  = struct.Struct('<4sHHI')
+LENGTH  = struct.Struct('<I')
+COORDS  = ('Latitude', 'Longitude')
+
+
+def padding(size):
+    """ Bytes needed to pad size up to the next multiple of 8 """
+    return -size % 8
+
+
+def little_endian(values):
+    """ Return the bytes of an array in little-endian order """
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_little_endian(typecode, data):
+    """ Return an array from little-endian bytes """
+    values = array(typecode, bytes(data))
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def write(path, fieldnames, rows):
+    """
+    Write a snapshot file.
+    Input: the path, the table field names (must include Latitude and
+           Longitude), and an iterable of rows (dicts keyed by field name)
+    Any existing file is replaced at once, when the new one is complete:
+    readers that mapped it keep the old one.
+    """
+    rows    = list(rows)
+    strings = [name for name in fieldnames if name not in COORDS]
+    names   = '\n'.join(strings).encode('utf-8')
+
+    chunks  = [HEADER.pack(MAGIC, VERSION, len(strings), len(rows)),
+               LENGTH.pack(len(names)), names]
+    chunks.append(bytes(padding(HEADER.size + LENGTH.size + len(names))))
+
+    for coord in COORDS:
+        column = array('d', [coordinate(row.get(coord), math.nan)
+                             for row in rows])
+        chunks.append(little_endian(column))
+
+    for name in strings:
+        offsets = array('I', [0])
+        blob    = bytearray()
+        for row in rows:
+            value = row.get(name)
+            blob += ('' if value is None else str(value)).encode('utf-8')
+            offsets.append(len(blob))
+        chunks.append(little_endian(offsets))
+        chunks.append(bytes(padding(offsets.itemsize * len(offsets))))
+        chunks.append(bytes(blob))
+        chunks.append(bytes(padding(len(blob))))
+
+    with open(path + '.tmp', 'wb') as binfile:
+        binfile.write(b''.join(chunks))
+    os.replace(path + '.tmp', path)
+
+
+
+class Snapshot(object):
+    """
+    Read-only, memory-mapped view of one snapshot file
+    - latitudes and longitudes are float64 memoryviews into the file
+    - Rows are built (as dicts of strings, like csv.DictReader) on access
+    """
+    def __init__(self, path):
+        """
+        Map the file, and check the header. If the file is not a valid
+        snapshot, the map is closed again, and ValueError is raised.
+        """
+        with open(path, 'rb') as binfile:
+            size = os.fstat(binfile.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError("{}: not a weather snapshot".format(path))
+            self._map = mmap.mmap(binfile.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view      = memoryview(self._map)
+        self.latitudes  = None
+        self.longitudes = None
+        self._strings   = {}
+        try:
+            self._read(path, size)
+        except Exception:
+            self.close()
+            raise
+
+    def _read(self, path, size):
+        """ Check the header, and find every section (see the layout) """
+        magic, version, n_fields, n_rows = HEADER.unpack_from(self._view, 0)
+        if magic != MAGIC:
+            raise ValueError("{}: not a weather snapshot".format(path))
+        if version != VERSION:
+            raise ValueError("{}: unsupported snapshot version {}"
+                             .format(path, version))
+
+        # Every section is checked against the file size before it is
+        # read, so a truncated file raises ValueError, like a bad header
+        def check(end):
+            if end > size:
+                raise ValueError("{}: truncated weather snapshot"
+                                 .format(path))
+
+        offset = HEADER.size
+        check(offset + LENGTH.size)
+        length = LENGTH.unpack_from(self._view, offset)[0]
+        offset = offset + LENGTH.size
+        check(offset + length)
+        try:
+            names = bytes(self._view[offset:offset + length]).decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("{}: corrupt weather snapshot".format(path))
+        offset = offset + length
+        offset = offset + padding(offset)
+        self.fieldnames = names.split('\n') if n_fields else []
+        self._rows      = n_rows
+        if len(self.fieldnames) != n_fields:
+            raise ValueError("{}: corrupt weather snapshot".format(path))
+
+        check(offset + 16 * n_rows)
+        self.latitudes  = self._column(offset, n_rows, 'd')
+        offset          = offset + 8 * n_rows
+        self.longitudes = self._column(offset, n_rows, 'd')
+        offset          = offset + 8 * n_rows
+
+        for name in self.fieldnames:
+            # Views are made only once the section is known to fit, and are
+            # kept where close() releases them
+            check(offset + 4 * (n_rows + 1))
+            start  = offset + 4 * (n_rows + 1)
+            start  = start + padding(start)
+            length = LENGTH.unpack_from(self._view, offset + 4 * n_rows)[0] \
+                if n_rows else 0
+            check(start + length)
+            self._strings[name] = (self._column(offset, n_rows + 1, 'I'),
+                                   self._view[start:start + length])
+            offset = start + length
+            offset = offset + padding(offset)
+
+    def _column(self, offset, count, typecode):
+        """ A typed view of count values at offset (zero-copy if possible) """
+        raw = self._view[offset:offset + count * struct.calcsize(typecode)]
+        if sys.byteorder == 'little':
+            return raw.cast(typecode)
+        values = array(typecode, raw)
+        values.byteswap()
+        return memoryview(values)
+
+    def __len__(self):
+        return self._rows
+
+    def __getitem__(self, position):
+        """ One row as a dict of strings """
+        if position < 0:
+            position = position + self._rows
+        if not 0 <= position < self._rows:
+            raise IndexError("snapshot row out of range")
+        row = {}
+        for name in self.fieldnames:
+            row[name] = self.field(name, position)
+        for coord, column in zip(COORDS, (self.latitudes, self.longitudes)):
+            value = column[position]
+            row[coord] = '' if math.isnan(value) else repr(value)
+        return row
+
+    def __iter__(self):
+        for position in range(self._rows):
+            yield self[position]
+
+    def field(self, name, position):
+        """ Decode one string field of one row """
+        offsets, blob = self._strings[name]
+        start, stop   = offsets[position], offsets[position + 1]
+        return bytes(blob[start:stop]).decode('utf-8')
+
+    def close(self):
+        """ Release the memory map. Views handed out become invalid """
+        for column in (self.latitudes, self.longitudes):
+            if column is not None:
+                column.release()
+        for offsets, blob in self._strings.values():
+            offsets.release()
+            blob.release()
+        self._strings = {}
+        self._view.release()
+        self._map.close()
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+"""
+SQLite database of the weather location tables, with an R*Tree index
+
+nws_database_creator writes one SQLite file, weather.sqlite, with a table
+per source ('radar', 'metar', 'zone'):
+    <table>          id (INTEGER PRIMARY KEY), then the CSV fields. The
+                     station ID field is UNIQUE (an index), Latitude and
+                     Longitude are REAL (NULL when missing), others TEXT
+    <table>_rtree    R*Tree virtual table: id, min/max lat, min/max lon.
+                     Stations without coordinates are left out
+
+Database answers nearest-station queries from the file: each query reads
+only the stations inside a bounding box around the point. The box grows
+until it holds a station that is provably the nearest, so whole tables are
+never loaded into Python.
+"""
+# Python Standard Library (Debian package libpython3.*-minimal)
+import os
+
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import math
+import sqlite3
+
+# Other modules of this project
+from weather_index import RADIUS, chord_to_km, coordinate, unit_vector
+
+
+COORDS   = ('Latitude', 'Longitude')
+FIRST_KM = 50           # Radius of the first bounding box. Doubled as needed
+
+
+def _quote(name):
+    """ Quote an SQL identifier """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def write(path, tables):
+    """
+    Write the database. Any existing file is replaced at once, when the
+    new one is complete.
+    Input: the path, and a list of (table name, ID field name, field names,
+           rows) tuples. Rows are dicts keyed by field name.
+    All rows are inserted in one transaction, with executemany().
+    """
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+    database = sqlite3.connect(path + '.tmp')
+    try:
+        with database:
+            for name, key, fieldnames, rows in tables:
+                _write_table(database, name, key, fieldnames, rows)
+        database.execute('ANALYZE')
+    finally:
+        database.close()
+    os.replace(path + '.tmp', path)
+
+
+def _write_table(database, name, key, fieldnames, rows):
+    """ Create and fill one table and its R*Tree """
+    columns = ['id INTEGER PRIMARY KEY']
+    for field in fieldnames:
+        if field in COORDS:
+            columns.append(_quote(field) + ' REAL')
+        elif field == key:
+            columns.append(_quote(field) + ' TEXT NOT NULL UNIQUE')
+        else:
+            columns.append(_quote(field) + ' TEXT')
+    database.execute('CREATE TABLE {} ({})'.format(_quote(name),
+                                                   ', '.join(columns)))
+    database.execute('CREATE VIRTUAL TABLE {} USING rtree(id, min_lat, '
+                     'max_lat, min_lon, max_lon)'
+                     .format(_quote(name + '_rtree')))
+
+    records = []
+    points  = []
+    for position, row in enumerate(rows, 1):
+        record = [position]
+        for field in fieldnames:
+            if field in COORDS:
+                record.append(coordinate(row.get(field)))
+            else:
+                record.append(row.get(field) or '')
+        records.append(record)
+        lat = coordinate(row.get('Latitude'))
+        lon = coordinate(row.get('Longitude'))
+        if lat is not None and lon is not None:
+            points.append((position, lat, lat, lon, lon))
+
+    database.executemany('INSERT INTO {} VALUES ({})'
+                         .format(_quote(name),
+                                 ', '.join('?' * (len(fieldnames) + 1))),
+                         records)
+    database.executemany('INSERT INTO {} VALUES (?, ?, ?, ?, ?)'
+                         .format(_quote(name + '_rtree')), points)
+
+
+
+def bounding_boxes(latitude, longitude, kilometers):
+    """
+    Lat/lon boxes that hold every point within kilometers of a point.
+    Output is a list of (south, north, west, east) tuples: two boxes when
+    the circle crosses the antimeridian, and None when it covers the
+    whole Earth.
+    """
+    angle = kilometers / RADIUS
+    if angle >= math.pi / 2:
+        return None
+    delta = math.degrees(angle)
+    south = latitude - delta
+    north = latitude + delta
+    if south <= -90 or north >= 90:
+        # A pole is inside the circle: every longitude
+        return [(max(south, -90.0), min(north, 90.0), -180.0, 180.0)]
+
+    # Widest longitude span of the circle (at its tangent points)
+    spread = math.degrees(math.asin(min(math.sin(angle)
+                                        / math.cos(math.radians(latitude)),
+                                        1.0)))
+    west = longitude - spread
+    east = longitude + spread
+    if spread >= 180:
+        return [(south, north, -180.0, 180.0)]
+    if west < -180:
+        return [(south, north, west + 360, 180.0),
+                (south, north, -180.0, east)]
+    if east > 180:
+        return [(south, north, west, 180.0),
+                (south, north, -180.0, east - 360)]
+    return [(south, north, west, east)]
+
+
+
+class Database(object):
+    """
+    Read a weather database, and answer nearest-station queries from it
+    """
+    def __init__(self, path):
+        """ Open the file read-only """
+        if not os.path.exists(path):
+            raise OSError("{}: no such database".format(path))
+        self.path       = path
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(path),
+                                          uri=True, check_same_thread=False)
+        self.fields     = {}        # Table name -> list of field names
+        for (name,) in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE '%\\_rtree%' ESCAPE '\\' "
+                "AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'"):
+            columns = self.connection.execute(
+                'PRAGMA table_info({})'.format(_quote(name))).fetchall()
+            self.fields[name] = [column[1] for column in columns[1:]]
+
+    def close(self):
+        """ Close the database """
+        self.connection.close()
+
+    def _row(self, name, record):
+        """ A table record as a dict of strings, like a CSV row """
+        row = {}
+        for field, value in zip(self.fields[name], record):
+            if value is None:
+                value = ''
+            elif isinstance(value, float):
+                value = repr(value)
+            row[field] = value
+        return row
+
+    def _candidates(self, name, boxes):
+        """ Records (id, fields...) with coordinates inside the boxes """
+        sql = 'SELECT t.* FROM {} AS t'.format(_quote(name))
+        if boxes is None:
+            return self.connection.execute(
+                sql + ' WHERE t."Latitude" IS NOT NULL'
+                ' AND t."Longitude" IS NOT NULL')
+        sql = sql + ' JOIN {} AS r ON r.id = t.id WHERE '.format(
+            _quote(name + '_rtree'))
+        sql = sql + ' OR '.join(['(r.max_lat >= ? AND r.min_lat <= ? '
+                                 'AND r.max_lon >= ? AND r.min_lon <= ?)']
+                                * len(boxes))
+        return self.connection.execute(
+            sql, [bound for box in boxes for bound in box])
+
+    def nearest(self, name, latitude, longitude):
+        """
+        The closest row of one table to a point.
+        Output is a tuple of (row dict, distance in km), or (None, None)
+        when the table has no located stations.
+
+        Start with a FIRST_KM box around the point. The nearest station in
+        the box is the answer if it is no further than the box radius:
+        any closer station would be inside the box, too. Otherwise double
+        the radius, until the box covers the whole Earth.
+        """
+        if name not in self.fields:
+            raise ValueError("Unknown table: {}".format(name))
+        longitude  = (longitude + 180) % 360 - 180
+        lat_col    = self.fields[name].index('Latitude') + 1
+        lon_col    = self.fields[name].index('Longitude') + 1
+        point      = unit_vector(latitude, longitude)
+        kilometers = FIRST_KM
+        while True:
+            boxes   = bounding_boxes(latitude, longitude, kilometers)
+            closest = None
+            for record in self._candidates(name, boxes):
+                xyz = unit_vector(record[lat_col], record[lon_col])
+                chord = sum((a - b) ** 2 for a, b in zip(point, xyz))
+                if closest is None or chord < closest[0]:
+                    closest = (chord, record)
+            if closest is not None \
+            and (boxes is None or chord_to_km(closest[0]) <= kilometers):
+                return (self._row(name, closest[1][1:]),
+                        chord_to_km(closest[0]))
+            if boxes is None:
+                return (None, None)
+            kilometers = kilometers * 2
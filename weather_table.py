@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+"""
+Compact, columnar storage for one weather location table
+
+A dict of dicts costs hundreds of bytes per station, and keeps every
+field as a separate object. StationTable keeps one column per field
+instead, with no object per value:
+    Text columns    one utf-8 blob (bytearray), and array('I') offsets
+                    into it, like the snapshot string sections
+                    (weather_snapshot). Strings are decoded on access.
+    Number columns  array('d'), 8 bytes per value
+    Station IDs     an open-addressing hash table of row positions,
+                    array('i'), instead of a dict of ID strings
+
+No table has a low-cardinality text column (a State is part of the
+Location text), so no column is shared or interned: each value is its
+own few bytes of blob.
+
+StationTable is a read-only Mapping of station ID -> Row. A Row is a
+small __slots__ view (table, position) that reads like the old per-station
+dict, so csv.DictWriter and the snapshot writer take it unchanged.
+Missing numbers are stored as NaN, and read back as None.
+"""
+# Python Standard Library (Debian package libpython3.*-stdlib)
+import collections.abc
+import itertools
+import math
+from array import array
+
+# Other modules of this project
+from weather_index import coordinate
+
+
+EMPTY = -1      # Unused slot of the ID hash table
+SLOTS = 8       # Smallest ID hash table
+
+
+
+class Row(collections.abc.Mapping):
+    """ Read-only view of one row of a StationTable """
+    __slots__ = ('_table', '_position')
+
+    def __init__(self, table, position):
+        self._table    = table
+        self._position = position
+
+    def __getitem__(self, field):
+        return self._table.value(field, self._position)
+
+    def __iter__(self):
+        return iter(self._table.fields)
+
+    def __len__(self):
+        return len(self._table.fields)
+
+    def __repr__(self):
+        return 'Row({!r})'.format(dict(self))
+
+
+
+class TextColumn(object):
+    """
+    One text column: utf-8 values end to end in a blob, and the offsets
+    of their ends. Value n is blob[offsets[n]:offsets[n + 1]].
+    """
+    __slots__ = ('offsets', 'blob')
+
+    def __init__(self):
+        self.offsets = array('I', [0])
+        self.blob    = bytearray()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, position):
+        """ One value, as utf-8 bytes """
+        return bytes(self.blob[self.offsets[position]:
+                               self.offsets[position + 1]])
+
+    def get(self, position):
+        """ One value, as str """
+        return self.blob[self.offsets[position]:
+                         self.offsets[position + 1]].decode('utf-8')
+
+    def extend(self, encoded):
+        """ Append a list of utf-8 values """
+        self.offsets.extend(itertools.islice(itertools.accumulate(
+            itertools.chain((self.offsets[-1],), map(len, encoded))), 1, None))
+        self.blob += b''.join(encoded)
+
+    def replace(self, position, data):
+        """ Replace one value. The later offsets move by the change """
+        start, end = self.offsets[position], self.offsets[position + 1]
+        self.blob[start:end] = data
+        change = len(data) - (end - start)
+        if change:
+            self.offsets[position + 1:] = array('I', [
+                offset + change for offset in self.offsets[position + 1:]])
+
+
+
+def _encode(values):
+    """ A text column to a list of utf-8 bytes. None is '' """
+    try:
+        return list(map(str.encode, values))
+    except TypeError:       # Not all str
+        return [str(value or '').encode('utf-8') for value in values]
+
+
+
+class StationTable(collections.abc.Mapping):
+    """
+    Columnar table of stations, keyed by station ID
+    - Text columns: TextColumn (utf-8 blob and offsets)
+    - Number columns: array('d'), NaN when missing
+    - add() appends one station, or replaces it if the ID already exists
+    """
+    def __init__(self, key, text_fields, number_fields):
+        """ key is the ID field. It must be one of the text fields """
+        if key not in text_fields:
+            raise ValueError("The key must be a text field")
+        self.key     = key
+        self.fields  = tuple(text_fields) + tuple(number_fields)
+        self._text   = dict((field, TextColumn()) for field in text_fields)
+        self._number = dict((field, array('d')) for field in number_fields)
+        self._slots  = array('i', [EMPTY]) * SLOTS  # ID hash -> position
+
+    def _find(self, data):
+        """
+        The slot of the ID hash table for one station ID (utf-8 bytes):
+        the slot that holds its position, or the empty slot it would take
+        """
+        slots = self._slots
+        keys  = self._text[self.key]
+        mask  = len(slots) - 1
+        slot  = hash(data) & mask
+        while slots[slot] != EMPTY and keys.raw(slots[slot]) != data:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _position(self, sta_id):
+        """ The row position of a station ID, or EMPTY """
+        if not isinstance(sta_id, str):
+            return EMPTY
+        return self._slots[self._find(sta_id.encode('utf-8'))]
+
+    def _reserve(self, count):
+        """
+        Make room in the ID hash table for count stations in all. It is
+        kept at most 2/3 full, so probe runs stay short.
+        """
+        size = len(self._slots)
+        if 3 * count <= 2 * size:
+            return
+        while 3 * count > 2 * size:
+            size = size * 2
+        self._slots = array('i', [EMPTY]) * size
+        keys = self._text[self.key]
+        self._insert((keys.raw(position) for position in range(len(keys))),
+                     0)
+
+    def _insert(self, encoded, start):
+        """
+        Add the positions of new station IDs (utf-8 bytes, not already in
+        the table) to the ID hash table, from position start on
+        """
+        slots = self._slots
+        mask  = len(slots) - 1
+        homes = [hash(data) & mask for data in encoded]
+        for position, slot in enumerate(homes, start):
+            while slots[slot] != EMPTY:
+                slot = (slot + 1) & mask
+            slots[slot] = position
+
+    def __getitem__(self, sta_id):
+        position = self._position(sta_id)
+        if position == EMPTY:
+            raise KeyError(sta_id)
+        return Row(self, position)
+
+    def __contains__(self, sta_id):
+        return self._position(sta_id) != EMPTY
+
+    def __iter__(self):
+        keys = self._text[self.key]
+        for position in range(len(keys)):
+            yield keys.get(position)
+
+    def __len__(self):
+        return len(self._text[self.key])
+
+    def value(self, field, position):
+        """ One field of one row. Missing numbers are None """
+        if field in self._number:
+            value = self._number[field][position]
+            return None if math.isnan(value) else value
+        return self._text[field].get(position)
+
+    def column(self, field):
+        """ A whole column: a list of str, or an array('d') (NaN missing) """
+        if field in self._number:
+            return self._number[field]
+        column = self._text[field]
+        return [column.get(position) for position in range(len(column))]
+
+    def add(self, values):
+        """
+        Add one station. values is a dict (or Row) of field -> value.
+        Missing text is '', missing or None numbers are NaN.
+        """
+        data = str(values[self.key]).encode('utf-8')
+        slot = self._find(data)
+        position = self._slots[slot]
+        if position == EMPTY:
+            position = len(self)
+            for field, column in self._text.items():
+                column.extend([str(values.get(field) or '').encode('utf-8')])
+            for field, column in self._number.items():
+                column.append(coordinate(values.get(field), math.nan))
+            self._slots[slot] = position
+            self._reserve(len(self))
+            return
+        for field, column in self._text.items():
+            column.replace(position,
+                           str(values.get(field) or '').encode('utf-8'))
+        for field, column in self._number.items():
+            column[position] = coordinate(values.get(field), math.nan)
+
+    def extend(self, columns):
+        """
+        Add many stations at once, from a dict of whole columns (like
+        radar_columns() returns). Fields not in the table are ignored.
+        Number columns are best given as array('d'). Other sequences are
+        converted like add() does: missing or None numbers are NaN.
+        """
+        keys  = _encode(columns[self.key])
+        count = len(keys)
+        if len(set(keys)) != count or \
+        (len(self) and any(self._slots[self._find(key)] != EMPTY
+                           for key in keys)):
+            # Duplicate IDs: the later station replaces the earlier
+            for position in range(count):
+                self.add(dict((field, columns[field][position])
+                              for field in self.fields if field in columns))
+            return
+
+        start = len(self)
+        self._reserve(start + count)
+        for field, column in self._text.items():
+            values = columns.get(field)
+            if field == self.key:
+                column.extend(keys)
+            elif values is None:
+                column.extend([b''] * count)
+            else:
+                column.extend(_encode(values))
+        self._insert(keys, start)
+        for field, column in self._number.items():
+            values = columns.get(field)
+            if values is None:
+                column.extend(array('d', [math.nan]) * count)
+            elif isinstance(values, array) and values.typecode == 'd':
+                column.extend(values)
+            else:
+                column.extend(array('d', [coordinate(value, math.nan)
+                                          for value in values]))